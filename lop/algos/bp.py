@@ -1,11 +1,13 @@
 import torch
 import torch.nn.functional as F
 from torch import optim
+from lop.algos.compiled_step import CompiledStep
+from lop.nets.sparse_linear import sparse_grad_supported
 
 
-class Backprop(object):
+class Backprop(CompiledStep):
     def __init__(self, net, step_size=0.001, loss='mse', opt='sgd', beta_1=0.9, beta_2=0.999, weight_decay=0.0,
-                 to_perturb=False, perturb_scale=0.1, device='cpu', momentum=0):
+                 to_perturb=False, perturb_scale=0.1, device='cpu', momentum=0, compile_step=False):
         self.net = net
         self.to_perturb = to_perturb
         self.perturb_scale = perturb_scale
@@ -21,10 +23,17 @@ class Backprop(object):
             self.opt = optim.AdamW(self.net.parameters(), lr=step_size, betas=(beta_1, beta_2),
                                    weight_decay=weight_decay)
 
+        # networks with a sparse-input first layer only get sparse gradients if the optimizer can use them
+        if getattr(self.net, 'sparse_input', False):
+            self.net.sparse_grad = sparse_grad_supported(self.opt)
+
         # define the loss function
         self.loss = loss
         self.loss_func = {'nll': F.cross_entropy, 'mse': F.mse_loss}[self.loss]
 
+        # with compile_step, the forward pass, the loss and the optimizer step are compiled, see CompiledStep
+        self.setup_step(compile_step=compile_step)
+
         # Placeholder
         self.previous_features = None
 
@@ -36,12 +45,14 @@ class Backprop(object):
         :return: loss
         """
         self.opt.zero_grad()
-        output, features = self.net.predict(x=x)
-        loss = self.loss_func(output, target)
+        loss, output, features = self.forward_loss(x, target)
         self.previous_features = features
 
         loss.backward()
-        self.opt.step()
+        # networks with CBP-layers without hooks replace their features after the backward pass, see ConvNet2.cbp_step
+        if getattr(self.net, 'explicit_cbp', False):
+            self.net.cbp_step()
+        self.opt_step()
         if self.to_perturb:
             self.perturb()
         if self.loss == 'nll':
@@ -1,10 +1,13 @@
 from torch import optim
+from lop.algos.compiled_step import CompiledStep
+from lop.nets.sparse_linear import sparse_grad_supported
 from lop.algos.gnt import GnT
+from lop.algos.fused_gnt import FusedGnT
 from lop.utils.AdamGnT import AdamGnT
 import torch.nn.functional as F
 
 
-class ContinualBackprop(object):
+class ContinualBackprop(CompiledStep):
     """
     The Continual Backprop algorithm, used in https://arxiv.org/abs/2108.06325v3
     """
@@ -27,6 +30,16 @@ class ContinualBackprop(object):
             momentum=0,
             outgoing_random=False,
             weight_decay=0,
+            fused=False,
+            lazy_decay=False,
+            weight_mag_period=1,
+            init_pool_size=0,
+            compact_step=False,
+            moment_dtype=None,
+            foreach=False,
+            compile_step=False,
+            static_replacement=False,
+            k_max=None,
     ):
         self.net = net
 
@@ -34,17 +47,25 @@ class ContinualBackprop(object):
         if opt == 'sgd':
             self.opt = optim.SGD(self.net.parameters(), lr=step_size, momentum=momentum, weight_decay=weight_decay)
         elif opt == 'adam':
-            self.opt = AdamGnT(self.net.parameters(), lr=step_size, betas=(beta, beta_2), weight_decay=weight_decay)
+            self.opt = AdamGnT(self.net.parameters(), lr=step_size, betas=(beta, beta_2), weight_decay=weight_decay,
+                               compact_step=compact_step, moment_dtype=moment_dtype, foreach=foreach)
+
+        # networks with a sparse-input first layer only get sparse gradients if the optimizer can use them
+        if getattr(self.net, 'sparse_input', False):
+            self.net.sparse_grad = sparse_grad_supported(self.opt)
 
         # define the loss function
         self.loss_func = {'nll': F.cross_entropy, 'mse': F.mse_loss}[loss]
 
+        # with compile_step, the forward pass, the loss and the optimizer step are compiled, see CompiledStep
+        self.setup_step(compile_step=compile_step)
+
         # a placeholder
         self.previous_features = None
 
         # define the generate-and-test object for the given network
         self.gnt = None
-        self.gnt = GnT(
+        self.gnt = (FusedGnT if fused else GnT)(
             net=self.net.layers,
             hidden_activations=self.net.act_type,
             opt=self.opt,
@@ -57,6 +78,11 @@ class ContinualBackprop(object):
             accumulate=accumulate,
             coeffs=coeffs,
             repl_rates=repl_rates,
+            lazy_decay=lazy_decay,
+            weight_mag_period=weight_mag_period,
+            init_pool_size=init_pool_size,
+            static=static_replacement,
+            k_max=k_max,
         )
 
     def learn(self, x, target):
@@ -67,19 +93,24 @@ class ContinualBackprop(object):
         :return: loss
         """
         # do a forward pass and get the hidden activations
-        output, features = self.net.predict(x=x)
-        loss = self.loss_func(output, target)
+        loss, output, features = self.forward_loss(x, target)
         self.previous_features = features
 
         # do the backward pass and take a gradient step
         self.opt.zero_grad()
         loss.backward()
-        self.opt.step()
+        self.opt_step()
 
         # take a generate-and-test step
         self.opt.zero_grad()
-        if type(self.gnt) is GnT:
+        if isinstance(self.gnt, GnT):
             self.gnt.gen_and_test(features=self.previous_features)
+            compaction = getattr(self.net, 'compaction', None)
+            if compaction is not None:
+                # reinitialized features start a new window of silent steps
+                for i in range(compaction.num_hidden_layers):
+                    for features_to_replace, mask in self.gnt.replaced_features[i]:
+                        compaction.revive(i, features_to_replace, mask=mask)
 
         if self.loss_func == F.cross_entropy:
             return loss.detach(), output.detach()
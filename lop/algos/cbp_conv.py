@@ -2,6 +2,7 @@ import torch
 from torch import nn
 from torch.nn.init import calculate_gain
 from lop.algos.cbp_linear import call_reinit, log_features, get_layer_bound
+from lop.utils.init_pool import InitPool
 
 
 class CBPConv(nn.Module):
@@ -18,6 +19,8 @@ class CBPConv(nn.Module):
             act_type='relu',
             util_type='contribution',
             decay_rate=0,
+            init_pool_size=0,
+            use_hooks=True,
     ):
         super().__init__()
         if type(in_layer) is not nn.Conv2d:
@@ -32,13 +35,17 @@ class CBPConv(nn.Module):
         self.maturity_threshold = maturity_threshold
         self.util_type = util_type
         self.decay_rate = decay_rate
-        self.features = None
+        self.init_pool_size = init_pool_size
+        self.init_pool = None
+        self.mean_abs_features, self.mean_features, self.feature_count = None, None, 0
         self.num_last_filter_outputs = num_last_filter_outputs
 
         """
-        Register hooks
+        Register hooks. Without hooks, forward only logs the features, and reinit has to be called explicitly after
+        the backward pass
         """
-        if self.replacement_rate > 0:
+        self.use_hooks = use_hooks
+        if self.replacement_rate > 0 and self.use_hooks:
             self.register_full_backward_hook(call_reinit)
             self.register_forward_hook(log_features)
 
@@ -58,8 +65,19 @@ class CBPConv(nn.Module):
         self.bound = get_layer_bound(layer=self.in_layer, init=init, gain=calculate_gain(nonlinearity=act_type))
 
     def forward(self, _input):
+        if self.replacement_rate > 0 and not self.use_hooks:
+            log_features(self, (_input,), _input)
         return _input
 
+    def stat_dims(self, features):
+        """
+        Dimensions over which the features are averaged by log_features. Before a linear layer, every position of a
+        channel has its own outgoing weights, so only the mini-batch dimension is averaged
+        """
+        if isinstance(self.out_layer, torch.nn.Linear):
+            return 0
+        return 0, 2, 3
+
     def get_features_to_reinit(self):
         """
         Returns: Features to replace
@@ -84,10 +102,10 @@ class CBPConv(nn.Module):
         """
         if isinstance(self.out_layer, torch.nn.Linear):
             output_weight_mag = self.out_layer.weight.data.abs().mean(dim=0).view(-1, self.num_last_filter_outputs)
-            self.util.data = (output_weight_mag * self.features.abs().mean(dim=0).view(-1, self.num_last_filter_outputs)).mean(dim=1)
+            self.util.data = (output_weight_mag * self.mean_abs_features.view(-1, self.num_last_filter_outputs)).mean(dim=1)
         elif isinstance(self.out_layer, torch.nn.Conv2d):
             output_weight_mag = self.out_layer.weight.data.abs().mean(dim=(0, 2, 3))
-            self.util.data = output_weight_mag * self.features.abs().mean(dim=(0, 2, 3))
+            self.util.data = output_weight_mag * self.mean_abs_features
         """
         Find features with smallest utility
         """
@@ -101,6 +119,18 @@ class CBPConv(nn.Module):
                     torch.tensor([i for i in range(self.num_last_filter_outputs)]).repeat(new_features_to_replace.size()[0]))
         return features_to_replace_input_indices, features_to_replace_output_indices
 
+    def new_input_weights(self, num_features):
+        """
+        Input weights for new features, taken from a pool on the layer's device when init_pool_size > 0
+        """
+        if self.init_pool_size > 0:
+            if self.init_pool is None:
+                self.init_pool = InitPool(row_shape=self.in_layer.weight.shape[1:], bound=self.bound,
+                                          pool_size=self.init_pool_size, device=self.util.device)
+            return self.init_pool.take(num_features)
+        # noinspection PyArgumentList
+        return torch.empty([num_features] + list(self.in_layer.weight.shape[1:]), device=self.util.device).uniform_(-self.bound, self.bound)
+
     def reinit_features(self, features_to_replace_input_indices, features_to_replace_output_indices):
         """
         Reset input and output weights for low utility features
@@ -109,9 +139,8 @@ class CBPConv(nn.Module):
             num_features_to_replace = features_to_replace_input_indices.shape[0]
             if num_features_to_replace == 0: return
             self.in_layer.weight.data[features_to_replace_input_indices, :] *= 0.0
-            # noinspection PyArgumentList
             self.in_layer.weight.data[features_to_replace_input_indices, :] += \
-                torch.empty([num_features_to_replace] + list(self.in_layer.weight.shape[1:]), device=self.util.device).uniform_(-self.bound, self.bound)
+                self.new_input_weights(num_features_to_replace)
             self.in_layer.bias.data[features_to_replace_input_indices] *= 0
 
             self.out_layer.weight.data[:, features_to_replace_output_indices] = 0
@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from math import sqrt
+from lop.utils.init_pool import InitPool
 
 
 def call_reinit(m, i, o):
@@ -8,14 +9,23 @@ def call_reinit(m, i, o):
 
 
 def log_features(m, i, o):
+    """
+    Reduce the input of a CBP layer to per-feature statistics: mean absolute activation, mean activation and number of
+    examples. With decay_rate > 0, the means are exponential moving averages of the per-mini-batch means, so the utility
+    uses the running mean of |activation| rather than |running mean of the activations|.
+    """
     with torch.no_grad():
+        dims = m.stat_dims(i[0])
+        mean_abs_features, mean_features = i[0].abs().mean(dim=dims), i[0].mean(dim=dims)
         if m.decay_rate == 0:
-            m.features = i[0]
+            m.mean_abs_features, m.mean_features = mean_abs_features, mean_features
+        elif m.mean_abs_features is None:
+            m.mean_abs_features = (1 - m.decay_rate) * mean_abs_features
+            m.mean_features = (1 - m.decay_rate) * mean_features
         else:
-            if m.features is None:
-                m.features = (1 - m.decay_rate) * i[0]
-            else:
-                m.features = m.features * m.decay_rate + (1 - m.decay_rate) * i[0]
+            m.mean_abs_features = m.mean_abs_features * m.decay_rate + (1 - m.decay_rate) * mean_abs_features
+            m.mean_features = m.mean_features * m.decay_rate + (1 - m.decay_rate) * mean_features
+        m.feature_count += i[0].shape[0]
 
 
 def get_layer_bound(layer, init, gain):
@@ -46,6 +56,8 @@ class CBPLinear(nn.Module):
             act_type='relu',
             util_type='contribution',
             decay_rate=0,
+            init_pool_size=0,
+            use_hooks=True,
     ):
         super().__init__()
         if type(in_layer) is not nn.Linear:
@@ -59,11 +71,15 @@ class CBPLinear(nn.Module):
         self.maturity_threshold = maturity_threshold
         self.util_type = util_type
         self.decay_rate = decay_rate
-        self.features = None
+        self.init_pool_size = init_pool_size
+        self.init_pool = None
+        self.mean_abs_features, self.mean_features, self.feature_count = None, None, 0
         """
-        Register hooks
+        Register hooks. Without hooks, forward only logs the features, and reinit has to be called explicitly after
+        the backward pass
         """
-        if self.replacement_rate > 0:
+        self.use_hooks = use_hooks
+        if self.replacement_rate > 0 and self.use_hooks:
             self.register_full_backward_hook(call_reinit)
             self.register_forward_hook(log_features)
 
@@ -83,8 +99,16 @@ class CBPLinear(nn.Module):
         self.bound = get_layer_bound(layer=self.in_layer, init=init, gain=nn.init.calculate_gain(nonlinearity=act_type))
 
     def forward(self, _input):
+        if self.replacement_rate > 0 and not self.use_hooks:
+            log_features(self, (_input,), _input)
         return _input
 
+    def stat_dims(self, features):
+        """
+        Dimensions over which the features are averaged by log_features
+        """
+        return [i for i in range(features.ndim - 1)]
+
     def get_features_to_reinit(self):
         """
         Returns: Features to replace
@@ -107,7 +131,7 @@ class CBPLinear(nn.Module):
         Calculate feature utility
         """
         output_weight_mag = self.out_layer.weight.data.abs().mean(dim=0)
-        self.util.data = output_weight_mag * self.features.abs().mean(dim=[i for i in range(self.features.ndim - 1)])
+        self.util.data = output_weight_mag * self.mean_abs_features
         """
         Find features with smallest utility
         """
@@ -116,6 +140,17 @@ class CBPLinear(nn.Module):
         features_to_replace = new_features_to_replace
         return features_to_replace
 
+    def new_input_weights(self, num_features):
+        """
+        Input weights for new features, taken from a pool on the layer's device when init_pool_size > 0
+        """
+        if self.init_pool_size > 0:
+            if self.init_pool is None:
+                self.init_pool = InitPool(row_shape=(self.in_layer.in_features,), bound=self.bound,
+                                          pool_size=self.init_pool_size, device=self.util.device)
+            return self.init_pool.take(num_features)
+        return torch.empty(num_features, self.in_layer.in_features, device=self.util.device).uniform_(-self.bound, self.bound)
+
     def reinit_features(self, features_to_replace):
         """
         Reset input and output weights for low utility features
@@ -124,8 +159,7 @@ class CBPLinear(nn.Module):
             num_features_to_replace = features_to_replace.shape[0]
             if num_features_to_replace == 0: return
             self.in_layer.weight.data[features_to_replace, :] *= 0.0
-            self.in_layer.weight.data[features_to_replace, :] += \
-                torch.empty(num_features_to_replace, self.in_layer.in_features, device=self.util.device).uniform_(-self.bound, self.bound)
+            self.in_layer.weight.data[features_to_replace, :] += self.new_input_weights(num_features_to_replace)
             self.in_layer.bias.data[features_to_replace] *= 0
 
             self.out_layer.weight.data[:, features_to_replace] = 0
@@ -0,0 +1,67 @@
+import torch
+
+
+class CompiledStep(object):
+    """
+    Forward pass, loss and optimizer step shared by Backprop and ContinualBackprop, and learn_many on top of them.
+    With compile_step, the forward pass and the loss are compiled for inputs of a fixed shape, which also compiles
+    their backward pass, and so is the optimizer step. AdamGnT keeps its step counts in tensors that generate-and-test
+    resets in place, so the compiled step is not recompiled when features are replaced. Generate-and-test itself is not
+    compiled.
+    learn_many copies every mini-batch into the same preallocated input tensors, so the compiled functions always see
+    the same inputs and are not recompiled.
+    The learner has to define self.net, self.opt and self.loss_func, call setup_step at the end of its __init__ and
+    use self.forward_loss and self.opt_step in learn.
+    """
+    def setup_step(self, compile_step=False):
+        self.compile_step = compile_step
+        self.forward_loss = self._forward_loss
+        self.opt_step = self.opt.step
+        if compile_step:
+            self.forward_loss = torch.compile(self._forward_loss, dynamic=False)
+            self.opt_step = torch.compile(self.opt.step)
+        self.x_buf, self.target_buf = None, None
+
+    def _forward_loss(self, x, target):
+        output, features = self.net.predict(x=x)
+        return self.loss_func(output, target), output, features
+
+    def step_inputs(self, x, target):
+        """
+        With compile_step, x and target copied into the preallocated input tensors
+        """
+        if not self.compile_step:
+            return x, target
+        if self.x_buf is None or self.x_buf.shape != x.shape or self.target_buf.shape != target.shape:
+            self.x_buf, self.target_buf = torch.empty_like(x), torch.empty_like(target)
+        self.x_buf.copy_(x)
+        self.target_buf.copy_(target)
+        return self.x_buf, self.target_buf
+
+    def learn_many(self, xs, targets, mini_batch_size=1):
+        """
+        Learn from a chunk of examples, one call to learn per mini-batch, in order. The losses are collected on the
+        device, so the chunk is only synchronized with the host when they are read
+        :param xs: inputs, (num_steps * mini_batch_size) * input shape
+        :param targets: desired outputs of the inputs
+        :param mini_batch_size: number of examples per step
+        :return: per-step losses (and the outputs, for the nll loss), without moving them off the device
+        """
+        num_steps = xs.shape[0] // mini_batch_size
+        losses = torch.empty(num_steps, device=xs.device)
+        outputs = None
+        for i in range(num_steps):
+            start, end = i * mini_batch_size, (i + 1) * mini_batch_size
+            x, target = self.step_inputs(xs[start: end], targets[start: end])
+            result = self.learn(x=x, target=target)
+            if isinstance(result, tuple):
+                loss, output = result
+                if outputs is None:
+                    outputs = output.new_empty((num_steps * mini_batch_size,) + output.shape[1:])
+                outputs[start: end] = output
+            else:
+                loss = result
+            losses[i] = loss
+        if outputs is not None:
+            return losses, outputs
+        return losses
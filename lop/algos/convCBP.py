@@ -10,14 +10,16 @@ class ConvCBP(object):
     """
     def __init__(self, net, step_size=0.001, loss='mse', opt='sgd', beta=0.9, beta_2=0.999, replacement_rate=0.0001,
                  decay_rate=0.9, init='kaiming', util_type='contribution', maturity_threshold=100, device='cpu',
-                 momentum=0, weight_decay=0):
+                 momentum=0, weight_decay=0, compact_step=False, moment_dtype=None,
+                 foreach=False, static_replacement=False, k_max=None):
         self.net = net
 
         # define the optimizer
         if opt == 'sgd':
             self.opt = optim.SGD(self.net.parameters(), lr=step_size, momentum=momentum, weight_decay=weight_decay)
         elif opt == 'adam':
-            self.opt = AdamGnT(self.net.parameters(), lr=step_size, betas=(beta, beta_2), weight_decay=weight_decay)
+            self.opt = AdamGnT(self.net.parameters(), lr=step_size, betas=(beta, beta_2), weight_decay=weight_decay,
+                               compact_step=compact_step, moment_dtype=moment_dtype, foreach=foreach)
 
         # define the loss function
         self.loss_func = {'nll': F.cross_entropy, 'mse': F.mse_loss}[loss]
@@ -37,6 +39,8 @@ class ConvCBP(object):
             util_type=util_type,
             maturity_threshold=maturity_threshold,
             device=device,
+            static=static_replacement,
+            k_max=k_max,
         )
 
     def learn(self, x, target):
@@ -58,5 +62,12 @@ class ConvCBP(object):
 
         # take a generate-and-test step
         self.gnt.gen_and_test(features=self.previous_features)
+        compaction = getattr(self.net, 'compaction', None)
+        if compaction is not None:
+            # the compacted layers are the last hidden layers, reinitialized features start a new window of silent steps
+            num_conv_layers = self.gnt.num_hidden_layers - compaction.num_hidden_layers
+            for i in range(compaction.num_hidden_layers):
+                for features_to_replace, mask in self.gnt.replaced_features[num_conv_layers + i]:
+                    compaction.revive(i, features_to_replace, mask=mask)
 
         return loss.detach(), output
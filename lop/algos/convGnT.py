@@ -4,16 +4,18 @@ import torch
 import sys
 from lop.utils.AdamGnT import AdamGnT
 from torch.nn.init import calculate_gain
-from lop.utils.miscellaneous import get_layer_bound
+from lop.utils.miscellaneous import get_layer_bound, bounded_topk, masked_index_copy_
 
 
 class ConvGnT(object):
     """
     Generate-and-Test algorithm for ConvNets, maturity threshold based tester, accumulates probability of replacement,
     with various measures of feature utility
+    With static, the features to replace are selected and reset with fixed-shape tensors, see GnT
     """
     def __init__(self, net, hidden_activation, opt, decay_rate=0.99, replacement_rate=1e-4, init='kaiming',
-                 num_last_filter_outputs=4, util_type='contribution', maturity_threshold=100, device='cpu'):
+                 num_last_filter_outputs=4, util_type='contribution', maturity_threshold=100, device='cpu',
+                 static=False, k_max=None):
         super(ConvGnT, self).__init__()
 
         self.net = net
@@ -43,20 +45,24 @@ class ConvGnT(object):
 
         for i in range(self.num_hidden_layers):
             if isinstance(self.net[i * 2], Conv2d):
-                self.util.append(zeros(self.net[i * 2].out_channels))
-                self.bias_corrected_util.append(zeros(self.net[i * 2].out_channels))
-                self.ages.append(zeros(self.net[i * 2].out_channels))
-                self.mean_feature_act.append(zeros(self.net[i * 2].out_channels))
-                self.mean_abs_feature_act.append(zeros(self.net[i * 2].out_channels))
+                self.util.append(zeros(self.net[i * 2].out_channels, device=self.device))
+                self.bias_corrected_util.append(zeros(self.net[i * 2].out_channels, device=self.device))
+                self.ages.append(zeros(self.net[i * 2].out_channels, device=self.device))
+                self.mean_feature_act.append(zeros(self.net[i * 2].out_channels, device=self.device))
+                self.mean_abs_feature_act.append(zeros(self.net[i * 2].out_channels, device=self.device))
             elif isinstance(self.net[i * 2], Linear):
-                self.util.append(zeros(self.net[i * 2].out_features))
-                self.bias_corrected_util.append(zeros(self.net[i * 2].out_features))
-                self.ages.append(zeros(self.net[i * 2].out_features))
-                self.mean_feature_act.append(zeros(self.net[i * 2].out_features))
-                self.mean_abs_feature_act.append(zeros(self.net[i * 2].out_features))
+                self.util.append(zeros(self.net[i * 2].out_features, device=self.device))
+                self.bias_corrected_util.append(zeros(self.net[i * 2].out_features, device=self.device))
+                self.ages.append(zeros(self.net[i * 2].out_features, device=self.device))
+                self.mean_feature_act.append(zeros(self.net[i * 2].out_features, device=self.device))
+                self.mean_abs_feature_act.append(zeros(self.net[i * 2].out_features, device=self.device))
 
         self.accumulated_num_features_to_replace = [0 for i in range(self.num_hidden_layers)]
         self.m = torch.nn.Softmax(dim=1)
+        """
+        Features replaced in the last step, per layer, as (indices, mask) pairs, the mask is None without static
+        """
+        self.replaced_features = [[] for _ in range(self.num_hidden_layers)]
 
         """
         Calculate uniform distribution's bound for random feature initialization
@@ -73,6 +79,19 @@ class ConvGnT(object):
                     self.num_new_features_to_replace.append(self.replacement_rate * self.net[i * 2].out_features)
                 elif isinstance(self.net[i * 2], Conv2d):
                     self.num_new_features_to_replace.append(self.replacement_rate * self.net[i * 2].out_channels)
+        """
+        Bounded number of replacements per layer and accumulated replacement counts for the static mode
+        """
+        self.static = static
+        if k_max is None:
+            k_max = [int(self.num_new_features_to_replace[i]) + 1 for i in range(self.num_hidden_layers)]
+        elif isinstance(k_max, int):
+            k_max = [k_max for _ in range(self.num_hidden_layers)]
+        self.k_max = [min(k_max[i], self.ages[i].shape[0]) for i in range(self.num_hidden_layers)]
+        self.static_accumulated_num_features_to_replace = None
+        if self.static:
+            self.static_accumulated_num_features_to_replace = zeros(self.num_hidden_layers, dtype=torch.float64,
+                                                                    device=self.device)
 
     def compute_bounds(self, hidden_activation, init='kaiming'):
         if hidden_activation in ['swish', 'elu']: hidden_activation = 'relu'
@@ -135,7 +154,7 @@ class ConvGnT(object):
                     new_util = new_util / input_wight_mag
 
             if self.util_type == 'random':
-                self.bias_corrected_util[layer_idx] = rand(self.util[layer_idx].shape)
+                self.bias_corrected_util[layer_idx] = rand(self.util[layer_idx].shape, device=self.device)
             else:
                 self.util[layer_idx] += (1 - self.decay_rate) * new_util
                 # correct the bias in the utility computation
@@ -196,7 +215,7 @@ class ConvGnT(object):
             if isinstance(self.net[i * 2], Conv2d) and isinstance(self.net[i * 2 + 2], Linear):
                 features_to_replace_output_indices[i] = \
                     (new_features_to_replace*self.num_last_filter_outputs).repeat_interleave(self.num_last_filter_outputs) + \
-                    tensor([i for i in range(self.num_last_filter_outputs)]).repeat(new_features_to_replace.size()[0])
+                    torch.arange(self.num_last_filter_outputs, device=self.device).repeat(new_features_to_replace.size()[0])
 
         return features_to_replace_input_indices, features_to_replace_output_indices, num_features_to_replace
 
@@ -213,12 +232,12 @@ class ConvGnT(object):
                 self.opt.state[self.net[i * 2].bias]['exp_avg'][features_to_replace_input_indices[i]] = 0.0
                 self.opt.state[self.net[i * 2].weight]['exp_avg_sq'][features_to_replace_input_indices[i], :] = 0.0
                 self.opt.state[self.net[i * 2].bias]['exp_avg_sq'][features_to_replace_input_indices[i]] = 0.0
-                self.opt.state[self.net[i * 2].weight]['step'][features_to_replace_input_indices[i], :] = 0
-                self.opt.state[self.net[i * 2].bias]['step'][features_to_replace_input_indices[i]] = 0
+                self.opt.reset_steps(self.net[i * 2].weight, rows=features_to_replace_input_indices[i])
+                self.opt.reset_steps(self.net[i * 2].bias, rows=features_to_replace_input_indices[i])
                 # output weights
                 self.opt.state[self.net[i * 2 + 2].weight]['exp_avg'][:, features_to_replace_output_indices[i]] = 0.0
                 self.opt.state[self.net[i * 2 + 2].weight]['exp_avg_sq'][:, features_to_replace_output_indices[i]] = 0.0
-                self.opt.state[self.net[i * 2 + 2].weight]['step'][:, features_to_replace_output_indices[i]] = 0
+                self.opt.reset_steps(self.net[i * 2 + 2].weight, cols=features_to_replace_output_indices[i])
 
     def gen_new_features(self, features_to_replace_input_indices, features_to_replace_output_indices, num_features_to_replace):
         """
@@ -240,7 +259,7 @@ class ConvGnT(object):
                     current_layer.weight.data[features_to_replace_input_indices[i], :] *= 0.0
                     current_layer.weight.data[features_to_replace_input_indices[i], :] -= - \
                         empty([num_features_to_replace[i]] + list(current_layer.weight.shape[1:])). \
-                            uniform_(-self.bounds[i], self.bounds[i])
+                            uniform_(-self.bounds[i], self.bounds[i]).to(self.device)
 
                 current_layer.bias.data[features_to_replace_input_indices[i]] *= 0.0
                 """
@@ -249,6 +268,100 @@ class ConvGnT(object):
                 next_layer.weight.data[:, features_to_replace_output_indices[i]] = 0
                 self.ages[i][features_to_replace_input_indices[i]] = 0
 
+    def static_test_features(self, features):
+        """
+        Same as test_features, with fixed-shape tensors
+        Returns:
+            Candidate features (input and output indices), Masks of the candidates that are replaced (for the input
+            and output indices)
+        """
+        features_to_replace_input_indices, features_to_replace_output_indices = [], []
+        input_masks, output_masks = [], []
+        accumulated = self.static_accumulated_num_features_to_replace
+
+        for i in range(self.num_hidden_layers):
+            self.ages[i] += 1
+            """
+            Update feature utility
+            """
+            self.update_utility(layer_idx=i, features=features[i])
+            """
+            Find the no. of features to replace, nothing is accumulated while no feature is eligible
+            """
+            eligible = self.ages[i] > self.maturity_threshold
+            accumulated[i] += self.num_new_features_to_replace[i] * eligible.any().double()
+            num_new_features_to_replace = accumulated[i].floor()
+            accumulated[i] -= num_new_features_to_replace
+
+            new_features_to_replace, mask = bounded_topk(-self.bias_corrected_util[i], eligible,
+                                                         num_new_features_to_replace, self.k_max[i])
+            """
+            Initialize utility for new features
+            """
+            masked_index_copy_(self.util[i], 0, new_features_to_replace, mask, 0)
+            masked_index_copy_(self.mean_feature_act[i], 0, new_features_to_replace, mask, 0)
+            masked_index_copy_(self.mean_abs_feature_act[i], 0, new_features_to_replace, mask, 0)
+
+            features_to_replace_input_indices.append(new_features_to_replace)
+            input_masks.append(mask)
+            if isinstance(self.net[i * 2], Conv2d) and isinstance(self.net[i * 2 + 2], Linear):
+                features_to_replace_output_indices.append(
+                    (new_features_to_replace*self.num_last_filter_outputs).repeat_interleave(self.num_last_filter_outputs) +
+                    torch.arange(self.num_last_filter_outputs, device=self.device).repeat(
+                        new_features_to_replace.size()[0]))
+                output_masks.append(mask.repeat_interleave(self.num_last_filter_outputs))
+            else:
+                features_to_replace_output_indices.append(new_features_to_replace)
+                output_masks.append(mask)
+
+        return features_to_replace_input_indices, features_to_replace_output_indices, input_masks, output_masks
+
+    def static_update_optim_params(self, features_to_replace_input_indices, features_to_replace_output_indices,
+                                   input_masks, output_masks):
+        """
+        Same as update_optim_params, for the candidates and masks of static_test_features
+        """
+        if self.opt_type == 'AdamGnT':
+            for i in range(self.num_hidden_layers):
+                input_indices, output_indices = features_to_replace_input_indices[i], features_to_replace_output_indices[i]
+                # input weights
+                weight_state, bias_state = self.opt.state[self.net[i * 2].weight], self.opt.state[self.net[i * 2].bias]
+                masked_index_copy_(bias_state['exp_avg'], 0, input_indices, input_masks[i], 0)
+                masked_index_copy_(weight_state['exp_avg_sq'], 0, input_indices, input_masks[i], 0)
+                masked_index_copy_(bias_state['exp_avg_sq'], 0, input_indices, input_masks[i], 0)
+                self.opt.reset_steps(self.net[i * 2].weight, rows=input_indices, mask=input_masks[i])
+                self.opt.reset_steps(self.net[i * 2].bias, rows=input_indices, mask=input_masks[i])
+                # output weights
+                next_state = self.opt.state[self.net[i * 2 + 2].weight]
+                masked_index_copy_(next_state['exp_avg'], 1, output_indices, output_masks[i], 0)
+                masked_index_copy_(next_state['exp_avg_sq'], 1, output_indices, output_masks[i], 0)
+                self.opt.reset_steps(self.net[i * 2 + 2].weight, cols=output_indices, mask=output_masks[i])
+
+    def static_gen_new_features(self, features_to_replace_input_indices, features_to_replace_output_indices,
+                                input_masks, output_masks):
+        """
+        Same as gen_new_features, for the candidates and masks of static_test_features
+        """
+        with torch.no_grad():
+            for i in range(self.num_hidden_layers):
+                current_layer = self.net[i * 2]
+                next_layer = self.net[i * 2 + 2]
+                input_indices, output_indices = features_to_replace_input_indices[i], features_to_replace_output_indices[i]
+
+                if isinstance(current_layer, Linear):
+                    new_weights = empty(input_indices.shape[0], current_layer.in_features).uniform_(
+                        -self.bounds[i], self.bounds[i]).to(self.device)
+                elif isinstance(current_layer, Conv2d):
+                    new_weights = empty([input_indices.shape[0]] + list(current_layer.weight.shape[1:])). \
+                        uniform_(-self.bounds[i], self.bounds[i]).to(self.device)
+                masked_index_copy_(current_layer.weight.data, 0, input_indices, input_masks[i], new_weights)
+                masked_index_copy_(current_layer.bias.data, 0, input_indices, input_masks[i], 0)
+                """
+                # Set the outgoing weights and ages to zero
+                """
+                masked_index_copy_(next_layer.weight.data, 1, output_indices, output_masks[i], 0)
+                masked_index_copy_(self.ages[i], 0, input_indices, input_masks[i], 0)
+
     def gen_and_test(self, features):
         """
         Perform generate-and-test
@@ -257,6 +370,20 @@ class ConvGnT(object):
         if not isinstance(features, list):
             print('features passed to generate-and-test should be a list')
             sys.exit()
+        self.replaced_features = [[] for _ in range(self.num_hidden_layers)]
+        if self.static:
+            if self.replacement_rate == 0:
+                return
+            replacement = self.static_test_features(features=features)
+            self.static_gen_new_features(*replacement)
+            self.static_update_optim_params(*replacement)
+            features_to_replace_input_indices, _, input_masks, _ = replacement
+            for i in range(self.num_hidden_layers):
+                self.replaced_features[i].append((features_to_replace_input_indices[i], input_masks[i]))
+            return
         features_to_replace_input_indices, features_to_replace_output_indices, num_features_to_replace = self.test_features(features=features)
         self.gen_new_features(features_to_replace_input_indices, features_to_replace_output_indices, num_features_to_replace)
         self.update_optim_params(features_to_replace_input_indices, features_to_replace_output_indices, num_features_to_replace)
+        for i in range(self.num_hidden_layers):
+            if num_features_to_replace[i] > 0:
+                self.replaced_features[i].append((features_to_replace_input_indices[i], None))
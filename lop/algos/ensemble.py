@@ -0,0 +1,247 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import optim
+from lop.algos.gnt import GnT
+from lop.algos.fused_gnt import FusedGnT
+from lop.utils.AdamGnT import AdamGnT
+
+
+def build_runs(make_net, seeds):
+    """
+    Build the networks of independent runs together with their random number generators
+    :param make_net: function that returns a new FFNN or DeepFFNN
+    :param seeds: seed of each run
+    :return: list of networks, list of generators
+    The generator of a run continues from the global random state right after its network was initialized,
+    which is where a single run seeded with torch.manual_seed(seed) would continue from.
+    """
+    nets, generators = [], []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        nets.append(make_net())
+        generator = torch.Generator()
+        generator.set_state(torch.get_rng_state())
+        generators.append(generator)
+    return nets, generators
+
+
+class EnsembleNet(nn.Module):
+    """
+    N FFNNs/DeepFFNNs with the same architecture, run together with batched matrix multiplications.
+    The networks keep their own parameters, which are the parameters of the ensemble: their weights are stacked into
+    batched tensors in every forward pass, so the gradients of the batched pass end up in the parameters of each run,
+    and the optimizer state and generate-and-test of a run work on them as they would in a single run.
+    """
+    def __init__(self, nets):
+        super(EnsembleNet, self).__init__()
+        self.num_runs = len(nets)
+        self.act_type = nets[0].act_type
+        self.num_hidden_layers = int(len(nets[0].layers) / 2)
+        self.nets = nn.ModuleList(nets)
+        self.activations = [nets[0].layers[i * 2 + 1] for i in range(self.num_hidden_layers)]
+
+    def stacked_layer(self, layer_idx):
+        """
+        :return: weights (runs * out-size * in-size) and biases (runs * out-size) of a linear layer of all runs
+        """
+        layers = [net.layers[layer_idx * 2] for net in self.nets]
+        return torch.stack([layer.weight for layer in layers]), torch.stack([layer.bias for layer in layers])
+
+    def predict(self, x):
+        """
+        Forward pass of all runs
+        :param x: input, runs * mini-batch * input-size
+        :return: estimated output (runs * mini-batch * output-size), activations of each hidden layer
+        """
+        activations = []
+        out = x
+        for i in range(self.num_hidden_layers):
+            weight, bias = self.stacked_layer(i)
+            out = torch.baddbmm(bias.unsqueeze(1), out, weight.transpose(1, 2))
+            out = self.activations[i](out)
+            activations.append(out)
+        weight, bias = self.stacked_layer(self.num_hidden_layers)
+        out = torch.baddbmm(bias.unsqueeze(1), out, weight.transpose(1, 2))
+        return out, activations
+
+
+def ensemble_loss(loss_func, output, target):
+    """
+    Loss of each run, reduced over the mini-batch in the same way as loss_func
+    :return: tensor of size runs
+    """
+    num_runs = output.shape[0]
+    if loss_func == F.cross_entropy:
+        losses = F.cross_entropy(output.flatten(0, 1), target.flatten(0, 1), reduction='none')
+        return losses.view(num_runs, -1).mean(dim=1)
+    return F.mse_loss(output, target, reduction='none').view(num_runs, -1).mean(dim=1)
+
+
+class EnsembleBackprop(object):
+    """
+    Backprop for N independent runs trained in lockstep on their own data streams.
+    Each run takes the steps Backprop would take on its own, but the batched matrix multiplications do not round in the
+    same way as the ones of a single network, so the runs are close to single runs with the same seeds, not identical.
+    """
+    def __init__(self, nets, generators=None, step_size=0.001, loss='mse', opt='sgd', beta_1=0.9, beta_2=0.999,
+                 weight_decay=0.0, to_perturb=False, perturb_scale=0.1, device='cpu', momentum=0):
+        self.net = EnsembleNet(nets=nets)
+        self.generators = generators if generators is not None else [None for _ in range(self.net.num_runs)]
+        self.to_perturb = to_perturb
+        self.perturb_scale = perturb_scale
+        self.device = device
+
+        # define the optimizer, all of them update each element independently
+        if opt == 'sgd':
+            self.opt = optim.SGD(self.net.parameters(), lr=step_size, weight_decay=weight_decay, momentum=momentum)
+        elif opt == 'adam':
+            self.opt = optim.Adam(self.net.parameters(), lr=step_size, betas=(beta_1, beta_2),
+                                  weight_decay=weight_decay)
+        elif opt == 'adamW':
+            self.opt = optim.AdamW(self.net.parameters(), lr=step_size, betas=(beta_1, beta_2),
+                                   weight_decay=weight_decay)
+
+        # define the loss function
+        self.loss = loss
+        self.loss_func = {'nll': F.cross_entropy, 'mse': F.mse_loss}[self.loss]
+
+        # Placeholder
+        self.previous_features = None
+
+    def learn(self, x, target):
+        """
+        Learn using one step of gradient-descent in every run
+        :param x: input, runs * mini-batch * input-size
+        :param target: desired output, runs * mini-batch * ...
+        :return: loss of each run
+        """
+        self.opt.zero_grad()
+        output, features = self.net.predict(x=x)
+        losses = ensemble_loss(self.loss_func, output, target)
+        self.previous_features = features
+
+        # the runs don't share parameters, so the gradient of the sum is the gradient of each run's loss
+        losses.sum().backward()
+        self.opt.step()
+        if self.to_perturb:
+            self.perturb()
+        if self.loss == 'nll':
+            return losses.detach(), output.detach()
+        return losses.detach()
+
+    def perturb(self):
+        with torch.no_grad():
+            for n, net in enumerate(self.net.nets):
+                for i in range(self.net.num_hidden_layers + 1):
+                    net.layers[i * 2].bias += \
+                        torch.empty(net.layers[i * 2].bias.shape).normal_(
+                            mean=0, std=self.perturb_scale, generator=self.generators[n]).to(self.device)
+                    net.layers[i * 2].weight += \
+                        torch.empty(net.layers[i * 2].weight.shape).normal_(
+                            mean=0, std=self.perturb_scale, generator=self.generators[n]).to(self.device)
+
+
+class EnsembleContinualBackprop(object):
+    """
+    Continual Backprop for N independent runs trained in lockstep on their own data streams.
+    Each run has its own generate-and-test object, with its own utilities, ages and random number generator, and it
+    resets the optimizer state of its own parameters. As with EnsembleBackprop, the runs are close to single runs with
+    the same seeds, but not identical, and a small difference in the utilities can change which feature is replaced.
+    """
+    def __init__(
+            self,
+            nets,
+            coeffs,
+            repl_rates,
+            generators=None,
+            step_size=0.001,
+            loss='mse',
+            opt='sgd',
+            beta=0.9,
+            beta_2=0.999,
+            decay_rate=0.9,
+            device='cpu',
+            maturity_threshold=100,
+            util_type='contribution',
+            init='kaiming',
+            accumulate=False,
+            momentum=0,
+            weight_decay=0,
+            fused=False,
+            compact_step=False,
+            moment_dtype=None,
+            foreach=False,
+            lazy_decay=False,
+            weight_mag_period=1,
+            init_pool_size=0,
+            static_replacement=False,
+            k_max=None,
+    ):
+        self.net = EnsembleNet(nets=nets)
+        generators = generators if generators is not None else [None for _ in range(self.net.num_runs)]
+
+        # define the optimizer, its state of the parameters of a run is the state of a single run
+        if opt == 'sgd':
+            self.opt = optim.SGD(self.net.parameters(), lr=step_size, momentum=momentum, weight_decay=weight_decay)
+        elif opt == 'adam':
+            self.opt = AdamGnT(self.net.parameters(), lr=step_size, betas=(beta, beta_2), weight_decay=weight_decay,
+                               compact_step=compact_step, moment_dtype=moment_dtype, foreach=foreach)
+
+        # define the loss function
+        self.loss_func = {'nll': F.cross_entropy, 'mse': F.mse_loss}[loss]
+
+        # a placeholder
+        self.previous_features = None
+
+        # define the generate-and-test object of each run
+        self.gnts = []
+        for n, net in enumerate(self.net.nets):
+            gnt = (FusedGnT if fused else GnT)(
+                net=net.layers,
+                hidden_activations=net.act_type,
+                opt=self.opt,
+                decay_rate=decay_rate,
+                maturity_threshold=maturity_threshold,
+                util_type=util_type,
+                device=device,
+                loss_func=self.loss_func,
+                init=init,
+                accumulate=accumulate,
+                coeffs=coeffs,
+                repl_rates=repl_rates,
+                lazy_decay=lazy_decay,
+                weight_mag_period=weight_mag_period,
+                init_pool_size=init_pool_size,
+                generator=generators[n],
+                static=static_replacement,
+                k_max=k_max,
+            )
+            self.gnts.append(gnt)
+
+    def learn(self, x, target):
+        """
+        Learn using one step of gradient-descent and generate-&-test in every run
+        :param x: input, runs * mini-batch * input-size
+        :param target: desired output, runs * mini-batch * ...
+        :return: loss of each run
+        """
+        # do a forward pass and get the hidden activations
+        output, features = self.net.predict(x=x)
+        losses = ensemble_loss(self.loss_func, output, target)
+        self.previous_features = features
+
+        # do the backward pass and take a gradient step
+        self.opt.zero_grad()
+        losses.sum().backward()
+        self.opt.step()
+
+        # take a generate-and-test step in each run
+        self.opt.zero_grad()
+        for n, gnt in enumerate(self.gnts):
+            gnt.gen_and_test(features=[layer_features[n] for layer_features in features])
+
+        if self.loss_func == F.cross_entropy:
+            return losses.detach(), output.detach()
+
+        return losses.detach()
@@ -0,0 +1,256 @@
+import sys
+import torch
+from lop.algos.gnt import GnT
+
+
+class FusedGnT(GnT):
+    """
+    Generate-and-Test for feed forward neural networks with the same replacement decisions as GnT, but with all the
+    per-feature statistics of the network kept in flat buffers. Utilities of all layers are updated at once, the low and
+    high utility criteria are resolved in a single selection pass, and the weights, biases and optimizer state of each
+    layer are reset with one indexed write.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FusedGnT, self).__init__(*args, **kwargs)
+        if self.static:
+            raise ValueError('FusedGnT does not implement the static replacement mode')
+        """
+        Flat buffers for the utility of all features/neurons, self.util[i] etc. are views into them
+        """
+        self.layer_sizes = [self.net[i * 2].out_features for i in range(self.num_hidden_layers)]
+        self.offsets = [0]
+        for size in self.layer_sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        num_features = self.offsets[-1]
+
+        self.flat_util = torch.zeros(num_features, device=self.device)
+        self.flat_bias_corrected_util = torch.zeros(num_features, device=self.device)
+        self.flat_ages = torch.zeros(num_features, device=self.device)
+        self.flat_mean_feature_act = torch.zeros(num_features, device=self.device)
+        self.util = list(torch.split(self.flat_util, self.layer_sizes))
+        self.bias_corrected_util = list(torch.split(self.flat_bias_corrected_util, self.layer_sizes))
+        self.ages = list(torch.split(self.flat_ages, self.layer_sizes))
+        self.mean_feature_act = list(torch.split(self.flat_mean_feature_act, self.layer_sizes))
+        self.flat_util_scale = 1.0
+        """
+        Layer index of every feature, used to count eligible features per layer in one op
+        """
+        self.feature_layer = torch.repeat_interleave(
+            torch.arange(self.num_hidden_layers, device=self.device),
+            torch.tensor(self.layer_sizes, device=self.device))
+
+    def update_utilities(self, features):
+        """
+        Update the utility of the features of all layers at once
+        """
+        with torch.no_grad():
+            self.flat_ages += 1
+            """
+            With lazy decay, the decay of all layers is kept in one scale, see GnT.update_lazy_utility
+            """
+            if self.lazy_decay:
+                self.flat_util_scale *= self.decay_rate
+                decay, step_size = 1, (1 - self.decay_rate) / self.flat_util_scale
+            else:
+                decay, step_size = self.decay_rate, 1 - self.decay_rate
+                self.flat_util *= decay
+            """
+            Adam-style bias correction
+            """
+            bias_correction = 1 - self.decay_rate ** self.flat_ages
+
+            mean_act = torch.cat([features[i].mean(dim=0) for i in range(self.num_hidden_layers)])
+            if decay != 1:
+                self.flat_mean_feature_act *= decay
+            self.flat_mean_feature_act -= - step_size * mean_act
+            if self.lazy_decay:
+                bias_corrected_act = (self.flat_util_scale * self.flat_mean_feature_act) / bias_correction
+            else:
+                bias_corrected_act = self.flat_mean_feature_act / bias_correction
+
+            new_util = [self.new_utility(layer_idx=i, features=features[i],
+                                         bias_corrected_act=bias_corrected_act[self.offsets[i]:self.offsets[i + 1]])
+                        for i in range(self.num_hidden_layers)]
+            if all(torch.is_tensor(util) for util in new_util):
+                self.flat_util += step_size * torch.cat(new_util)
+
+            if self.lazy_decay:
+                if self.flat_util_scale < self.min_util_scale:
+                    self.flat_util *= self.flat_util_scale
+                    self.flat_mean_feature_act *= self.flat_util_scale
+                    self.flat_util_scale = 1.0
+            else:
+                torch.div(self.flat_util, bias_correction, out=self.flat_bias_corrected_util)
+
+            if self.util_type == 'random':
+                for i in range(self.num_hidden_layers):
+                    self.bias_corrected_util[i].copy_(torch.rand(self.util[i].shape, generator=self.generator))
+
+    def corrected_utility(self, layer_idx):
+        """
+        Same as GnT.corrected_utility, with the decay of all layers in flat_util_scale, written into the flat buffer
+        """
+        if self.lazy_decay and self.util_type != 'random':
+            bias_correction = 1 - self.decay_rate ** self.ages[layer_idx]
+            torch.div(self.flat_util_scale * self.util[layer_idx], bias_correction,
+                      out=self.bias_corrected_util[layer_idx])
+        return self.bias_corrected_util[layer_idx]
+
+    def num_to_replace(self, layer_idx, num_eligible, criterion):
+        """
+        Number of features to replace in a layer under the given criterion, same bookkeeping as GnT.test_features
+        """
+        if num_eligible == 0:
+            return 0
+        index = 0 if criterion == 'low' else 1
+        num_new_features_to_replace = self.repl_rates[layer_idx][index] * num_eligible
+        self.accumulated_num_features_to_replace[layer_idx][index] += num_new_features_to_replace
+
+        if self.accumulate:
+            num_new_features_to_replace = int(self.accumulated_num_features_to_replace[layer_idx][index])
+            self.accumulated_num_features_to_replace[layer_idx][index] -= num_new_features_to_replace
+        else:
+            if num_new_features_to_replace < 1:
+                if torch.rand(1, generator=self.generator) <= num_new_features_to_replace:
+                    num_new_features_to_replace = 1
+            num_new_features_to_replace = int(num_new_features_to_replace)
+        return num_new_features_to_replace
+
+    def new_feature_weights(self, num_features_to_replace):
+        """
+        Draw the new input weights of the features to be replaced, one block per layer.
+        With init pools the rows are taken in replace_features, as they don't use the global random number generator.
+        """
+        new_weights = [None for _ in range(self.num_hidden_layers)]
+        if self.util_type == 'output' or self.init_pools is not None:
+            return new_weights
+        for i in range(self.num_hidden_layers):
+            if num_features_to_replace[i] == 0:
+                continue
+            new_weights[i] = self.new_input_weights(layer_idx=i, num_features=num_features_to_replace[i])
+        return new_weights
+
+    def select_features(self):
+        """
+        Find the features to replace in all layers, under both the low and the high utility criterion.
+        The counts are resolved first, in the same order as GnT, so that the random number stream is unchanged.
+        Returns:
+            Features to replace and new input weights in each layer, for each criterion
+        """
+        eligible = self.flat_ages > self.maturity_threshold
+        num_eligible = torch.zeros(self.num_hidden_layers, dtype=torch.long, device=self.device)
+        num_eligible = num_eligible.index_add_(0, self.feature_layer, eligible.long()).tolist()
+
+        num_low = [self.num_to_replace(i, num_eligible[i], 'low') for i in range(self.num_hidden_layers)]
+        new_weights_low = self.new_feature_weights(num_low)
+        """
+        Features replaced by the low criterion have their age reset, so they are not eligible for the high one
+        """
+        num_high = [self.num_to_replace(i, num_eligible[i] - num_low[i], 'high') for i in range(self.num_hidden_layers)]
+        new_weights_high = self.new_feature_weights(num_high)
+
+        features_low = [None for _ in range(self.num_hidden_layers)]
+        features_high = [None for _ in range(self.num_hidden_layers)]
+        if sum(num_low) + sum(num_high) == 0:
+            return features_low, features_high, new_weights_low, new_weights_high
+
+        if self.lazy_decay and self.util_type != 'random':
+            bias_correction = 1 - self.decay_rate ** self.flat_ages
+            torch.div(self.flat_util_scale * self.flat_util, bias_correction, out=self.flat_bias_corrected_util)
+        eligible_feature_indices = torch.split(torch.where(eligible)[0], num_eligible)
+        for i in range(self.num_hidden_layers):
+            if num_low[i] + num_high[i] == 0:
+                continue
+            eligible_indices = eligible_feature_indices[i] - self.offsets[i]
+            util = self.bias_corrected_util[i]
+            if num_low[i] > 0:
+                selected = torch.topk(-1 * util[eligible_indices], num_low[i])[1]
+                features_low[i] = eligible_indices[selected]
+                remaining = torch.ones(eligible_indices.shape[0], dtype=torch.bool, device=self.device)
+                remaining[selected] = False
+                eligible_indices = eligible_indices[remaining]
+            if num_high[i] > 0:
+                selected = torch.topk(util[eligible_indices], num_high[i])[1]
+                features_high[i] = eligible_indices[selected]
+
+        return features_low, features_high, new_weights_low, new_weights_high
+
+    def replace_features(self, features_low, features_high, new_weights_low, new_weights_high):
+        """
+        Reset the statistics, weights and optimizer state of the selected features with one write per tensor
+        """
+        with torch.no_grad():
+            flat_features_to_replace = []
+            for i in range(self.num_hidden_layers):
+                current_layer = self.net[i * 2]
+                next_layer = self.net[i * 2 + 2]
+                if self.util_type == 'output':
+                    current_layer.weight.clamp_(-10.0, 10.0)
+                    current_layer.bias.clamp_(-10.0, 10.0)
+
+                selected = [f for f in (features_low[i], features_high[i]) if f is not None]
+                if len(selected) == 0:
+                    continue
+                features_to_replace = torch.cat(selected)
+                flat_features_to_replace.append(features_to_replace + self.offsets[i])
+                self.replaced_features[i].append((features_to_replace, None))
+
+                if self.util_type == 'output':
+                    coeffs = torch.cat([torch.full((f.shape[0],), self.coeffs[i][j], device=self.device)
+                                        for j, f in enumerate((features_low[i], features_high[i])) if f is not None])
+                    current_layer.weight.data[features_to_replace, :] *= coeffs.unsqueeze(1)
+                    current_layer.bias.data[features_to_replace] *= coeffs
+                    current_layer.weight.clamp_(-10.0, 10.0)
+                    current_layer.bias.clamp_(-10.0, 10.0)
+                else:
+                    if self.init_pools is not None:
+                        new_weights = self.new_input_weights(layer_idx=i, num_features=features_to_replace.shape[0])
+                    else:
+                        new_weights = torch.cat([w for w in (new_weights_low[i], new_weights_high[i]) if w is not None])
+                    current_layer.weight.data[features_to_replace, :] = new_weights
+                    current_layer.bias.data[features_to_replace] = 0.0
+                    """
+                    The mean activation of the replaced features is reset during selection, so the bias correction of
+                    the next layer used by GnT adds zero and is skipped here. Set the outgoing weights to zero.
+                    """
+                    next_layer.weight.data[:, features_to_replace] = 0
+
+                self.update_layer_optim_params(layer_idx=i, features_to_replace=features_to_replace)
+
+            if len(flat_features_to_replace) == 0:
+                return
+            self.reset_weight_magnitudes()
+            flat_features_to_replace = torch.cat(flat_features_to_replace)
+            self.flat_util[flat_features_to_replace] = 0
+            self.flat_mean_feature_act[flat_features_to_replace] = 0.
+            self.flat_ages[flat_features_to_replace] = 0
+
+    def update_layer_optim_params(self, layer_idx, features_to_replace):
+        """
+        Update Optimizer's state for the features replaced in one layer
+        """
+        if self.opt_type != 'adam':
+            return
+        in_weight, in_bias = self.net[layer_idx * 2].weight, self.net[layer_idx * 2].bias
+        out_weight = self.net[layer_idx * 2 + 2].weight
+        for key in ['exp_avg', 'exp_avg_sq']:
+            self.opt.state[in_weight][key][features_to_replace, :] = 0.0
+            self.opt.state[in_bias][key][features_to_replace] = 0.0
+            self.opt.state[out_weight][key][:, features_to_replace] = 0.0
+        self.opt.reset_steps(in_weight, rows=features_to_replace)
+        self.opt.reset_steps(in_bias, rows=features_to_replace)
+        self.opt.reset_steps(out_weight, cols=features_to_replace)
+
+    def gen_and_test(self, features):
+        """
+        Perform generate-and-test
+        :param features: activation of hidden units in the neural network
+        """
+        if not isinstance(features, list):
+            print('features passed to generate-and-test should be a list')
+            sys.exit()
+
+        self.update_utilities(features=features)
+        self.replaced_features = [[] for _ in range(self.num_hidden_layers)]
+        features_low, features_high, new_weights_low, new_weights_high = self.select_features()
+        self.replace_features(features_low, features_high, new_weights_low, new_weights_high)
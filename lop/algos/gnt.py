@@ -4,11 +4,29 @@ import wandb
 from math import sqrt
 import torch.nn.functional as F
 from lop.utils.AdamGnT import AdamGnT
+from lop.utils.init_pool import InitPool
+from lop.utils.miscellaneous import bounded_topk, masked_index_copy_
 
 
 class GnT(object):
     """
     Generate-and-Test algorithm for feed forward neural networks, based on maturity-threshold based replacement
+
+    With lazy_decay, util and mean_feature_act are stored without the running decay, which is kept in a per-layer scale
+    instead and only applied when features are selected, or folded back when the scale gets too small for float32.
+    With weight_mag_period > 1, the input/output weight magnitudes used by the utility are recomputed every
+    weight_mag_period steps, and after every replacement. The mean absolute value of a row or column changes by at most
+    the largest change of a single weight in it, so the cached magnitudes are off by at most (weight_mag_period - 1)
+    times the largest per-step weight change, i.e. (weight_mag_period - 1) * lr * max|grad| for SGD and about
+    (weight_mag_period - 1) * lr for Adam.
+    With static, the features to replace are selected and reset with fixed-shape tensors (at most k_max[i] features
+    per layer and step, masked when they are not used), so a step never reads anything back to the host. The
+    selections are the same as the default mode, up to ties in the utility. Random numbers come from the same generator
+    and device as in the default mode, but the draw that decides a fractional replacement is made at every step, also
+    when the default mode skips it, and the weights of new features are drawn for all k_max[i] candidates, so the two
+    modes only consume the random number stream in the same way while the expected number of replacements stays below
+    one, no replacement happens and every layer has eligible features. The weight magnitudes are recomputed at every
+    step, as any step may have replaced features.
     """
     def __init__(
             self,
@@ -24,9 +42,16 @@ class GnT(object):
             util_type='contribution',
             loss_func=F.mse_loss,
             accumulate=False,
+            lazy_decay=False,
+            weight_mag_period=1,
+            init_pool_size=0,
+            generator=None,
+            static=False,
+            k_max=None,
     ):
         super(GnT, self).__init__()
         self.device = device
+        self.generator = generator
         self.net = net
         self.num_hidden_layers = int(len(self.net)/2)
         self.loss_func = loss_func
@@ -56,11 +81,49 @@ class GnT(object):
         self.accumulated_num_features_to_replace = [[0 for j in range(2)] for i in range(self.num_hidden_layers)]
         self.accumulate_total = [0 for i in range(2)]
         """
+        Features replaced in the last step, per layer, as (indices, mask) pairs, the mask is None without static
+        """
+        self.replaced_features = [[] for _ in range(self.num_hidden_layers)]
+        """
         Calculate uniform distribution's bound for random feature initialization
         """
         self.bounds = self.compute_bounds(init=init)
+        """
+        Pools of pre-generated input weights for new features, one per layer
+        """
+        self.init_pools = None
+        if init_pool_size > 0:
+            self.init_pools = [InitPool(row_shape=(self.net[i * 2].in_features,), bound=self.bounds[i],
+                                        pool_size=init_pool_size, device=self.device, generator=self.generator)
+                               for i in range(self.num_hidden_layers)]
         self.coeffs = coeffs
         self.repl_rates = repl_rates
+        """
+        Lazy decay of the utility and cached weight magnitudes
+        """
+        # with decay_rate 0 the scale would be 0 after one step, the utility is then just the last one, eagerly
+        self.lazy_decay = lazy_decay and self.decay_rate > 0
+        self.min_util_scale = 1e-10
+        self.util_scale = [1.0 for _ in range(self.num_hidden_layers)]
+        self.weight_mag_period = weight_mag_period
+        self.weight_mags = [None for _ in range(self.num_hidden_layers)]
+        self.weight_mag_steps = [0 for _ in range(self.num_hidden_layers)]
+        """
+        Bounded number of replacements per layer and accumulated replacement counts on the device for the static mode.
+        The accumulated count stays below 1 + repl_rate * num_features, so int(repl_rate * num_features) + 1
+        replacements per step are always enough
+        """
+        self.static = static
+        if k_max is None:
+            k_max = [int(max(self.repl_rates[i]) * self.net[i * 2].out_features) + 1
+                     for i in range(self.num_hidden_layers)]
+        elif isinstance(k_max, int):
+            k_max = [k_max for _ in range(self.num_hidden_layers)]
+        self.k_max = [min(k_max[i], self.net[i * 2].out_features) for i in range(self.num_hidden_layers)]
+        self.static_accumulated_num_features_to_replace = None
+        if self.static:
+            self.static_accumulated_num_features_to_replace = \
+                torch.zeros((self.num_hidden_layers, 2), dtype=torch.float64, device=self.device)
 
     def compute_bounds(self, init='kaiming'):
         if init == 'default':
@@ -70,7 +133,19 @@ class GnT(object):
         bounds.append(1 * sqrt(3 / self.net[self.num_hidden_layers * 2].in_features))
         return bounds
 
+    def new_input_weights(self, layer_idx, num_features):
+        """
+        Input weights for new features, from the pool of the layer if there is one
+        """
+        if self.init_pools is not None:
+            return self.init_pools[layer_idx].take(num_features)
+        # noinspection PyArgumentList
+        return torch.empty(num_features, self.net[layer_idx * 2].in_features).uniform_(
+            -self.bounds[layer_idx], self.bounds[layer_idx], generator=self.generator).to(self.device)
+
     def update_utility(self, layer_idx=0, features=None, next_features=None):
+        if self.lazy_decay:
+            return self.update_lazy_utility(layer_idx=layer_idx, features=features)
         with torch.no_grad():
             self.util[layer_idx] *= self.decay_rate
             """
@@ -82,28 +157,7 @@ class GnT(object):
             self.mean_feature_act[layer_idx] -= - (1 - self.decay_rate) * features.mean(dim=0)
             bias_corrected_act = self.mean_feature_act[layer_idx] / bias_correction
 
-            current_layer = self.net[layer_idx * 2]
-            next_layer = self.net[layer_idx * 2 + 2]
-            output_wight_mag = next_layer.weight.data.abs().mean(dim=0)
-            input_wight_mag = current_layer.weight.data.abs().mean(dim=1)
-
-            if self.util_type == 'weight':
-                new_util = output_wight_mag
-            elif self.util_type == 'contribution':
-                new_util = output_wight_mag * features.abs().mean(dim=0)
-            elif self.util_type == 'adaptation':
-                new_util = 1/input_wight_mag
-            elif self.util_type == 'zero_contribution':
-                new_util = output_wight_mag * (features - bias_corrected_act).abs().mean(dim=0)
-            elif self.util_type == 'adaptable_contribution':
-                new_util = output_wight_mag * (features - bias_corrected_act).abs().mean(dim=0) / input_wight_mag
-            elif self.util_type == 'feature_by_input':
-                input_wight_mag = self.net[layer_idx*2].weight.data.abs().mean(dim=1)
-                new_util = (features - bias_corrected_act).abs().mean(dim=0) / input_wight_mag
-            elif self.util_type == 'output':
-                new_util = features.mean(dim=0)
-            else:
-                new_util = 0
+            new_util = self.new_utility(layer_idx=layer_idx, features=features, bias_corrected_act=bias_corrected_act)
         
             self.util[layer_idx] += (1 - self.decay_rate) * new_util
 
@@ -113,7 +167,88 @@ class GnT(object):
             self.bias_corrected_util[layer_idx] = self.util[layer_idx] / bias_correction
 
             if self.util_type == 'random':
-                self.bias_corrected_util[layer_idx] = torch.rand(self.util[layer_idx].shape)
+                self.bias_corrected_util[layer_idx] = torch.rand(self.util[layer_idx].shape, generator=self.generator)
+
+    def update_lazy_utility(self, layer_idx=0, features=None):
+        """
+        Same update as update_utility, but the decay only changes self.util_scale[layer_idx].
+        The stored util and mean_feature_act have to be multiplied by the scale to get their actual values.
+        """
+        with torch.no_grad():
+            self.util_scale[layer_idx] *= self.decay_rate
+            scale = self.util_scale[layer_idx]
+            bias_correction = 1 - self.decay_rate ** self.ages[layer_idx]
+
+            self.mean_feature_act[layer_idx] += ((1 - self.decay_rate) / scale) * features.mean(dim=0)
+            bias_corrected_act = (scale * self.mean_feature_act[layer_idx]) / bias_correction
+
+            new_util = self.new_utility(layer_idx=layer_idx, features=features, bias_corrected_act=bias_corrected_act)
+            self.util[layer_idx] += ((1 - self.decay_rate) / scale) * new_util
+
+            if scale < self.min_util_scale:
+                self.util[layer_idx] *= scale
+                self.mean_feature_act[layer_idx] *= scale
+                self.util_scale[layer_idx] = 1.0
+
+            if self.util_type == 'random':
+                self.bias_corrected_util[layer_idx] = torch.rand(self.util[layer_idx].shape, generator=self.generator)
+
+    def corrected_utility(self, layer_idx):
+        """
+        Bias corrected utility of the features in a layer, computed from the lazy representation when needed
+        """
+        if self.lazy_decay and self.util_type != 'random':
+            bias_correction = 1 - self.decay_rate ** self.ages[layer_idx]
+            self.bias_corrected_util[layer_idx] = (self.util_scale[layer_idx] * self.util[layer_idx]) / bias_correction
+        return self.bias_corrected_util[layer_idx]
+
+    def weight_magnitudes(self, layer_idx):
+        """
+        Mean magnitude of the output and input weights of the features in a layer, recomputed every
+        self.weight_mag_period steps
+        """
+        self.weight_mag_steps[layer_idx] += 1
+        if self.weight_mags[layer_idx] is None or self.weight_mag_steps[layer_idx] >= self.weight_mag_period:
+            current_layer = self.net[layer_idx * 2]
+            next_layer = self.net[layer_idx * 2 + 2]
+            output_wight_mag, input_wight_mag = None, None
+            if self.util_type in ['weight', 'contribution', 'zero_contribution', 'adaptable_contribution']:
+                output_wight_mag = next_layer.weight.data.abs().mean(dim=0)
+            if self.util_type in ['adaptation', 'adaptable_contribution', 'feature_by_input']:
+                input_wight_mag = current_layer.weight.data.abs().mean(dim=1)
+            self.weight_mags[layer_idx] = (output_wight_mag, input_wight_mag)
+            self.weight_mag_steps[layer_idx] = 0
+        return self.weight_mags[layer_idx]
+
+    def reset_weight_magnitudes(self):
+        """
+        Replacing features changes the magnitude of the rows and columns of their layer and its neighbours
+        """
+        self.weight_mags = [None for _ in range(self.num_hidden_layers)]
+
+    def new_utility(self, layer_idx, features, bias_corrected_act):
+        """
+        Instantaneous utility of the features in a layer, before it is folded into the running average
+        """
+        output_wight_mag, input_wight_mag = self.weight_magnitudes(layer_idx)
+
+        if self.util_type == 'weight':
+            new_util = output_wight_mag
+        elif self.util_type == 'contribution':
+            new_util = output_wight_mag * features.abs().mean(dim=0)
+        elif self.util_type == 'adaptation':
+            new_util = 1/input_wight_mag
+        elif self.util_type == 'zero_contribution':
+            new_util = output_wight_mag * (features - bias_corrected_act).abs().mean(dim=0)
+        elif self.util_type == 'adaptable_contribution':
+            new_util = output_wight_mag * (features - bias_corrected_act).abs().mean(dim=0) / input_wight_mag
+        elif self.util_type == 'feature_by_input':
+            new_util = (features - bias_corrected_act).abs().mean(dim=0) / input_wight_mag
+        elif self.util_type == 'output':
+            new_util = features.mean(dim=0)
+        else:
+            new_util = 0
+        return new_util
 
     def test_features(self, features, criterion):
         """
@@ -146,7 +281,7 @@ class GnT(object):
                 self.accumulated_num_features_to_replace[i][index] -= num_new_features_to_replace
             else:
                 if num_new_features_to_replace < 1:
-                    if torch.rand(1) <= num_new_features_to_replace:
+                    if torch.rand(1, generator=self.generator) <= num_new_features_to_replace:
                         num_new_features_to_replace = 1
                 num_new_features_to_replace = int(num_new_features_to_replace)
     
@@ -156,7 +291,7 @@ class GnT(object):
             """
             Find features to replace in the current layer
             """
-            new_features_to_replace = torch.topk((coef) * self.bias_corrected_util[i][eligible_feature_indices],
+            new_features_to_replace = torch.topk((coef) * self.corrected_utility(i)[eligible_feature_indices],
                                                 num_new_features_to_replace)[1]
             new_features_to_replace = eligible_feature_indices[new_features_to_replace]
             
@@ -199,10 +334,8 @@ class GnT(object):
                     current_layer.bias.clamp_(-10.0, 10.0)
                 else:
                     current_layer.weight.data[features_to_replace[i], :] *= 0.0
-                    # noinspection PyArgumentList
                     current_layer.weight.data[features_to_replace[i], :] += \
-                        torch.empty(num_features_to_replace[i], current_layer.in_features).uniform_(
-                            -self.bounds[i], self.bounds[i]).to(self.device)
+                        self.new_input_weights(layer_idx=i, num_features=num_features_to_replace[i])
                     current_layer.bias.data[features_to_replace[i]] *= 0
                     """
                     # Update bias to correct for the removed features and set the outgoing weights and ages to zero
@@ -213,6 +346,8 @@ class GnT(object):
                     next_layer.weight.data[:, features_to_replace[i]] = 0
                 self.ages[i][features_to_replace[i]] = 0
 
+            if sum(num_features_to_replace) > 0:
+                self.reset_weight_magnitudes()
 
     def update_optim_params(self, features_to_replace, num_features_to_replace):
         """
@@ -227,12 +362,111 @@ class GnT(object):
                 self.opt.state[self.net[i * 2].bias]['exp_avg'][features_to_replace[i]] = 0.0
                 self.opt.state[self.net[i * 2].weight]['exp_avg_sq'][features_to_replace[i], :] = 0.0
                 self.opt.state[self.net[i * 2].bias]['exp_avg_sq'][features_to_replace[i]] = 0.0
-                self.opt.state[self.net[i * 2].weight]['step'][features_to_replace[i], :] = 0
-                self.opt.state[self.net[i * 2].bias]['step'][features_to_replace[i]] = 0
+                self.opt.reset_steps(self.net[i * 2].weight, rows=features_to_replace[i])
+                self.opt.reset_steps(self.net[i * 2].bias, rows=features_to_replace[i])
                 # output weights
                 self.opt.state[self.net[i * 2 + 2].weight]['exp_avg'][:, features_to_replace[i]] = 0.0
                 self.opt.state[self.net[i * 2 + 2].weight]['exp_avg_sq'][:, features_to_replace[i]] = 0.0
-                self.opt.state[self.net[i * 2 + 2].weight]['step'][:, features_to_replace[i]] = 0
+                self.opt.reset_steps(self.net[i * 2 + 2].weight, cols=features_to_replace[i])
+
+    def static_test_features(self, criterion):
+        """
+        Same as test_features, with fixed-shape tensors
+        Returns:
+            Candidate features (k_max[i] per layer), Masks of the candidates that are replaced
+        """
+        features_to_replace, replace_masks = [], []
+        index = 0 if criterion == 'low' else 1
+        coef = -1 if criterion == 'low' else 1
+        accumulated = self.static_accumulated_num_features_to_replace
+
+        for i in range(self.num_hidden_layers):
+            eligible = self.ages[i] > self.maturity_threshold
+            repl_rate = self.repl_rates[i][0] if criterion == 'low' else self.repl_rates[i][1]
+
+            num_new_features_to_replace = repl_rate * eligible.sum(dtype=torch.float64)
+            accumulated[i, index] += num_new_features_to_replace
+
+            if self.accumulate:
+                num_new_features_to_replace = accumulated[i, index].floor()
+                accumulated[i, index] -= num_new_features_to_replace
+            else:
+                # drawn on the host with the generator of the default mode, compared as a cpu scalar without a copy
+                replace_one = (torch.rand(1, generator=self.generator)[0] <= num_new_features_to_replace) \
+                              & (num_new_features_to_replace > 0)
+                num_new_features_to_replace = torch.where(num_new_features_to_replace < 1, replace_one.double(),
+                                                          num_new_features_to_replace).floor()
+
+            new_features_to_replace, replace_mask = bounded_topk(coef * self.corrected_utility(i), eligible,
+                                                                 num_new_features_to_replace, self.k_max[i])
+            masked_index_copy_(self.util[i], 0, new_features_to_replace, replace_mask, 0)
+            masked_index_copy_(self.mean_feature_act[i], 0, new_features_to_replace, replace_mask, 0)
+
+            features_to_replace.append(new_features_to_replace)
+            replace_masks.append(replace_mask)
+
+        return features_to_replace, replace_masks
+
+    def static_gen_new_features(self, features_to_replace, replace_masks, criterion):
+        """
+        Same as gen_new_features, for the candidates and masks of static_test_features
+        """
+        with torch.no_grad():
+            for i in range(self.num_hidden_layers):
+                current_layer = self.net[i * 2]
+                next_layer = self.net[i * 2 + 2]
+                indices, mask = features_to_replace[i], replace_masks[i]
+                if self.util_type == 'output':
+                    current_layer.weight.clamp_(-10.0, 10.0)
+                    current_layer.bias.clamp_(-10.0, 10.0)
+                    coeff = self.coeffs[i][0] if criterion == 'low' else self.coeffs[i][1]
+                    masked_index_copy_(current_layer.weight.data, 0, indices, mask,
+                                       current_layer.weight.data[indices, :] * coeff)
+                    masked_index_copy_(current_layer.bias.data, 0, indices, mask, current_layer.bias.data[indices] * coeff)
+                    current_layer.weight.clamp_(-10.0, 10.0)
+                    current_layer.bias.clamp_(-10.0, 10.0)
+                else:
+                    masked_index_copy_(current_layer.weight.data, 0, indices, mask,
+                                       self.new_input_weights(layer_idx=i, num_features=indices.shape[0]))
+                    masked_index_copy_(current_layer.bias.data, 0, indices, mask, 0)
+                    """
+                    # Update bias to correct for the removed features and set the outgoing weights and ages to zero
+                    """
+                    bias_correction = next_layer.weight.data[:, indices] * self.mean_feature_act[i][indices] / \
+                                      (1 - self.decay_rate ** self.ages[i][indices])
+                    next_layer.bias.data += torch.where(mask, bias_correction, 0).sum(dim=1)
+                    masked_index_copy_(next_layer.weight.data, 1, indices, mask, 0)
+                masked_index_copy_(self.ages[i], 0, indices, mask, 0)
+
+            self.reset_weight_magnitudes()
+
+    def static_update_optim_params(self, features_to_replace, replace_masks):
+        """
+        Same as update_optim_params, for the candidates and masks of static_test_features
+        """
+        if self.opt_type == 'adam':
+            for i in range(self.num_hidden_layers):
+                indices, mask = features_to_replace[i], replace_masks[i]
+                # input weights
+                for p in [self.net[i * 2].weight, self.net[i * 2].bias]:
+                    masked_index_copy_(self.opt.state[p]['exp_avg'], 0, indices, mask, 0)
+                    masked_index_copy_(self.opt.state[p]['exp_avg_sq'], 0, indices, mask, 0)
+                    self.opt.reset_steps(p, rows=indices, mask=mask)
+                # output weights
+                p = self.net[i * 2 + 2].weight
+                masked_index_copy_(self.opt.state[p]['exp_avg'], 1, indices, mask, 0)
+                masked_index_copy_(self.opt.state[p]['exp_avg_sq'], 1, indices, mask, 0)
+                self.opt.reset_steps(p, cols=indices, mask=mask)
+
+    def record_replaced_features(self, features_to_replace, replace_masks=None):
+        """
+        Add the features replaced for one criterion to self.replaced_features
+        """
+        for i in range(self.num_hidden_layers):
+            if replace_masks is not None:
+                self.replaced_features[i].append((features_to_replace[i], replace_masks[i]))
+            elif features_to_replace[i].numel() > 0:
+                self.replaced_features[i].append((features_to_replace[i], None))
 
     def gen_and_test(self, features):
         """
@@ -246,11 +480,22 @@ class GnT(object):
         for i in range(self.num_hidden_layers):
             self.ages[i] += 1
             self.update_utility(layer_idx=i, features=features[i])
+        self.replaced_features = [[] for _ in range(self.num_hidden_layers)]
+
+        if self.static:
+            for criterion in ['low', 'high']:
+                features_to_replace, replace_masks = self.static_test_features(criterion=criterion)
+                self.static_gen_new_features(features_to_replace, replace_masks, criterion=criterion)
+                self.static_update_optim_params(features_to_replace, replace_masks)
+                self.record_replaced_features(features_to_replace, replace_masks)
+            return
 
         features_to_replace, num_features_to_replace = self.test_features(features=features, criterion = 'low')
         self.gen_new_features(features_to_replace, num_features_to_replace, criterion = 'low')
         self.update_optim_params(features_to_replace, num_features_to_replace)
+        self.record_replaced_features(features_to_replace)
 
         features_to_replace, num_features_to_replace = self.test_features(features=features, criterion = 'high')
         self.gen_new_features(features_to_replace, num_features_to_replace, criterion = 'high')
-        self.update_optim_params(features_to_replace, num_features_to_replace)
\ No newline at end of file
+        self.update_optim_params(features_to_replace, num_features_to_replace)
+        self.record_replaced_features(features_to_replace)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import torch
 from math import sqrt
+from lop.utils.init_pool import InitPool
 
 
 class GnTredo(object):
@@ -13,7 +14,8 @@ class GnTredo(object):
             threshold=0.01,
             init='kaiming',
             device="cpu",
-            reset_period=1000
+            reset_period=1000,
+            init_pool_size=0,
     ):
         super(GnTredo, self).__init__()
         self.device = device
@@ -25,6 +27,12 @@ class GnTredo(object):
         # Calculate uniform distribution's bound for random feature initialization
         if hidden_activation == 'selu': init = 'lecun'
         self.bounds = self.compute_bounds(hidden_activation=hidden_activation, init=init)
+        # Pools of pre-generated input weights for new features, one per layer
+        self.init_pools = None
+        if init_pool_size > 0:
+            self.init_pools = [InitPool(row_shape=(self.net[i * 2].in_features,), bound=self.bounds[i],
+                                        pool_size=init_pool_size, device=self.device)
+                               for i in range(self.num_hidden_layers)]
 
     def compute_bounds(self, hidden_activation, init='kaiming'):
         if hidden_activation in ['swish', 'elu']: hidden_activation = 'relu'
@@ -73,9 +81,13 @@ class GnTredo(object):
                 current_layer = self.net[i * 2]
                 next_layer = self.net[i * 2 + 2]
                 current_layer.weight.data[features_to_replace[i], :] *= 0.0
-                current_layer.weight.data[features_to_replace[i], :] += \
-                    torch.empty(num_features_to_replace[i], current_layer.in_features).uniform_(
-                        -self.bounds[i], self.bounds[i]).to(self.device)
+                if self.init_pools is not None:
+                    current_layer.weight.data[features_to_replace[i], :] += \
+                        self.init_pools[i].take(num_features_to_replace[i])
+                else:
+                    current_layer.weight.data[features_to_replace[i], :] += \
+                        torch.empty(num_features_to_replace[i], current_layer.in_features).uniform_(
+                            -self.bounds[i], self.bounds[i]).to(self.device)
                 current_layer.bias.data[features_to_replace[i]] *= 0
 
                 next_layer.weight.data[:, features_to_replace[i]] = 0
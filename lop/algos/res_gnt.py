@@ -4,6 +4,7 @@ from math import sqrt
 import torch
 import sys
 from torch.nn.init import calculate_gain
+from lop.utils.miscellaneous import bounded_topk, masked_index_copy_
 
 
 def get_layer_bound(layer, init, gain):
@@ -28,13 +29,50 @@ def get_layer_std(layer, gain):
         return gain * sqrt(1 / layer.in_features)
 
 
+def channel_magnitudes(features):
+    """
+    Mean magnitude of each feature (channel) of a mini-batch of activations, 1-d inputs are already reduced
+    """
+    if features.dim() == 1:
+        return features
+    if features.dim() == 4:
+        return features.abs().mean(dim=(0, 2, 3))
+    return features.abs().mean(dim=0)
+
+
+class ChannelMagnitudes(object):
+    """
+    Replacement for the feature list passed to the forward pass of the network. Every activation map that is appended
+    is reduced to the mean magnitude of its channels right away, so the maps do not have to be kept until
+    gen_and_test, which only uses these magnitudes
+    """
+    def __init__(self):
+        self.magnitudes = []
+
+    def append(self, features):
+        with torch.no_grad():
+            self.magnitudes.append(channel_magnitudes(features.detach()))
+
+    def pop(self, index=-1):
+        return self.magnitudes.pop(index)
+
+    def __getitem__(self, index):
+        return self.magnitudes[index]
+
+    def __len__(self):
+        return len(self.magnitudes)
+
+
 class ResGnT(object):
     """
     Generate-and-Test algorithm for a simple resnet, assuming only one fully connected layer at the top and that
     there is no pooling at the end
+    The features passed to gen_and_test can be the activation maps of the hidden layers, or a ChannelMagnitudes object
+    (see new_feature_list) that already reduced them
+    With static, the features to replace are selected and reset with fixed-shape tensors, see GnT
     """
     def __init__(self, net, hidden_activation, decay_rate=0.99, replacement_rate=1e-4, util_type='weight',
-                 maturity_threshold=1000, device=torch.device("cpu")):
+                 maturity_threshold=1000, device=torch.device("cpu"), static=False, k_max=None):
         super(ResGnT, self).__init__()
 
         self.net = net
@@ -76,6 +114,25 @@ class ResGnT(object):
         for i in range(self.num_hidden_layers):
             with no_grad():
                 self.num_new_features_to_replace.append(self.replacement_rate * self.weight_layers[i].out_channels)
+        """
+        Bounded number of replacements per layer and accumulated replacement counts for the static mode
+        """
+        self.static = static
+        if k_max is None:
+            k_max = [int(self.num_new_features_to_replace[i]) + 1 for i in range(self.num_hidden_layers)]
+        elif isinstance(k_max, int):
+            k_max = [k_max for _ in range(self.num_hidden_layers)]
+        self.k_max = [min(k_max[i], self.weight_layers[i].out_channels) for i in range(self.num_hidden_layers)]
+        self.static_accumulated_num_features_to_replace = None
+        if self.static:
+            self.static_accumulated_num_features_to_replace = \
+                zeros(self.num_hidden_layers, dtype=torch.float64, device=self.device)
+
+    def new_feature_list(self):
+        """
+        Returns: an empty feature list for the forward pass of the network, that only keeps the channel magnitudes
+        """
+        return ChannelMagnitudes()
 
     def get_weight_layers(self, nn_module: torch.nn.Module):
         if isinstance(nn_module, Conv2d) or isinstance(nn_module, Linear):
@@ -114,10 +171,7 @@ class ResGnT(object):
             Update feature stats
             """
             with torch.no_grad():
-                if features[i].size().__len__() == 2:
-                    self.mean_feature_mag[i] += (1 - self.decay_rate) * features[i].abs().mean(dim=0)
-                elif features[i].size().__len__() == 4:
-                    self.mean_feature_mag[i] += (1 - self.decay_rate) * features[i].abs().mean(dim=(0, 2, 3))
+                self.mean_feature_mag[i] += (1 - self.decay_rate) * channel_magnitudes(features[i])
             """
             Find the no. of features to replace
             """
@@ -195,13 +249,96 @@ class ResGnT(object):
                 self.bn_layers[i].running_var[features_to_replace[i]] *= 0.0
                 self.bn_layers[i].running_var[features_to_replace[i]] += 1.0
 
+    def static_test_features(self, features):
+        """
+        Same as test_features, with fixed-shape tensors
+        Returns:
+            Candidate features (k_max[i] per layer), Masks of the candidates that are replaced
+        """
+        features_to_replace, replace_masks = [], []
+        accumulated = self.static_accumulated_num_features_to_replace
+
+        for i in range(self.num_hidden_layers):
+            self.ages[i] += 1
+            """
+            Update feature stats
+            """
+            with torch.no_grad():
+                self.mean_feature_mag[i] += (1 - self.decay_rate) * channel_magnitudes(features[i])
+            """
+            Find the no. of features to replace, nothing is accumulated while no feature is eligible
+            """
+            eligible = self.ages[i] > self.maturity_threshold
+            accumulated[i] += self.num_new_features_to_replace[i] * eligible.any().double()
+            num_new_features_to_replace = accumulated[i].floor()
+            accumulated[i] -= num_new_features_to_replace
+
+            """
+            Calculate utility, it only depends on the current weights and feature stats
+            """
+            with torch.no_grad():
+                next_layer = self.weight_layers[i + 1]
+                if isinstance(next_layer, Linear):
+                    output_wight_mag = next_layer.weight.data.abs().mean(dim=0)
+                elif isinstance(next_layer, Conv2d):
+                    output_wight_mag = next_layer.weight.data.abs().mean(dim=(0, 2, 3))
+
+                if self.util_type == 'weight':
+                    self.util[i] = output_wight_mag
+                elif self.util_type in ['contribution']:
+                    self.util[i] = output_wight_mag * self.mean_feature_mag[i]
+
+            new_features_to_replace, mask = bounded_topk(-self.util[i], eligible, num_new_features_to_replace,
+                                                         self.k_max[i])
+            """
+            Initialize utility for new features
+            """
+            masked_index_copy_(self.util[i], 0, new_features_to_replace, mask, 0)
+
+            features_to_replace.append(new_features_to_replace)
+            replace_masks.append(mask)
+
+        return features_to_replace, replace_masks
+
+    def static_gen_new_features(self, features_to_replace, replace_masks):
+        """
+        Same as gen_new_features, for the candidates and masks of static_test_features
+        """
+        with torch.no_grad():
+            for i in range(self.num_hidden_layers):
+                current_layer, next_layer = self.weight_layers[i], self.weight_layers[i+1]
+                indices, mask = features_to_replace[i], replace_masks[i]
+
+                new_weights = empty([indices.shape[0]] + list(current_layer.weight.shape[1:]),
+                                    device=self.device).normal_(std=self.stds[i])
+                masked_index_copy_(current_layer.weight.data, 0, indices, mask, new_weights)
+                masked_index_copy_(current_layer.bias.data, 0, indices, mask, 0)
+                """
+                Set the outgoing weights and ages to zero
+                """
+                masked_index_copy_(next_layer.weight.data, 1, indices, mask, 0)
+                masked_index_copy_(self.ages[i], 0, indices, mask, 0)
+                """
+                Reset the corresponding batchnorm layers
+                """
+                masked_index_copy_(self.bn_layers[i].bias.data, 0, indices, mask, 0)
+                masked_index_copy_(self.bn_layers[i].weight.data, 0, indices, mask, 1)
+                masked_index_copy_(self.bn_layers[i].running_mean, 0, indices, mask, 0)
+                masked_index_copy_(self.bn_layers[i].running_var, 0, indices, mask, 1)
+
     def gen_and_test(self, features):
         """
         Perform generate-and-test
         :param features: activation of hidden units in the neural network
         """
-        if not isinstance(features, list):
+        if not isinstance(features, (list, ChannelMagnitudes)):
             print('features passed to generate-and-test should be a list')
             sys.exit()
+        if self.static:
+            if self.replacement_rate == 0:
+                return
+            features_to_replace, replace_masks = self.static_test_features(features=features)
+            self.static_gen_new_features(features_to_replace, replace_masks)
+            return
         features_to_replace, num_features_to_replace = self.test_features(features=features)
         self.gen_new_features(features_to_replace, num_features_to_replace)
\ No newline at end of file
@@ -2,11 +2,18 @@ import torch
 
 
 class Agent(object):
-    def __init__(self, pol, learner, device='cpu', to_log_features=False):
+    def __init__(self, pol, learner, device='cpu', to_log_features=False, store_dist=True):
         self.pol = pol
         self.learner = learner
         self.device = device
         self.to_log_features = to_log_features
+        # the parameters of the distribution are only needed if the buffer stores them
+        self.store_dist = store_dist
+
+    def dist_params(self, dist):
+        if not self.store_dist:
+            return None
+        return self.pol.dist_params(dist)
 
     def get_action(self, o):
         """
@@ -14,13 +21,29 @@ class Agent(object):
         :return: a two tuple
         - np.array of shape (1,)
         - np.array of shape (1,)
+        The distribution is returned as the np.array of its parameters, see Policy.dist_params, or None without
+        store_dist
         """
         action, lprob, dist = self.pol.action(torch.tensor(o, dtype=torch.float32, device=self.device).unsqueeze(0),
                                               to_log_features=self.to_log_features)
         features = None
         if self.to_log_features:
             features = self.pol.get_activations()
-        return action[0].cpu().numpy(), lprob.cpu().numpy(), self.pol.dist_to(dist, to_device='cpu'), features
+        return action[0].cpu().numpy(), lprob.cpu().numpy(), self.dist_params(dist), features
+
+    def get_actions(self, os):
+        """
+        Same as get_action for the observations of all environments of a vector env, in one forward pass
+        :param os: np.array of shape (num_envs, o_dim)
+        :return: actions of shape (num_envs, a_dim), log probabilities of shape (num_envs, 1), distribution parameters
+        of shape (num_envs, 2 * a_dim) and the features
+        """
+        action, lprob, dist = self.pol.action(torch.as_tensor(os, dtype=torch.float32, device=self.device),
+                                              to_log_features=self.to_log_features)
+        features = None
+        if self.to_log_features:
+            features = self.pol.get_activations()
+        return action.cpu().numpy(), lprob.cpu().numpy(), self.dist_params(dist), features
 
     def log_update(self, o, a, r, op, logp, dist, done):
         return self.learner.log_update(o, a, r, op, logp, dist, done)
@@ -1,52 +1,114 @@
 import numpy as np
-import collections as c
 
 import torch
 
 
 class Buffer(object):
-    def __init__(self, o_dim, a_dim, bs, device='cpu'):
+    """
+    Rollout buffer backed by preallocated float32 arrays. The stored transitions are rows start to start + size of the
+    arrays, pop and clear only move these cursors, and get returns torch.from_numpy views of the first bs of them.
+    The arrays start with room for bs transitions and double when more are needed, e.g. with episodic updates.
+    The behaviour distributions are stored as rows of parameters (see Policy.dist_params), or not at all without
+    store_dist, and get only builds a distribution object from them when it is given a dist_stack function.
+    With num_envs > 1, every row holds one transition of each environment of a vector env, the arrays have shape
+    (rows, num_envs, dim), and bs counts transitions, so a rollout is bs // num_envs rows.
+    """
+    def __init__(self, o_dim, a_dim, bs, device='cpu', store_dist=True, num_envs=1):
+        if bs % num_envs != 0:
+            raise ValueError(f'bs={bs} is not a multiple of num_envs={num_envs}')
         self.o_dim = o_dim
         self.a_dim = a_dim
         self.bs = bs
         self.device = device
-        self.o_buf, self.a_buf, self.r_buf, self.logpb_buf, self.distb_buf, self.done_buf = \
-            c.deque(), c.deque(), c.deque(), c.deque(), c.deque(), c.deque()
-        self.op = np.zeros((1, o_dim), dtype=np.float32)
+        self.store_dist = store_dist
+        self.num_envs = num_envs
+        self.env_shape = () if num_envs == 1 else (num_envs,)
+        self.capacity = bs // num_envs
+        self.start, self.size = 0, 0
+        self.o_buf = np.zeros((self.capacity,) + self.env_shape + (o_dim,), dtype=np.float32)
+        self.a_buf = np.zeros((self.capacity,) + self.env_shape + (a_dim,), dtype=np.float32)
+        self.r_buf = np.zeros((self.capacity,) + self.env_shape + (1,), dtype=np.float32)
+        self.logpb_buf = np.zeros((self.capacity,) + self.env_shape + (1,), dtype=np.float32)
+        self.done_buf = np.zeros((self.capacity,) + self.env_shape + (1,), dtype=np.float32)
+        self.distb_buf = np.zeros((self.capacity if store_dist else 0,) + self.env_shape + (2 * a_dim,),
+                                  dtype=np.float32)
+        self.op = np.zeros((num_envs, o_dim), dtype=np.float32)
+
+    def __len__(self):
+        return self.size * self.num_envs
+
+    def arrays(self):
+        if self.store_dist:
+            return ['o_buf', 'a_buf', 'r_buf', 'logpb_buf', 'distb_buf', 'done_buf']
+        return ['o_buf', 'a_buf', 'r_buf', 'logpb_buf', 'done_buf']
+
+    def make_room(self):
+        """
+        Make sure that row start + size is free, by moving the stored transitions to the front or growing the arrays
+        """
+        if self.start + self.size < self.capacity:
+            return
+        if self.start > 0:
+            for name in self.arrays():
+                array = getattr(self, name)
+                array[:self.size] = array[self.start: self.start + self.size]
+        else:
+            self.capacity *= 2
+            for name in self.arrays():
+                array = getattr(self, name)
+                new_array = np.zeros((self.capacity,) + array.shape[1:], dtype=array.dtype)
+                new_array[:self.size] = array[:self.size]
+                setattr(self, name, new_array)
+        self.start = 0
 
     def store(self, o, a, r, op, logpb, dist, done):
-        self.o_buf.append(o)
-        self.a_buf.append(a)
-        self.r_buf.append(r)
-        self.logpb_buf.append(logpb)
-        self.distb_buf.append(dist)
-        self.done_buf.append(float(done))
+        self.make_room()
+        idx = self.start + self.size
+        self.o_buf[idx] = np.reshape(o, self.env_shape + (self.o_dim,))
+        self.a_buf[idx] = np.reshape(a, self.env_shape + (self.a_dim,))
+        self.r_buf[idx] = np.reshape(r, self.env_shape + (1,))
+        self.logpb_buf[idx] = np.reshape(logpb, self.env_shape + (1,))
+        if self.store_dist:
+            self.distb_buf[idx] = np.reshape(dist, self.env_shape + (2 * self.a_dim,))
+        self.done_buf[idx] = np.reshape(done, self.env_shape + (1,))
+        self.size += 1
         self.op[:] = op
 
     def pop(self):
-        self.o_buf.popleft()
-        self.a_buf.popleft()
-        self.r_buf.popleft()
-        self.logpb_buf.popleft()
-        self.distb_buf.popleft()
-        self.done_buf.popleft()
+        self.start += 1
+        self.size -= 1
 
     def clear(self):
-        self.o_buf.clear()
-        self.a_buf.clear()
-        self.r_buf.clear()
-        self.logpb_buf.clear()
-        self.distb_buf.clear()
-        self.done_buf.clear()
-
-    def get(self, dist_stack):
-        rang = range(self.bs)
-        os = torch.as_tensor(np.array([self.o_buf[i] for i in rang]), dtype=torch.float32, device=self.device).view(-1, self.o_dim)
-        acts = torch.as_tensor(np.array([self.a_buf[i] for i in rang]), dtype=torch.float32, device=self.device).view(-1, self.a_dim)
-        rs = torch.as_tensor(np.array([self.r_buf[i] for i in rang]), dtype=torch.float32, device=self.device).view(-1, 1)
+        self.start, self.size = 0, 0
+
+    def rollout(self):
+        """
+        The stored transitions as a dict of arrays, e.g. to send them to another process
+        """
+        rollout = {name: getattr(self, name)[self.start: self.start + self.size].copy() for name in self.arrays()}
+        rollout['op'] = self.op.copy()
+        return rollout
+
+    def load(self, rollout):
+        """
+        Replace the stored transitions by a rollout returned by Buffer.rollout
+        """
+        for name in self.arrays():
+            setattr(self, name, rollout[name])
+        self.op[:] = rollout['op']
+        self.start, self.size = 0, len(rollout['o_buf'])
+        self.capacity = self.size
+
+    def get(self, dist_stack=None):
+        rang = slice(self.start, self.start + self.bs // self.num_envs)
+        os = torch.from_numpy(self.o_buf[rang]).to(self.device)
+        acts = torch.from_numpy(self.a_buf[rang]).to(self.device)
+        rs = torch.from_numpy(self.r_buf[rang]).to(self.device)
         op = torch.as_tensor(self.op, device=self.device).view(-1, self.o_dim)
-        logpbs = torch.as_tensor(np.array([self.logpb_buf[i] for i in rang]), dtype=torch.float32, device=self.device).view(-1, 1)
-        distbs = dist_stack([self.distb_buf[i] for i in rang], device=self.device)
-        dones = torch.as_tensor(np.array([self.done_buf[i] for i in rang]), dtype=torch.float32, device=self.device).view(-1, 1)
+        logpbs = torch.from_numpy(self.logpb_buf[rang]).to(self.device)
+        distbs = None
+        if self.store_dist and dist_stack is not None:
+            distbs = dist_stack(torch.from_numpy(self.distb_buf[rang]), device=self.device)
+        dones = torch.from_numpy(self.done_buf[rang]).to(self.device)
 
-        return os, acts, rs, op, logpbs, distbs, dones
\ No newline at end of file
+        return os, acts, rs, op, logpbs, distbs, dones
@@ -0,0 +1,104 @@
+import copy
+import numpy as np
+
+import torch
+
+from lop.algos.rl.agent import Agent
+from lop.algos.rl.buffer import Buffer
+
+
+class PolicySnapshot(object):
+    """
+    Copy of the policy in shared memory, together with the number of updates it reflects (its version).
+    The learner publishes the policy after every update, and an actor loads the snapshot into its own copy of the
+    policy at the start of every rollout, so the policy stays frozen while the rollout is collected.
+    updates is released once per update, run_actor acquires it to wait for the updates it may not run ahead of
+    """
+    def __init__(self, pol, ctx):
+        self.pol = copy.deepcopy(pol).cpu()
+        self.pol.device = 'cpu'
+        self.pol.share_memory()
+        self.version = ctx.Value('i', 0)
+        self.lock = ctx.Lock()
+        self.updates = ctx.Semaphore(0)
+
+    def publish(self, pol):
+        with self.lock:
+            for shared_param, param in zip(self.pol.state_dict().values(), pol.state_dict().values()):
+                shared_param.copy_(param)
+            self.version.value += 1
+        self.updates.release()
+
+    def load(self, pol):
+        """
+        Copy the snapshot into pol
+        :return: the version of the snapshot
+        """
+        with self.lock:
+            pol.load_state_dict(self.pol.state_dict())
+            return self.version.value
+
+
+def run_actor(env_fn, snapshot, rollouts, bs, u_epi_up=False, store_dist=False, start_step=0, n_steps=0,
+              schedule_states=None, log_steps=False):
+    """
+    Actor process of the pipelined mode of run_ppo. Collects rollouts from the vector env returned by env_fn with the
+    policy snapshot and puts them in the rollouts queue, while the learner updates the policy on the previous rollout.
+    Rollout i is collected with a policy of version i - 1 or later, the learner uses it for update i, so the policy that
+    collected a rollout is at most one update behind the learner.
+    A rollout is a dict with the transitions (see Buffer.rollout, None for the last, incomplete rollout), the returns and
+    termination steps of the episodes that ended in it, the step after it and the version of the policy that collected
+    it. With schedule_states, the environments are FrictionSchedules that start from these states, and every rollout
+    also has the states of their schedules after it. With log_steps, every rollout also has the actions of all its steps,
+    (steps, num_envs, a_dim), and the features of the policy for them, one (steps, num_envs, h_dim) array per layer, for
+    the logs of run_ppo. None is put in the queue after the last rollout.
+    """
+    # the policy is small, and the threads of the learner are shared with it
+    torch.set_num_threads(1)
+    env = env_fn()
+    if schedule_states is not None:
+        env.set_attr('schedule_state', schedule_states)
+    num_envs = env.num_envs
+    o_dim, a_dim = env.single_observation_space.shape[0], env.single_action_space.shape[0]
+    pol = copy.deepcopy(snapshot.pol)
+    agent = Agent(pol, learner=None, to_log_features=log_steps, store_dist=store_dist)
+    buf = Buffer(o_dim, a_dim, bs, store_dist=store_dist, num_envs=num_envs)
+
+    rets_per_env = np.zeros(num_envs)
+    o = env.reset()
+    step = start_step
+    rollout_idx = 0
+    while step < n_steps:
+        if rollout_idx >= 2:
+            snapshot.updates.acquire()
+        version = snapshot.load(pol)
+        rets, termination_steps = [], []
+        actions, features = [], []
+        buf.clear()
+        while step < n_steps:
+            a, logp, dist, new_features = agent.get_actions(o)
+            if log_steps:
+                actions.append(a)
+                features.append([f.cpu().numpy() for f in new_features])
+            op, r, done, infos = env.step(a)
+            buf.store(o, a, r, op, logp, dist, done)
+            o = op
+            rets_per_env += r
+            for env_idx in np.flatnonzero(done):
+                rets.append(rets_per_env[env_idx])
+                termination_steps.append(step + env_idx)
+                rets_per_env[env_idx] = 0
+            step += num_envs
+            if (not u_epi_up or np.any(done)) and len(buf) >= buf.bs:
+                break
+        transitions = buf.rollout() if len(buf) >= buf.bs else None
+        rollout = {'transitions': transitions, 'rets': rets, 'termination_steps': termination_steps, 'step': step,
+                   'version': version,
+                   'schedule_states': None if schedule_states is None else list(env.get_attr('schedule_state'))}
+        if log_steps:
+            rollout['actions'] = np.stack(actions)
+            rollout['features'] = [np.stack(layer_features) for layer_features in zip(*features)]
+        rollouts.put(rollout)
+        rollout_idx += 1
+    rollouts.put(None)
+    env.close()
@@ -7,6 +7,53 @@ from lop.algos.rl.learner import Learner
 import torch.nn.functional as F
 
 
+def gae_advantages(rs, dones, vals, g, lm, block_size=64):
+    """
+    Vectorized GAE, the same recursion as
+        advs[t] = rs[t] + (1 - dones[t]) * g * vals[t + 1] - vals[t] + (1 - dones[t]) * g * lm * advs[t + 1]
+    with advs[T] = 0. The rollout is split into blocks of block_size steps. Inside a block,
+    advs[t] = sum_k (g * lm)^(k - t) * deltas[k] over the steps k >= t that come before the first done at or after t,
+    which is one batched matrix product for all blocks; only the carry from one block to the previous one is sequential.
+    :param rs: rewards, of shape (T,) or (T, E) for E environments
+    :param dones: episode ends, same shape as rs
+    :param vals: values, of shape (T + 1,) or (T + 1, E), the last row is the value of the observation after the rollout
+    :return: advantages, same shape as rs
+    """
+    squeeze = rs.dim() == 1
+    if squeeze:
+        rs, dones, vals = rs.unsqueeze(-1), dones.unsqueeze(-1), vals.unsqueeze(-1)
+    num_steps, num_envs = rs.shape
+    not_dones = 1 - dones
+    deltas = rs + not_dones * g * vals[1:] - vals[:-1]
+
+    num_blocks = (num_steps + block_size - 1) // block_size
+    padding = num_blocks * block_size - num_steps
+    deltas = F.pad(deltas, (0, 0, 0, padding)).view(num_blocks, block_size, num_envs)
+    dones = F.pad(dones, (0, 0, 0, padding)).view(num_blocks, block_size, num_envs)
+
+    # number of dones before each step of a block, and in the whole block
+    done_counts = dones.cumsum(dim=1)
+    block_done_counts = done_counts[:, -1:]
+    done_counts = done_counts - dones
+    # discounts[t, k] = (g * lm)^(k - t) for k >= t, the steps between t and k must belong to the same episode
+    steps = torch.arange(block_size, device=rs.device)
+    gaps = steps.view(1, -1) - steps.view(-1, 1)
+    discounts = torch.where(gaps >= 0, (g * lm) ** gaps.clamp(min=0).to(rs.dtype), torch.zeros((), dtype=rs.dtype,
+                                                                                                  device=rs.device))
+    same_episode = done_counts.unsqueeze(2) == done_counts.unsqueeze(1)
+    advs = torch.einsum('ntke,nke->nte', discounts.view(1, block_size, block_size, 1) * same_episode, deltas)
+
+    # carry the advantage of the first step of each block to the steps of the previous block
+    carry_discounts = (g * lm) ** (block_size - steps).to(rs.dtype).view(1, -1, 1) * (done_counts == block_done_counts)
+    for n in reversed(range(num_blocks - 1)):
+        advs[n] += carry_discounts[n] * advs[n + 1, 0]
+
+    advs = advs.view(-1, num_envs)[:num_steps]
+    if squeeze:
+        advs = advs.squeeze(-1)
+    return advs
+
+
 class PPO(Learner):
     """
     Implementation of PPO
@@ -80,7 +127,7 @@ class PPO(Learner):
         self.buf.store(o, a, r, op, logpb, dist, done)
 
     def learn_time(self, done):
-        return (not self.u_epi_up or done) and len(self.buf.o_buf) >= self.buf.bs
+        return (not self.u_epi_up or np.any(done)) and len(self.buf) >= self.buf.bs
 
     def post_learn(self):
         self.buf.clear()
@@ -92,24 +139,32 @@ class PPO(Learner):
                 net[i * 2].weight += torch.empty(net[i * 2].weight.shape, device=device).normal_(mean=0, std=self.perturb_scale)
 
     def get_rets_advs(self, rs, dones, vals, device='cpu'):
-        dones, rs, vals = dones.to(device), rs.to(device), vals.to(device)
-        advs = torch.as_tensor(np.zeros(len(rs)+1, dtype=np.float32), device=device)
-        for t in reversed(range(len(rs))):
-            delta = rs[t] + (1-dones[t])*self.g*vals[t+1] - vals[t]
-            advs[t] = delta + (1-dones[t])*self.g*self.lm*advs[t+1]
-        v_rets = advs[:-1] + vals[:-1]
-        advs = advs[:-1].view(-1, 1)
+        """
+        vals has shape (T + 1,), or (T + 1, num_envs) for a rollout of a vector env, rs and dones are reshaped to match.
+        The returns and advantages are flattened to shape (T * num_envs, 1) in time-major order
+        """
+        vals = vals.to(device)
+        rs = rs.to(device).reshape((vals.shape[0] - 1,) + vals.shape[1:])
+        dones = dones.to(device).reshape((vals.shape[0] - 1,) + vals.shape[1:])
+        advs = gae_advantages(rs, dones, vals, g=self.g, lm=self.lm)
+        v_rets = advs + vals[:-1]
+        advs = advs.reshape(-1, 1)
         if self.u_adv_scl:
             advs = advs - advs.mean()
             if advs.std() != 0 and not torch.isnan(advs.std()): advs /= advs.std()
         v_rets, advs = v_rets.detach().to(self.device), advs.detach().to(self.device)
-        return v_rets.view(-1, 1), advs
+        return v_rets.reshape(-1, 1), advs
 
     def learn(self):
-        os, acts, rs, op, logpbs, _, dones = self.buf.get(self.pol.dist_stack)
+        os, acts, rs, op, logpbs, _, dones = self.buf.get()
+        # a rollout of a vector env is stored as (steps, envs), the values are computed for all steps at once
+        os, acts, logpbs = os.reshape(-1, os.shape[-1]), acts.reshape(-1, acts.shape[-1]), logpbs.reshape(-1, 1)
         with torch.no_grad():
             pre_vals = self.vf.value(torch.cat((os, op)))
-        v_rets, advs = self.get_rets_advs(rs, dones, pre_vals.t()[0])
+        vals = pre_vals.t()[0]
+        if self.buf.num_envs > 1:
+            vals = vals.view(-1, self.buf.num_envs)
+        v_rets, advs = self.get_rets_advs(rs, dones, vals)
         inds = np.arange(os.shape[0])
         mini_bs = self.buf.bs // self.n_slices
         iter_num = -1
@@ -1,4 +1,5 @@
 from lop.envs.slippery_ant import SlipperyAntEnv, SlipperyAntEnv3
+from lop.envs.friction_schedule import FrictionSchedule
 
 
 from gym.envs.registration import (
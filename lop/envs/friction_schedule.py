@@ -0,0 +1,57 @@
+import gym
+
+
+class FrictionSchedule(gym.Wrapper):
+    """
+    SlipperyAnt environment that moves to the next friction in frictions at the first reset after more than
+    change_time steps with the current one. A change counts from the step of the transition that ended the episode, so a
+    single environment follows the same schedule as before run_ppo used vector envs.
+    Each copy of the environment in a vector env needs its own xml_file. steps_per_env_step is the number of
+    experiment steps that one step of this environment stands for, the number of environments in the vector env.
+    """
+    def __init__(self, env_name, frictions, xml_file, change_time, steps_per_env_step=1):
+        self.env_name = env_name
+        self.frictions = frictions
+        self.xml_file = xml_file
+        self.change_time = change_time
+        self.steps_per_env_step = steps_per_env_step
+        self.friction_number = 0
+        self.steps = 0
+        self.previous_change_time = 0
+        super().__init__(gym.make(env_name, friction=frictions[0], xml_file=xml_file))
+
+    @property
+    def friction(self):
+        return self.frictions[self.friction_number]
+
+    @property
+    def schedule_state(self):
+        """
+        State of the schedule, to save it in a checkpoint. friction is only informative and is not restored
+        """
+        return {'friction_number': self.friction_number, 'steps': self.steps,
+                'previous_change_time': self.previous_change_time, 'friction': self.friction}
+
+    @schedule_state.setter
+    def schedule_state(self, state):
+        self.steps = state['steps']
+        self.previous_change_time = state['previous_change_time']
+        if state['friction_number'] != self.friction_number:
+            self.friction_number = state['friction_number']
+            self.env.close()
+            self.env = gym.make(self.env_name, friction=self.friction, xml_file=self.xml_file)
+
+    def step(self, action):
+        self.steps += self.steps_per_env_step
+        return self.env.step(action)
+
+    def reset(self, **kwargs):
+        # the step of the last transition, negative at the first reset
+        step = self.steps - self.steps_per_env_step
+        if step - self.previous_change_time > self.change_time:
+            self.previous_change_time = step
+            self.friction_number += 1
+            print(f'{step}: change friction to {self.friction:.6f}')
+            self.env.close()
+            self.env = gym.make(self.env_name, friction=self.friction, xml_file=self.xml_file)
+        return self.env.reset(**kwargs)
@@ -60,6 +60,7 @@ def repeat_expr(params: {}):
     perturb_scale = 0
     momentum = 0
     net_type = 1
+    use_hooks = True
     if 'replacement_rate' in params.keys(): replacement_rate = params['replacement_rate']
     if 'decay_rate' in params.keys(): decay_rate = params['decay_rate']
     if 'util_type' in params.keys(): util_type = params['util_type']
@@ -76,12 +77,13 @@ def repeat_expr(params: {}):
     if 'perturb_scale' in params.keys():    perturb_scale = params['perturb_scale']
     if 'momentum' in params.keys(): momentum = params['momentum']
     if 'net_type' in params.keys(): net_type = params['net_type']
+    if 'use_hooks' in params.keys(): use_hooks = params['use_hooks']
     num_epochs = num_showings
 
     classes_per_task = num_classes
     net = ConvNet()
     if net_type == 2:
-        net = ConvNet2(replacement_rate=replacement_rate, maturity_threshold=maturity_threshold)
+        net = ConvNet2(replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, use_hooks=use_hooks)
     if agent_type == 'linear':
         net = MyLinear( 
             input_size=3072, num_outputs=classes_per_task
@@ -385,7 +385,7 @@ class IncrementalCIFARExperiment(Experiment):
                 for param in self.net.parameters(): param.grad = None   # apparently faster than optim.zero_grad()
 
                 # compute prediction and loss
-                current_features = [] if self.use_cbp else None
+                current_features = self.resgnt.new_feature_list() if self.use_cbp else None
                 predictions = self.net.forward(image, current_features)[:, self.all_classes[:self.current_num_classes]]
                 current_reg_loss = self.loss(predictions, label)
                 current_loss = current_reg_loss.detach().clone()
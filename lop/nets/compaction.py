@@ -0,0 +1,131 @@
+import torch
+import torch.nn.functional as F
+from lop.utils.miscellaneous import masked_index_copy_
+
+
+class ActiveUnitCompaction(object):
+    """
+    Runs a stack of linear layers with ReLU hidden units on the live units only, with the same outputs and gradients as
+    the dense computation, up to the rounding of the smaller matrix multiplications.
+    A hidden unit whose activation has been exactly zero for every example of the last `window` steps is considered
+    dead, and the set of dead units is updated every `period` steps. Live units are computed with the rows of their
+    input weights and the columns of the live units of the layer below, and dead units get a zero activation and a zero
+    gradient, which is what the dense computation gives them as long as their pre-activations are not positive.
+    This is checked at every step, before the weights of the live units are gathered: the pre-activations of the dead
+    units are computed without gradients, and if any of them is positive the unit is revived and the step uses the
+    dense computation.
+    The parameters and the optimizer are not compacted: the weights of the live units are gathered in every step, and
+    the optimizer still updates the full weight matrices, with zero gradients for the dead units.
+    """
+    def __init__(self, layers, window=1000, period=100, min_dead_fraction=0.1):
+        """
+        :param layers: list of nn.Linear layers, every layer but the last one is followed by a ReLU
+        :param window: number of steps without activity after which a unit is dead
+        :param period: number of steps between updates of the set of dead units
+        :param min_dead_fraction: the dense computation is used in layers with fewer dead units than this
+        """
+        self.layers = layers
+        self.num_hidden_layers = len(layers) - 1
+        self.window = window
+        self.period = period
+        self.min_dead_fraction = min_dead_fraction
+        self.steps = 0
+        self.silent_steps = [torch.zeros(layer.out_features, device=layer.weight.device) for layer in layers[:-1]]
+        self.live_units = [None for _ in range(self.num_hidden_layers)]
+        self.dead_units = [None for _ in range(self.num_hidden_layers)]
+
+    def update_dead_units(self, layer_idx=None):
+        layer_indices = range(self.num_hidden_layers) if layer_idx is None else [layer_idx]
+        for i in layer_indices:
+            dead = self.silent_steps[i] >= self.window
+            if dead.float().mean() < self.min_dead_fraction:
+                self.live_units[i], self.dead_units[i] = None, None
+            else:
+                self.live_units[i] = torch.where(~dead)[0]
+                self.dead_units[i] = torch.where(dead)[0]
+
+    def revive(self, layer_idx, units, mask=None):
+        """
+        Restart the count of silent steps of units of a hidden layer, e.g. after generate-and-test reinitialized them.
+        The set of dead units is only updated at the next period, until then the units are checked at every step
+        :param mask: only the units where mask is True, without reading it on the host
+        """
+        if mask is not None:
+            masked_index_copy_(self.silent_steps[layer_idx], 0, units, mask, 0)
+        elif units.numel() > 0:
+            self.silent_steps[layer_idx][units] = 0
+
+    def forward(self, x):
+        """
+        :param x: input of the first layer
+        :return: output of the last layer, list of the (full width) activations of the hidden layers
+        """
+        if self.silent_steps[0].device != x.device:
+            self.silent_steps = [silent_steps.to(x.device) for silent_steps in self.silent_steps]
+            self.update_dead_units()
+        self.steps += 1
+        if self.steps % self.period == 0:
+            self.update_dead_units()
+
+        result = None
+        if any(live_units is not None for live_units in self.live_units):
+            result = self.compact_forward(x)
+        if result is None:
+            result = self.dense_forward(x)
+
+        with torch.no_grad():
+            for i, features in enumerate(result[1]):
+                silent = (features.reshape(-1, features.shape[-1]) == 0).all(dim=0)
+                self.silent_steps[i].add_(1).mul_(silent)
+        return result
+
+    def dense_forward(self, x):
+        features = []
+        for layer in self.layers[:-1]:
+            x = F.relu(layer(x))
+            features.append(x)
+        return self.layers[-1](x), features
+
+    def compact_forward(self, x):
+        """
+        The pre-activations of the dead units are computed without gradients first, and None is returned if one of them
+        is positive, the dense forward pass has to be used for this step
+        """
+        features = []
+        input_units = None
+        for i, layer in enumerate(self.layers[:-1]):
+            live_units, dead_units = self.live_units[i], self.dead_units[i]
+            if live_units is None:
+                x = F.relu(F.linear(x, sub_weight(layer.weight, None, input_units), layer.bias))
+                features.append(x)
+                input_units = None
+                continue
+
+            with torch.no_grad():
+                dead_pre_activation = F.linear(x, sub_weight(layer.weight, dead_units, input_units),
+                                               layer.bias.index_select(0, dead_units))
+                reactivated = (dead_pre_activation > 0).reshape(-1, dead_units.shape[0]).any(dim=0)
+                if reactivated.any():
+                    self.revive(i, dead_units[reactivated])
+                    self.update_dead_units(layer_idx=i)
+                    return None
+
+            x = F.relu(F.linear(x, sub_weight(layer.weight, live_units, input_units),
+                                layer.bias.index_select(0, live_units)))
+            features.append(x.new_zeros(x.shape[:-1] + (layer.out_features,)).index_copy(-1, live_units, x))
+            input_units = live_units
+
+        return F.linear(x, sub_weight(self.layers[-1].weight, None, input_units), self.layers[-1].bias), features
+
+
+def sub_weight(weight, rows, cols):
+    """
+    The rows and columns of a weight matrix, all of them if None, gathered in a single copy of the submatrix
+    """
+    if rows is None and cols is None:
+        return weight
+    if rows is None:
+        return weight.index_select(1, cols)
+    if cols is None:
+        return weight.index_select(0, rows)
+    return weight[rows.unsqueeze(1), cols]
@@ -1,10 +1,13 @@
 import torch.nn as nn
+from lop.nets.compaction import ActiveUnitCompaction
 
 
 class ConvNet(nn.Module):
-    def __init__(self, num_classes=2):
+    def __init__(self, num_classes=2, compact_dead_units=False, compaction_window=1000, compaction_period=100):
         """
         Convolutional Neural Network with 3 convolutional layers followed by 3 fully connected layers
+        With compact_dead_units, the fully connected layers leave out the units that were not active for
+        compaction_window steps, see lop.nets.compaction
         """
         super().__init__()
         self.conv1 = nn.Conv2d(3, 32, 5)
@@ -33,11 +36,19 @@ class ConvNet(nn.Module):
 
         self.act_type = 'relu'
 
+        self.compaction = None
+        if compact_dead_units:
+            self.compaction = ActiveUnitCompaction([self.fc1, self.fc2, self.fc3], window=compaction_window,
+                                                   period=compaction_period)
+
     def predict(self, x):
         x1 = self.pool(self.layers[1](self.layers[0](x)))
         x2 = self.pool(self.layers[3](self.layers[2](x1)))
         x3 = self.pool(self.layers[5](self.layers[4](x2)))
         x3 = x3.view(-1, self.num_conv_outputs)
+        if self.compaction is not None:
+            x6, [x4, x5] = self.compaction.forward(x3)
+            return x6, [x1, x2, x3, x4, x5]
         x4 = self.layers[7](self.layers[6](x3))
         x5 = self.layers[9](self.layers[8](x4))
         x6 = self.layers[10](x5)
@@ -4,10 +4,13 @@ from lop.algos.cbp_conv import CBPConv
 
 
 class ConvNet2(nn.Module):
-    def __init__(self, num_classes=10, replacement_rate=0, init='default', maturity_threshold=100):
+    def __init__(self, num_classes=10, replacement_rate=0, init='default', maturity_threshold=100, init_pool_size=0,
+                 use_hooks=True):
 
         """
         Same as ConvNet, but using CBP-layers
+        With use_hooks=False, the CBP-layers do not use backward hooks, and cbp_step has to be called after the
+        backward pass of every training step
         """
         super().__init__()
         self.conv1 = nn.Conv2d(3, 32, 5)
@@ -24,11 +27,11 @@ class ConvNet2(nn.Module):
         """
         Initialize CBP-layers
         """
-        self.cbp1 = CBPConv(in_layer=self.conv1, out_layer=self.conv2, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init)
-        self.cbp2 = CBPConv(in_layer=self.conv2, out_layer=self.conv3, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init)
-        self.cbp3 = CBPConv(in_layer=self.conv3, out_layer=self.fc1, num_last_filter_outputs=self.last_filter_output, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init)
-        self.cbp4 = CBPLinear(in_layer=self.fc1, out_layer=self.fc2, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init)
-        self.cbp5 = CBPLinear(in_layer=self.fc2, out_layer=self.fc3, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init)
+        self.cbp1 = CBPConv(in_layer=self.conv1, out_layer=self.conv2, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init, init_pool_size=init_pool_size, use_hooks=use_hooks)
+        self.cbp2 = CBPConv(in_layer=self.conv2, out_layer=self.conv3, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init, init_pool_size=init_pool_size, use_hooks=use_hooks)
+        self.cbp3 = CBPConv(in_layer=self.conv3, out_layer=self.fc1, num_last_filter_outputs=self.last_filter_output, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init, init_pool_size=init_pool_size, use_hooks=use_hooks)
+        self.cbp4 = CBPLinear(in_layer=self.fc1, out_layer=self.fc2, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init, init_pool_size=init_pool_size, use_hooks=use_hooks)
+        self.cbp5 = CBPLinear(in_layer=self.fc2, out_layer=self.fc3, replacement_rate=replacement_rate, maturity_threshold=maturity_threshold, init=init, init_pool_size=init_pool_size, use_hooks=use_hooks)
 
         self.layers = nn.ModuleList()
         self.layers.append(self.conv1)
@@ -44,6 +47,25 @@ class ConvNet2(nn.Module):
         self.layers.append(self.fc3)
 
         self.act_type = 'relu'
+        self.use_hooks = use_hooks
+        self.cbp_layers = [self.cbp1, self.cbp2, self.cbp3, self.cbp4, self.cbp5]
+        # the learner has to call cbp_step only if features are replaced without hooks
+        self.explicit_cbp = replacement_rate > 0 and not use_hooks
+
+    def cbp_step(self):
+        """
+        Selective reinitialization of all CBP-layers, for use_hooks=False. The layers are processed from the top, the
+        order in which the backward hooks run. This does not reproduce the hooks: they reinitialize the features of a
+        layer in the middle of the backward pass, so the gradients of the layers below are computed through the new
+        input weights, while with cbp_step the whole backward pass uses the old weights. The optimizer steps differ
+        after every replacement, and so do the trajectories. cbp_step can be called between loss.backward() and the
+        optimizer step, or after the optimizer step, the utilities then use the updated weights.
+        """
+        if self.use_hooks:
+            return
+        for cbp_layer in reversed(self.cbp_layers):
+            if cbp_layer.replacement_rate > 0:
+                cbp_layer.reinit()
 
     def predict(self, x):
         """
@@ -1,12 +1,16 @@
 import torch.nn as nn
+from lop.nets.sparse_linear import sparse_input_linear
+from lop.nets.compaction import ActiveUnitCompaction
 
 
 class Layer(nn.Module):
-    def __init__(self, in_shape, out_shape, act_type='relu'):
+    def __init__(self, in_shape, out_shape, act_type='relu', sparse_input=False):
         super(Layer, self).__init__()
         self.in_shape = in_shape
         self.out_shape = out_shape
         self.act_type = act_type
+        self.sparse_input = sparse_input
+        self.sparse_grad = False
 
         self.layers = nn.ModuleList()
 
@@ -28,14 +32,18 @@ class Layer(nn.Module):
         nn.init.kaiming_uniform_(self.fc.weight, nonlinearity=self.act_type)
 
     def forward(self, x):
-        x = self.fc(x)
+        if self.sparse_input:
+            x = sparse_input_linear(x, self.fc, sparse_grad=self.sparse_grad)
+        else:
+            x = self.fc(x)
         if self.act_layer is not None:
             x = self.act_layer(x)
         return x
 
 
 class DeepFFNN(nn.Module):
-    def __init__(self, input_size, num_features=2000, num_outputs=1, num_hidden_layers=2, act_type=['relu', 'relu']):
+    def __init__(self, input_size, num_features=2000, num_outputs=1, num_hidden_layers=2, act_type=['relu', 'relu'],
+                 sparse_input=False, compact_dead_units=False, compaction_window=1000, compaction_period=100):
         super(DeepFFNN, self).__init__()
         self.num_inputs = input_size
         self.num_features = num_features
@@ -48,7 +56,9 @@ class DeepFFNN(nn.Module):
         self.layers = nn.ModuleList()
 
         
-        self.in_layer = Layer(in_shape=input_size, out_shape=num_features, act_type=act_type[0])
+        # with sparse_input, the first layer only uses the weights of nonzero inputs, see lop.nets.sparse_linear
+        self.sparse_input = sparse_input
+        self.in_layer = Layer(in_shape=input_size, out_shape=num_features, act_type=act_type[0], sparse_input=sparse_input)
         self.layers.extend(self.in_layer.layers)
 
         self.hidden_layers = []
@@ -59,12 +69,34 @@ class DeepFFNN(nn.Module):
         self.out_layer = Layer(in_shape=num_features, out_shape=num_outputs, act_type='linear')
         self.layers.extend(self.out_layer.layers)
 
+        # with compact_dead_units, units that were not active for compaction_window steps are left out of the
+        # forward and backward passes, see lop.nets.compaction
+        self.compaction = None
+        if compact_dead_units:
+            if any(act != 'relu' for act in self.act_type[:self.num_hidden_layers]):
+                raise ValueError('compact_dead_units only supports relu activations')
+            if sparse_input:
+                raise ValueError('compact_dead_units does not support sparse_input')
+            self.compaction = ActiveUnitCompaction(
+                [self.in_layer.fc] + [layer.fc for layer in self.hidden_layers] + [self.out_layer.fc],
+                window=compaction_window, period=compaction_period)
+
+    @property
+    def sparse_grad(self):
+        return self.in_layer.sparse_grad
+
+    @sparse_grad.setter
+    def sparse_grad(self, sparse_grad):
+        self.in_layer.sparse_grad = sparse_grad
+
     def predict(self, x):
         """
         Forward pass
         :param x: input
         :return: estimated output
         """
+        if self.compaction is not None:
+            return self.compaction.forward(x)
         activations = []
         out = self.in_layer.forward(x=x)
         activations.append(out)
@@ -1,17 +1,22 @@
 import torch.nn as nn
+from lop.nets.sparse_linear import sparse_input_linear
 
 
 class FFNN(nn.Module):
     """
     A feed forward neural network with just one hidden layer.
     This network is used as the learning network in the Slowly Changing Regression problem
+    With sparse_input, the first layer only uses the weights of nonzero inputs, see lop.nets.sparse_linear
     """
-    def __init__(self, input_size, num_features=5, num_outputs=1, hidden_activation='relu'):
+    def __init__(self, input_size, num_features=5, num_outputs=1, hidden_activation='relu', sparse_input=False):
         super(FFNN, self).__init__()
         self.num_inputs = input_size
         self.num_features = num_features
         self.num_outputs = num_outputs
         self.act_type = hidden_activation
+        self.sparse_input = sparse_input
+        # set by the learner when its optimizer can use sparse gradients
+        self.sparse_grad = False
 
         # define the hidden activation
         self.hidden_activation = {'sigmoid': nn.Sigmoid, 'tanh': nn.Tanh, 'relu': nn.ReLU, 'selu': nn.SELU,
@@ -39,7 +44,10 @@ class FFNN(nn.Module):
         :param x: input
         :return: estimated output
         """
-        features = self.layers[1](self.layers[0](x))
+        if self.sparse_input:
+            features = self.layers[1](sparse_input_linear(x, self.layers[0], sparse_grad=self.sparse_grad))
+        else:
+            features = self.layers[1](self.layers[0](x))
         out = self.layers[-1](features)
         return out, [features]
 
@@ -25,6 +25,9 @@ class Policy(object):
     def dist_to(self, dist, to_device='cpu'):
         pass
 
+    def dist_params(self, dist):
+        pass
+
     def dist_stack(self, dists):
         pass
 
@@ -98,7 +101,19 @@ class MLPPolicy(Policy, nn.Module):
         dist.scale.to(to_device)
         return dist
 
+    def dist_params(self, dist):
+        """
+        :return: np.array of shape [N, 2 * a_dim] with the means and log standard deviations of the distribution
+        """
+        return torch.cat((dist.loc, dist.scale.log()), dim=-1).cpu().numpy()
+
     def dist_stack(self, dists, device='cpu'):
+        """
+        :param dists: list of distributions, or tensor of shape [N, 2 * a_dim] of rows returned by dist_params
+        """
+        if isinstance(dists, torch.Tensor):
+            mean, log_std = dists.to(device).chunk(2, dim=-1)
+            return Normal(mean, log_std.exp())
         return Normal(
             torch.cat(tuple([dists[i].loc for i in range(len(dists))])).to(device),
             torch.cat(tuple([dists[i].scale for i in range(len(dists))])).to(device)
@@ -0,0 +1,58 @@
+import torch
+from torch import optim
+
+
+class SparseInputLinearFunction(torch.autograd.Function):
+    """
+    Linear layer for inputs that are mostly zero, like the bits of the slowly changing regression problem or MNIST
+    pixels. Only the weight columns of inputs that are nonzero for some example in the mini-batch are used, and only
+    these columns get a gradient. With sparse_grad, the gradient of the weights is a sparse COO tensor, so that a plain
+    SGD step only updates these columns.
+    The output is the same as the one of F.linear up to the order of the floating point additions.
+    """
+    @staticmethod
+    def forward(ctx, x, weight, bias, sparse_grad=False):
+        active = torch.nonzero((x != 0).any(dim=0)).squeeze(1)
+        active_x = x[:, active]
+        ctx.save_for_backward(active_x, active, weight)
+        ctx.sparse_grad = sparse_grad
+        return torch.addmm(bias, active_x, weight[:, active].t())
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        active_x, active, weight = ctx.saved_tensors
+        grad_x = grad_weight = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            grad_x = grad_output @ weight
+        if ctx.needs_input_grad[1]:
+            grad_columns = grad_output.t() @ active_x
+            if ctx.sparse_grad:
+                rows = torch.arange(weight.shape[0], device=weight.device).repeat_interleave(active.shape[0])
+                cols = active.repeat(weight.shape[0])
+                grad_weight = torch.sparse_coo_tensor(torch.stack((rows, cols)), grad_columns.reshape(-1),
+                                                      size=weight.shape)
+            else:
+                grad_weight = torch.zeros_like(weight)
+                grad_weight[:, active] = grad_columns
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_output.sum(dim=0)
+        return grad_x, grad_weight, grad_bias, None
+
+
+def sparse_input_linear(x, layer, sparse_grad=False):
+    """
+    :param x: input, mini-batch * in_features
+    :param layer: nn.Linear layer whose weights are used
+    :param sparse_grad: return the gradient of the weights as a sparse tensor
+    :return: layer(x)
+    """
+    return SparseInputLinearFunction.apply(x, layer.weight, layer.bias, sparse_grad)
+
+
+def sparse_grad_supported(opt):
+    """
+    Sparse gradients can only be used by plain SGD, without momentum or weight decay
+    """
+    if type(opt) is not optim.SGD:
+        return False
+    return all(group['momentum'] == 0 and group['weight_decay'] == 0 for group in opt.param_groups)
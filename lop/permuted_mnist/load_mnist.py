@@ -1,5 +1,7 @@
+import sys
 import torch
 import pickle
+import numpy as np
 import torchvision
 import torchvision.transforms as transforms
 
@@ -39,20 +41,57 @@ def mnist():
 
     with open('data/mnist_', 'wb+') as f:
         pickle.dump([x, y, x_test, y_test], f)
+    save_uint8_mnist(x, y, x_test, y_test)
 
     return x, y, x_test, y_test
 
 
+def save_uint8_mnist(x, y, x_test, y_test, data_dir='data'):
+    """
+    Store the images as uint8 .npy files, which are 4x smaller than float32 and can be memory-mapped by many runs at once.
+    The images from ToTensor are k/255, so x = uint8 / 255 recovers them exactly.
+    """
+    for name, images, labels in [('mnist', x, y), ('mnist_test', x_test, y_test)]:
+        np.save(data_dir + '/' + name + '_x.npy', (images * 255).round().to(torch.uint8).numpy())
+        np.save(data_dir + '/' + name + '_y.npy', labels.numpy())
+
+
+def convert_mnist(data_file='data/mnist_', data_dir='data'):
+    """
+    Convert a pickled data file to the uint8 format, keeping the order of the examples in it
+    """
+    with open(data_file, 'rb+') as f:
+        x, y, x_test, y_test = pickle.load(f)
+    save_uint8_mnist(x, y, x_test, y_test, data_dir=data_dir)
+
+
 def get_mnist(type='reg'):
     if type == 'reg':
         data_file = 'data/mnist_'
         with open(data_file, 'rb+') as f:
             x, y, x_test, y_test = pickle.load(f)
+    elif type == 'npy':
+        x, y, x_test, y_test = get_uint8_mnist()
     return x, y, x_test, y_test
 
 
+def get_uint8_mnist(data_dir='data'):
+    """
+    Memory-map the uint8 data set, the pages are shared by all the processes that read it.
+    Images are uint8 arrays and have to be divided by 255, e.g. by PermutedTaskStream, one batch at a time
+    """
+    data = []
+    for name in ['mnist', 'mnist_test']:
+        data.append(np.load(data_dir + '/' + name + '_x.npy', mmap_mode='r'))
+        data.append(np.load(data_dir + '/' + name + '_y.npy', mmap_mode='r'))
+    return data
+
+
 if __name__ == '__main__':
     """
-    Generates all the required data
+    Generates all the required data. With --convert, an existing data/mnist_ is converted to the uint8 format
     """
-    mnist()
+    if '--convert' in sys.argv:
+        convert_mnist()
+    else:
+        mnist()
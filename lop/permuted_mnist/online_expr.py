@@ -14,7 +14,10 @@ from lop.algos.cbp import ContinualBackprop
 from lop.nets.linear import MyLinear
 from torch.nn.functional import softmax
 from lop.nets.deep_ffnn import DeepFFNN
-from lop.utils.miscellaneous import nll_accuracy, compute_matrix_rank_summaries
+from lop.utils.miscellaneous import nll_accuracy, compute_matrix_rank_summaries, MetricBuffer
+from lop.utils.sketch import FrequentDirections
+from lop.permuted_mnist.task_stream import PermutedTaskStream
+from lop.permuted_mnist.load_mnist import get_uint8_mnist
 
 
 def online_expr(params: {}):
@@ -43,6 +46,20 @@ def online_expr(params: {}):
     coeffs = [[-0.5, 0.5], [-0.5, 0.5], [-0.5, 0.5]]
     repl_rates = [[1e-4, 1e-5], [1e-4, 1e-5], [1e-4, 1e-5]]
     activations = ['relu', 'relu', 'relu']
+    fused = False
+    lazy_decay = False
+    weight_mag_period = 1
+    init_pool_size = 0
+    data_format = 'pickle'
+    log_weight_every = 1
+    sketch_size = 0
+    sketch_decay = 1.0
+    sparse_input = False
+    compact_dead_units = False
+    compaction_window = 1000
+    rank_method = 'svd'
+    rank_driver = None
+    rank_use_scipy = False
 
     if 'to_log' in params.keys():
         to_log = params['to_log']
@@ -77,13 +94,42 @@ def online_expr(params: {}):
         coeffs = params['coeffs']
     if 'repl_rates' in params.keys():
         repl_rates = params['repl_rates']
+    if 'fused' in params.keys():
+        fused = params['fused']
+    if 'lazy_decay' in params.keys():
+        lazy_decay = params['lazy_decay']
+    if 'weight_mag_period' in params.keys():
+        weight_mag_period = params['weight_mag_period']
+    if 'init_pool_size' in params.keys():
+        init_pool_size = params['init_pool_size']
+    if 'data_format' in params.keys():
+        data_format = params['data_format']
+    if 'log_weight_every' in params.keys():
+        log_weight_every = params['log_weight_every']
+    if 'sketch_size' in params.keys():
+        sketch_size = params['sketch_size']
+    if 'sketch_decay' in params.keys():
+        sketch_decay = params['sketch_decay']
+    if 'sparse_input' in params.keys():
+        sparse_input = params['sparse_input']
+    if 'compact_dead_units' in params.keys():
+        compact_dead_units = params['compact_dead_units']
+    if 'compaction_window' in params.keys():
+        compaction_window = params['compaction_window']
+    if 'rank_method' in params.keys():
+        rank_method = params['rank_method']
+    if 'rank_driver' in params.keys():
+        rank_driver = params['rank_driver']
+    if 'rank_use_scipy' in params.keys():
+        rank_use_scipy = params['rank_use_scipy']
 
     classes_per_task = 10
     images_per_class = 1000
     input_size = 784
     num_hidden_layers = num_hidden_layers
     net = DeepFFNN(input_size=input_size, num_features=num_features, num_outputs=classes_per_task,
-                   num_hidden_layers=num_hidden_layers, act_type=activations)
+                   num_hidden_layers=num_hidden_layers, act_type=activations, sparse_input=sparse_input,
+                   compact_dead_units=compact_dead_units, compaction_window=compaction_window)
 
     if agent_type == 'linear':
         net = MyLinear(
@@ -115,6 +161,10 @@ def online_expr(params: {}):
             device=dev,
             coeffs=coeffs,
             repl_rates=repl_rates,
+            fused=fused,
+            lazy_decay=lazy_decay,
+            weight_mag_period=weight_mag_period,
+            init_pool_size=init_pool_size,
         )
 
     accuracy = nll_accuracy
@@ -135,29 +185,49 @@ def online_expr(params: {}):
     ranks = torch.zeros((int(total_examples/rank_measure_period), num_hidden_layers), dtype=torch.float)
     dead_neurons = torch.zeros((int(total_examples/rank_measure_period), num_hidden_layers), dtype=torch.float)
 
+    """
+    Per-step metrics stay on the device and are copied to the host once per task
+    """
+    iters_per_task = len(range(0, change_after, mini_batch_size))
+    accuracy_buffer = MetricBuffer(num_steps=iters_per_task, device=dev)
+    if to_log and agent_type != 'linear':
+        weight_mag_buffer = MetricBuffer(num_steps=iters_per_task, shape=(len(learner.net.layers_to_log),), device=dev)
+
+    """
+    Streaming sketches of the hidden activations seen during each task, summarized and reset at the end of the task
+    """
+    to_sketch = sketch_size > 0 and agent_type != 'linear'
+    if to_sketch:
+        sketches = [FrequentDirections(num_features=num_features, sketch_size=sketch_size, decay=sketch_decay, device=dev)
+                    for _ in range(num_hidden_layers)]
+        sketch_effective_ranks = torch.zeros((num_tasks, num_hidden_layers), dtype=torch.float)
+        sketch_approximate_ranks = torch.zeros((num_tasks, num_hidden_layers), dtype=torch.float)
+        sketch_stable_ranks = torch.zeros((num_tasks, num_hidden_layers), dtype=torch.float)
+        sketch_dead_neurons = torch.zeros((num_tasks, num_hidden_layers), dtype=torch.float)
+
     iter = 0
-    with open('data/mnist_', 'rb+') as f:
-        x, y, _, _ = pickle.load(f)
-        if use_gpu == 1:
-            x = x.to(dev)
-            y = y.to(dev)
+    if data_format == 'npy':
+        x, y, _, _ = get_uint8_mnist()
+    else:
+        with open('data/mnist_', 'rb+') as f:
+            x, y, _, _ = pickle.load(f)
+            if use_gpu == 1:
+                x = x.to(dev)
+                y = y.to(dev)
+    task_stream = PermutedTaskStream(x=x, y=y, examples_per_task=examples_per_task, input_size=input_size, device=dev)
 
     for task_idx in (range(num_tasks)):
         new_iter_start = iter
-        pixel_permutation = np.random.permutation(input_size)
-        x = x[:, pixel_permutation]
-        data_permutation = np.random.permutation(examples_per_task)
-        x, y = x[data_permutation], y[data_permutation]
+        task_stream.new_task()
 
         if agent_type != 'linear':
             with torch.no_grad():
                 new_idx = int(iter / rank_measure_period)
-                m = net.predict(x[:2000])[1]
-                for rep_layer_idx in range(num_hidden_layers):
-                    ranks[new_idx][rep_layer_idx], effective_ranks[new_idx][rep_layer_idx], \
-                    approximate_ranks[new_idx][rep_layer_idx], approximate_ranks_abs[new_idx][rep_layer_idx] = \
-                        compute_matrix_rank_summaries(m=m[rep_layer_idx], use_scipy=True)
-                    dead_neurons[new_idx][rep_layer_idx] = (m[rep_layer_idx].abs().sum(dim=0) == 0).sum()
+                m = torch.stack(net.predict(task_stream.get(0, 2000)[0])[1][:num_hidden_layers])
+                # the summaries of all layers are computed at once, by default with a batched torch svd
+                ranks[new_idx], effective_ranks[new_idx], approximate_ranks[new_idx], approximate_ranks_abs[new_idx] = \
+                    compute_matrix_rank_summaries(m=m, use_scipy=rank_use_scipy, method=rank_method, driver=rank_driver)
+                dead_neurons[new_idx] = (m.abs().sum(dim=1) == 0).sum(dim=-1)
                 print('approximate rank: ', approximate_ranks[new_idx], ', dead neurons: ', dead_neurons[new_idx])
                 
                 wandb.log({
@@ -169,20 +239,35 @@ def online_expr(params: {}):
 
         for start_idx in tqdm(range(0, change_after, mini_batch_size)):
             start_idx = start_idx % examples_per_task
-            batch_x = x[start_idx: start_idx+mini_batch_size]
-            batch_y = y[start_idx: start_idx+mini_batch_size]
+            batch_x, batch_y = task_stream.get(start_idx, start_idx+mini_batch_size)
 
             # train the network
             loss, network_output = learner.learn(x=batch_x, target=batch_y)
 
             if to_log and agent_type != 'linear':
-                for idx, layer_idx in enumerate(learner.net.layers_to_log):
-                    weight_mag_sum[iter][idx] = learner.net.layers[layer_idx].weight.data.abs().sum()
+                # steps in between measurements repeat the last one
+                if iter % log_weight_every == 0:
+                    current_weight_mag = torch.stack([learner.net.layers[layer_idx].weight.data.abs().sum()
+                                                      for layer_idx in learner.net.layers_to_log])
+                weight_mag_buffer.record(current_weight_mag)
+            if to_sketch:
+                for layer_idx, sketch in enumerate(sketches):
+                    sketch.update(learner.previous_features[layer_idx])
             # log accuracy
             with torch.no_grad():
-                acc = accuracy(softmax(network_output, dim=1), batch_y).cpu()
-                accuracies[iter] = acc
+                accuracy_buffer.record(accuracy(softmax(network_output, dim=1), batch_y))
             iter += 1
+
+        accuracies[new_iter_start:iter] = accuracy_buffer.flush()
+        if to_log and agent_type != 'linear':
+            weight_mag_sum[new_iter_start:iter, :len(learner.net.layers_to_log)] = weight_mag_buffer.flush()
+        if to_sketch:
+            for layer_idx, sketch in enumerate(sketches):
+                _, sketch_effective_ranks[task_idx][layer_idx], sketch_approximate_ranks[task_idx][layer_idx], _ = \
+                    sketch.rank_summaries()
+                sketch_stable_ranks[task_idx][layer_idx] = sketch.stable_rank()
+                sketch_dead_neurons[task_idx][layer_idx] = sketch.dead_units()
+                sketch.reset()
         
         print('recent accuracy', accuracies[new_iter_start:iter - 1].mean())
         num_weights = 99400
@@ -203,6 +288,11 @@ def online_expr(params: {}):
                 'abs_approximate_ranks': approximate_ranks_abs.cpu(),
                 'dead_neurons': dead_neurons.cpu(),
             }
+            if to_sketch:
+                data['sketch_effective_ranks'] = sketch_effective_ranks
+                data['sketch_approximate_ranks'] = sketch_approximate_ranks
+                data['sketch_stable_ranks'] = sketch_stable_ranks
+                data['sketch_dead_neurons'] = sketch_dead_neurons
 
 def save_data(file, data):
     with open(file, 'wb+') as f:
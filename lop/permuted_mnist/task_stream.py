@@ -0,0 +1,54 @@
+import torch
+import numpy as np
+
+
+class PermutedTaskStream(object):
+    """
+    Stream of Permuted MNIST tasks that never copies the data set.
+    The original experiment permutes the pixels of the (already permuted) inputs and then shuffles the examples at every
+    task switch, i.e. x = x[:, pixel_permutation][data_permutation]. Here x and y stay as they are, and only the
+    composition of all permutations so far is kept: the inputs of the current task are x[rows][:, cols] and the
+    targets are y[rows]. Batches are gathered when they are needed.
+    x and y can also be numpy arrays, e.g. memory-mapped by get_uint8_mnist. Batches are then gathered on the host
+    and moved to device, and uint8 images are scaled to [0, 1] there.
+    """
+    def __init__(self, x, y, examples_per_task=10000, input_size=784, device='cpu'):
+        self.x = x
+        self.y = y
+        self.examples_per_task = examples_per_task
+        self.input_size = input_size
+        self.on_host = isinstance(x, np.ndarray)
+        if self.on_host:
+            self.device = device
+            self.rows = np.arange(x.shape[0])
+            self.cols = np.arange(input_size)
+        else:
+            self.device = x.device
+            self.rows = torch.arange(x.shape[0], device=self.device)
+            self.cols = torch.arange(input_size, device=self.device)
+
+    def new_task(self):
+        """
+        Switch to the next task, using the same random numbers, in the same order, as the original experiment
+        """
+        pixel_permutation = np.random.permutation(self.input_size)
+        data_permutation = np.random.permutation(self.examples_per_task)
+        if not self.on_host:
+            pixel_permutation = torch.from_numpy(pixel_permutation).to(self.device)
+            data_permutation = torch.from_numpy(data_permutation).to(self.device)
+        self.cols = self.cols[pixel_permutation]
+        self.rows = self.rows[data_permutation]
+
+    def get(self, start_idx, end_idx):
+        """
+        Returns: inputs and targets of examples start_idx to end_idx of the current task
+        """
+        rows = self.rows[start_idx: end_idx]
+        if not self.on_host:
+            return self.x[rows][:, self.cols], self.y[rows]
+
+        x = torch.from_numpy(self.x[rows[:, None], self.cols]).to(self.device)
+        y = torch.from_numpy(np.asarray(self.y[rows])).to(self.device)
+        if x.dtype == torch.uint8:
+            x = x.float() / 255
+        return x, y
@@ -1,5 +1,6 @@
 import os
 import yaml
+import queue
 import pickle
 import argparse
 import subprocess
@@ -7,20 +8,25 @@ import numpy as np
 
 import gym
 import torch
+import torch.multiprocessing as mp
+from functools import partial
 from torch.optim import Adam
 
 import lop.envs
+from lop.envs import FrictionSchedule
 from lop.algos.rl.buffer import Buffer
 from lop.nets.policies import MLPPolicy
 from lop.nets.valuefs import MLPVF
 from lop.algos.rl.agent import Agent
 from lop.algos.rl.ppo import PPO
+from lop.algos.rl.pipeline import PolicySnapshot, run_actor
 from lop.utils.miscellaneous import compute_matrix_rank_summaries
 
 
 def save_data(cfg, rets, termination_steps,
               pol_features_activity, stable_rank, mu, pol_weights, val_weights,
-              action_probs=None, weight_change=[], friction=-1.0, num_updates=0, previous_change_time=0):
+              action_probs=None, weight_change=[], friction=-1.0, num_updates=0, previous_change_time=0,
+              policy_lag=[]):
     data_dict = {
         'rets': np.array(rets),
         'termination_steps': np.array(termination_steps),
@@ -33,7 +39,8 @@ def save_data(cfg, rets, termination_steps,
         'weight_change': torch.tensor(weight_change).numpy(),
         'friction': friction,
         'num_updates': num_updates,
-        'previous_change_time': previous_change_time
+        'previous_change_time': previous_change_time,
+        'policy_lag': np.array(policy_lag),
     }
     with open(cfg['log_path'], 'wb') as f:
         pickle.dump(data_dict, f, pickle.HIGHEST_PROTOCOL)
@@ -45,13 +52,14 @@ def load_data(cfg):
     return data_dict
 
 
-def save_checkpoint(cfg, step, learner):
-    # Save step, model and optimizer states
+def save_checkpoint(cfg, step, learner, friction_schedules=None):
+    # Save step, model and optimizer states, and the states of the friction schedules of a vector env
     ckpt_dict = dict(
         step = step,
         actor = learner.pol.state_dict(),
         critic = learner.vf.state_dict(),
-        opt = learner.opt.state_dict()
+        opt = learner.opt.state_dict(),
+        friction_schedules = friction_schedules,
     )
     torch.save(ckpt_dict, cfg['ckpt_path'])
     print(f'Save checkpoint at step={step}')
@@ -66,7 +74,40 @@ def load_checkpoint(cfg, device, learner):
     learner.vf.load_state_dict(ckpt_dict['critic'])
     learner.opt.load_state_dict(ckpt_dict['opt'])
     print(f"Successfully restore from checkpoint: {cfg['ckpt_path']}.")
-    return step, learner
+    return step, learner, ckpt_dict.get('friction_schedules')
+
+
+def make_vector_env(cfg, frictions=None):
+    """
+    cfg['num_envs'] copies of the environment in a gym vector env, stepped one after the other in this process
+    (vec_env: sync) or in parallel in subprocesses (vec_env: async), a vector env of one environment by default.
+    SlipperyAnt environments follow their own friction schedule, each with its own xml file
+    """
+    seed, num_envs = cfg['seed'], cfg['num_envs']
+
+    def make_env(env_idx):
+        def thunk():
+            if frictions is None:
+                return gym.make(cfg['env_name'])
+            xml_file = os.path.abspath(cfg['dir'] + f'slippery_ant_{seed}_{env_idx}.xml')
+            return FrictionSchedule(cfg['env_name'], frictions=frictions[seed], xml_file=xml_file,
+                                    change_time=cfg['change_time'], steps_per_env_step=num_envs)
+        return thunk
+
+    env_fns = [make_env(env_idx) for env_idx in range(num_envs)]
+    if cfg['vec_env'] == 'async':
+        return gym.vector.AsyncVectorEnv(env_fns)
+    if cfg['vec_env'] == 'sync':
+        return gym.vector.SyncVectorEnv(env_fns)
+    raise ValueError(f"Unknown vec_env: {cfg['vec_env']}")
+
+
+def schedule_logs(friction_schedules):
+    """
+    Friction and previous_change_time of every environment of a vector env, for the data logs
+    """
+    return [state['friction'] for state in friction_schedules], \
+        [state['previous_change_time'] for state in friction_schedules]
 
 
 def main():
@@ -100,9 +141,14 @@ def main():
     cfg.setdefault('frictions_file', 'cfg/frictions')
     cfg.setdefault('max_grad_norm', 1e9)
     cfg.setdefault('perturb_scale', 0)
+    cfg.setdefault('store_dist', False)
+    cfg.setdefault('num_envs', 1)
+    cfg.setdefault('vec_env', 'sync')
+    cfg.setdefault('pipelined', False)
     cfg['n_steps'] = int(float(cfg['n_steps']))
     cfg['perturb_scale'] = float(cfg['perturb_scale'])
     n_steps = cfg['n_steps']    
+    num_envs = cfg['num_envs']
 
     # Set default values for CBP
     cfg.setdefault('mt', 10000)
@@ -117,26 +163,16 @@ def main():
     cfg.setdefault('pgnt', (cfg['rr']>0) or cfg['redo'])
     cfg.setdefault('vgnt', (cfg['rr']>0) or cfg['redo'])
 
-    # Initialize env
+    # Initialize env, a vector env also with a single environment
     seed = cfg['seed']
-    friction = -1.0
+    frictions = None
     if cfg['env_name'] in ['SlipperyAnt-v2', 'SlipperyAnt-v3']:
-        xml_file = os.path.abspath(cfg['dir'] + f'slippery_ant_{seed}.xml')
         cfg.setdefault('friction', [0.02, 2])
         cfg.setdefault('change_time', int(2e6))
 
         with open(cfg['frictions_file'], 'rb+') as f:
             frictions = pickle.load(f)
-        friction_number = 0
-        new_friction = frictions[seed][friction_number]
-
-        if friction < 0: # If no saved friction, use the default value 1.0
-            friction = 1.0
-        env = gym.make(cfg['env_name'], friction=new_friction, xml_file=xml_file)
-        print(f'Initial friction: {friction:.6f}')
-    else:
-        env = gym.make(cfg['env_name'])
-    env.name = None
+    env = make_vector_env(cfg, frictions=frictions)
 
     # Set random seeds
     np.random.seed(seed)
@@ -148,12 +184,12 @@ def main():
     # Initialize algorithm
     opt = Adam
     num_layers = len(cfg['h_dim'])
-    o_dim = env.observation_space.shape[0]
-    a_dim = env.action_space.shape[0]
+    o_dim = env.single_observation_space.shape[0]
+    a_dim = env.single_action_space.shape[0]
     pol = MLPPolicy(o_dim, a_dim, act_type=cfg['act_type'], h_dim=cfg['h_dim'], device=device, init=cfg['init'])
     vf = MLPVF(o_dim, act_type=cfg['act_type'], h_dim=cfg['h_dim'], device=device, init=cfg['init'])
     np.random.set_state(random_state)
-    buf = Buffer(o_dim, a_dim, cfg['bs'], device=device)
+    buf = Buffer(o_dim, a_dim, cfg['bs'], device=device, store_dist=cfg['store_dist'], num_envs=num_envs)
 
     learner = PPO(pol, buf, cfg['lr'], g=cfg['g'], vf=vf, lm=cfg['lm'], Opt=opt,
                   u_epi_up=cfg['u_epi_ups'], device=device, n_itrs=cfg['n_itrs'], n_slices=cfg['n_slices'],
@@ -168,19 +204,29 @@ def main():
                   )
 
     to_log = cfg['to_log']
-    agent = Agent(pol, learner, device=device, to_log_features=(len(to_log) > 0))
+    # the logs other than weight_change are taken at every step, from the actions and the features of the policy
+    log_every_step = any(log != 'weight_change' for log in to_log)
+    agent = Agent(pol, learner, device=device, to_log_features=(len(to_log) > 0), store_dist=cfg['store_dist'])
 
     # Load checkpoint
+    friction_schedules = None
     if os.path.exists(cfg['ckpt_path']):
-        start_step, agent.learner = load_checkpoint(cfg, device, agent.learner)
+        start_step, agent.learner, friction_schedules = load_checkpoint(cfg, device, agent.learner)
     else:
         start_step = 0
+    # the SlipperyAnt environments continue their friction schedules
+    if frictions is not None:
+        if friction_schedules is None:
+            friction_schedules = list(env.get_attr('schedule_state'))
+        elif not cfg['pipelined']:
+            # in the pipelined mode, the actor restores them in its own environments
+            env.set_attr('schedule_state', friction_schedules)
+        print('Initial frictions:', schedule_logs(friction_schedules)[0])
     
     # Initialize log
     if os.path.exists(cfg['log_path']):
         data_dict = load_data(cfg)
         num_updates = data_dict['num_updates']
-        previous_change_time = data_dict['previous_change_time']
         for k, v in data_dict.items():
             try:
                 data_dict[k] = list(v)
@@ -191,7 +237,6 @@ def main():
         pol_features_activity = data_dict['pol_features_activity']
         stable_rank = data_dict['stable_rank']
         if 'pol_features_activity' in to_log:
-            short_term_feature_activity = torch.zeros(size=(1000, num_layers, cfg['h_dim'][0]))
             pol_features_activity = torch.stack(pol_features_activity)
         if 'stable_rank' in to_log:
             stable_rank = torch.stack(stable_rank)
@@ -205,82 +250,141 @@ def main():
         if 'val_weights' in to_log:
             val_weights = np.array(val_weights)
         weight_change = data_dict['weight_change']
+        policy_lag = data_dict.get('policy_lag', [])
     else:
         num_updates = 0
-        previous_change_time = 0
-        rets, termination_steps = [], []
+        rets, termination_steps, policy_lag = [], [], []
         mu, weight_change, pol_features_activity, stable_rank, pol_weights, val_weights = [], [], [], [], [], []
         if 'mu' in to_log:
-            mu = np.ones(size=(n_steps, a_dim))
+            # the last iteration over a vector env can go past n_steps
+            mu = np.ones(shape=(n_steps + num_envs - 1, a_dim))
         if 'pol_weights' in to_log:
             pol_weights = np.zeros(shape=(n_steps//1000 + 2, (len(pol.mean_net)+1)//2))
         if 'val_weights' in to_log:
             val_weights = np.zeros(shape=(n_steps//1000 + 2, (len(pol.mean_net)+1)//2))
         if 'pol_features_activity' in to_log:
-            short_term_feature_activity = torch.zeros(size=(1000, num_layers, cfg['h_dim'][0]))
             pol_features_activity = torch.zeros(size=(n_steps//1000 + 2, num_layers, cfg['h_dim'][0]))
         if 'stable_rank' in to_log:
             stable_rank = torch.zeros(size=(n_steps//10000 + 2,))
+    # features of the last 1000 steps, for pol_features_activity and stable_rank
+    short_term_feature_activity = torch.zeros(size=(1000, num_layers, cfg['h_dim'][0]))
 
-    ret = 0
-    epi_steps = 0
-    o = env.reset()
-    print('start_step:', start_step)
-    # Interaction loop
-    for step in range(start_step, n_steps):
-        a, logp, dist, new_features = agent.get_action(o)
-        op, r, done, infos = env.step(a)
-        epi_steps += 1
-        op_ = op
-        val_logs = agent.log_update(o, a, r, op_, logp, dist, done)
-        # Logging
+    def log_steps(step, a, new_features):
+        """
+        Logs of the steps step, step + 1, ..., one step of every environment of the vector env
+        :param a: actions of the environments, (num_envs, a_dim)
+        :param new_features: features of the policy for them, one (num_envs, h_dim) tensor per layer
+        """
         with torch.no_grad():
+            for env_idx in range(a.shape[0]):
+                env_step = step + env_idx
+                if 'mu' in to_log: mu[env_step] = a[env_idx]
+                if env_step % 1000 == 0:
+                    if env_step % 10000 == 0 and 'stable_rank' in to_log:
+                        _, _, _, stable_rank[env_step//10000] = compute_matrix_rank_summaries(m=short_term_feature_activity[:, -1, :], use_scipy=True)
+                    if 'pol_features_activity' in to_log:
+                        pol_features_activity[env_step//1000] = (short_term_feature_activity>0).float().mean(dim=0)
+                    short_term_feature_activity.zero_()
+                    if 'pol_weights' in to_log:
+                        for layer_idx in range((len(pol.mean_net) + 1) // 2):
+                            pol_weights[env_step//1000, layer_idx] = pol.mean_net[2 * layer_idx].weight.data.abs().mean()
+                    if 'val_weights' in to_log:
+                        for layer_idx in range((len(learner.vf.v_net) + 1) // 2):
+                            val_weights[env_step//1000, layer_idx] = learner.vf.v_net[2 * layer_idx].weight.data.abs().mean()
+                if 'pol_features_activity' in to_log or 'stable_rank' in to_log:
+                    for i in range(num_layers):
+                        short_term_feature_activity[env_step % 1000, i] = new_features[i][env_idx]
+
+    def save(step, friction_schedules):
+        """
+        Save the checkpoint and the data logs, step is the next step to run
+        """
+        friction, previous_change_time = -1.0, 0
+        if friction_schedules is not None:
+            friction, previous_change_time = schedule_logs(friction_schedules)
+        # Save checkpoint
+        save_checkpoint(cfg, step, agent.learner, friction_schedules=friction_schedules)
+        # Save data logs
+        save_data(cfg=cfg, rets=rets, termination_steps=termination_steps,
+                  pol_features_activity=pol_features_activity, stable_rank=stable_rank, mu=mu,
+                  pol_weights=pol_weights, val_weights=val_weights, weight_change=weight_change,
+                  friction=friction, num_updates=num_updates, previous_change_time=previous_change_time,
+                  policy_lag=policy_lag)
+
+    save_every = max(1, n_steps // 100)
+    print('start_step:', start_step)
+    if cfg['pipelined']:
+        # An actor process collects the next rollout with a snapshot of the policy while the learner updates it on the
+        # previous one. The environments of the actor are only used to read the dimensions here
+        env.close()
+        ctx = mp.get_context('fork')
+        snapshot = PolicySnapshot(pol, ctx)
+        rollouts = ctx.Queue(maxsize=1)
+        actor = ctx.Process(target=run_actor, kwargs=dict(
+            env_fn=partial(make_vector_env, cfg, frictions=frictions), snapshot=snapshot,
+            rollouts=rollouts, bs=cfg['bs'], u_epi_up=cfg['u_epi_ups'], store_dist=cfg['store_dist'],
+            start_step=start_step, n_steps=n_steps, schedule_states=friction_schedules, log_steps=log_every_step))
+        actor.start()
+        step = start_step
+        while True:
+            try:
+                rollout = rollouts.get(timeout=60)
+            except queue.Empty:
+                # the actor puts None in the queue when it is done, so it failed if it exited
+                if not actor.is_alive():
+                    raise RuntimeError(f'The actor process exited with code {actor.exitcode}')
+                continue
+            if rollout is None:
+                break
+            rets.extend(rollout['rets'])
+            termination_steps.extend(rollout['termination_steps'])
+            if log_every_step:
+                # logged with the policy of the learner, the rollout was collected with the previous one at most
+                features = [torch.as_tensor(f) for f in rollout['features']]
+                for t in range(rollout['actions'].shape[0]):
+                    log_steps(step + t * num_envs, rollout['actions'][t], [f[t] for f in features])
+            if rollout['transitions'] is not None:
+                # the policy that collected the rollout is at most one update behind
+                policy_lag.append(snapshot.version.value - rollout['version'])
+                learner.buf.load(rollout['transitions'])
+                val_logs = learner.learn()
+                learner.post_learn()
+                snapshot.publish(pol)
+                if 'weight_change' in to_log: weight_change.append(val_logs['weight_change'])
+
+            if step // save_every != rollout['step'] // save_every or rollout['step'] >= n_steps:
+                if rollout['schedule_states'] is not None:
+                    friction_schedules = rollout['schedule_states']
+                save(rollout['step'], friction_schedules)
+            step = rollout['step']
+        actor.join()
+    else:
+        # Interaction loop, each iteration is one step of every environment, and step counts the transitions of all
+        # environments
+        rets_per_env = np.zeros(num_envs)
+        o = env.reset()
+        for step in range(start_step, n_steps, num_envs):
+            a, logp, dist, new_features = agent.get_actions(o)
+            op, r, done, infos = env.step(a)
+            val_logs = agent.log_update(o, a, r, op, logp, dist, done)
+            # Logging
             if 'weight_change' in to_log and 'weight_change' in val_logs.keys(): weight_change.append(val_logs['weight_change'])
-            if 'mu' in to_log: mu[step] = a
-            if step % 1000 == 0:
-                if step % 10000 == 0 and 'stable_rank' in to_log:
-                    _, _, _, stable_rank[step//10000] = compute_matrix_rank_summaries(m=short_term_feature_activity[:, -1, :], use_scipy=True)
-                if 'pol_features_activity' in to_log:
-                    pol_features_activity[step//1000] = (short_term_feature_activity>0).float().mean(dim=0)
-                    short_term_feature_activity *= 0
-                if 'pol_weights' in to_log:
-                    for layer_idx in range((len(pol.mean_net) + 1) // 2):
-                        pol_weights[step//1000, layer_idx] = pol.mean_net[2 * layer_idx].weight.data.abs().mean()
-                if 'val_weights' in to_log:
-                    for layer_idx in range((len(learner.vf.v_net) + 1) // 2):
-                        val_weights[step//1000, layer_idx] = learner.vf.v_net[2 * layer_idx].weight.data.abs().mean()
-            if 'pol_features_activity' in to_log:
-                for i in range(num_layers):
-                    short_term_feature_activity[step % 1000, i] = new_features[i]
-
-        o = op
-        ret += r
-        if done:
-            # print(step, "(", epi_steps, ") {0:.2f}".format(ret))
-            rets.append(ret)
-            termination_steps.append(step)
-            ret = 0
-            epi_steps = 0
-            if cfg['env_name'] in ['SlipperyAnt-v2', 'SlipperyAnt-v3'] and step - previous_change_time > cfg['change_time']:
-                previous_change_time = step
-                env.close()
-                friction_number += 1
-                new_friction = frictions[seed][friction_number]
-                print(f'{step}: change friction to {new_friction:.6f}')
-                env.close()
-                env = gym.make(cfg['env_name'], friction=new_friction, xml_file=xml_file)
-                env.name = None
-                agent.env = env
-            o = env.reset()
-
-        if step % (n_steps//100) == 0 or step == n_steps-1:
-            # Save checkpoint
-            save_checkpoint(cfg, step, agent.learner)
-            # Save data logs
-            save_data(cfg=cfg, rets=rets, termination_steps=termination_steps,
-                      pol_features_activity=pol_features_activity, stable_rank=stable_rank, mu=mu, pol_weights=pol_weights,
-                      val_weights=val_weights, weight_change=weight_change, friction=friction,
-                      num_updates=num_updates, previous_change_time=previous_change_time)
+            if log_every_step:
+                log_steps(step, a, new_features)
+
+            # The vector env resets the environments that are done, op already holds their first observations
+            o = op
+            rets_per_env += r
+            for env_idx in np.flatnonzero(done):
+                rets.append(rets_per_env[env_idx])
+                termination_steps.append(step + env_idx)
+                rets_per_env[env_idx] = 0
+
+            if step // save_every != (step + num_envs) // save_every or step + num_envs >= n_steps:
+                if friction_schedules is not None:
+                    friction_schedules = list(env.get_attr('schedule_state'))
+                save(step + num_envs, friction_schedules)
+        env.close()
 
     with open(cfg['done_path'], 'w') as f:
         f.write('All done!')
@@ -8,12 +8,64 @@ from lop.nets.ffnn import FFNN
 from lop.nets.linear import MyLinear
 from lop.algos.bp import Backprop
 from lop.algos.cbp import ContinualBackprop
+from lop.algos.ensemble import build_runs, EnsembleBackprop, EnsembleContinualBackprop
+from lop.slowly_changing_regression.slowly_changing_regression import SlowlyChangingRegressionStream
+from lop.utils.packed_bits import PackedBinaryInputs  # inputs of data files generated with data_format: compact
 from lop.utils.miscellaneous import *
 
 
+def make_stream(params, seed):
+    """
+    Stream of the data of one run, generated while learning
+    """
+    return SlowlyChangingRegressionStream(
+        flip_after=int(params['flip_after']),
+        num_data_points=int(params['num_data_points']),
+        num_inputs=params['num_inputs'],
+        num_target_features=params['num_target_features'],
+        num_flipping_bits=params['num_flipping_bits'],
+        beta=params['beta'],
+        flip_one=params.get('flip_one', False),
+        seed=seed,
+    )
+
+
+def ensemble_expr(params, learner, num_runs, stream_data):
+    """
+    num_runs independent runs trained in lockstep by an ensemble learner, each on its own data.
+    The cfg with run_idx i trains the runs i to i + num_runs - 1, run i + n learns from the data file of run i + n or,
+    when the data is generated while learning, from the stream with the seed env_seed + n
+    :return: the data of each run, in the format of a single run
+    """
+    num_data_points = int(params['num_data_points'])
+    if stream_data:
+        streams = [make_stream(params, seed=params['env_seed'] + n) for n in range(num_runs)]
+    else:
+        run_data = []
+        for n in range(num_runs):
+            with open(params['env_data_dir'] + str(params['run_idx'] + n), 'rb+') as f:
+                inputs, outputs, _ = pickle.load(f)
+            run_data.append((inputs, outputs))
+    errs = torch.zeros((num_runs, num_data_points), dtype=torch.float)
+    for i in tqdm(range(num_data_points)):
+        if stream_data:
+            x, y = zip(*[stream.get(i, i+1) for stream in streams])
+        else:
+            x, y = zip(*[(inputs[i: i+1], outputs[i: i+1]) for inputs, outputs in run_data])
+        errs[:, i] = learner.learn(x=torch.stack(x), target=torch.stack(y))
+        if (i + 1) % 100 == 0:
+            wandb.log({"error": errs[:, i].mean()})
+    return [{'errs': errs[n].numpy()} for n in range(num_runs)]
+
+
 def expr(params: {}):
     agent_type = params['agent']
-    env_file = params['env_file']
+    # without a data file, the data is generated while learning
+    env_file = params.get('env_file')
+    stream_data = env_file is None or params.get('stream_data', False)
+    if stream_data and 'env_seed' not in params.keys():
+        # without it, every run would learn from the same data
+        raise ValueError("Generating the data while learning needs the seed of the run's data, env_seed, in the cfg")
     num_data_points = int(params['num_data_points'])
     to_log = False
     to_log_grad = False
@@ -23,6 +75,10 @@ def expr(params: {}):
     weight_decay = 0.0
     accumulate = False
     perturb_scale = 0
+    sparse_input = False
+    compile_step = False
+    chunk_size = 1
+    ensemble = 0
     if 'to_log' in params.keys():
         to_log = params['to_log']
     if 'to_log_grad' in params.keys():
@@ -39,6 +95,14 @@ def expr(params: {}):
         accumulate = params['accumulate']
     if 'perturb_scale' in params.keys():
         perturb_scale = params['perturb_scale']
+    if 'sparse_input' in params.keys():
+        sparse_input = params['sparse_input']
+    if 'compile_step' in params.keys():
+        compile_step = params['compile_step']
+    if 'chunk_size' in params.keys():
+        chunk_size = params['chunk_size']
+    if 'ensemble' in params.keys():
+        ensemble = params['ensemble']
 
     num_inputs = params['num_inputs']
     num_features = params['num_features']
@@ -57,6 +121,41 @@ def expr(params: {}):
     if "init" in params.keys():
         init = params["init"]
 
+    if ensemble > 0:
+        # independent runs trained together with batched matmuls, each with its own network and data
+        if agent_type == 'linear' or to_log or to_log_grad or to_log_activation:
+            raise ValueError('ensemble needs a bp, l2 or cbp agent, without logs')
+        seeds = [params['run_idx'] + n for n in range(ensemble)]
+        nets, generators = build_runs(make_net=lambda: FFNN(input_size=num_inputs, num_features=num_features,
+                                                            hidden_activation=hidden_activation), seeds=seeds)
+        if agent_type == 'cbp':
+            learner = EnsembleContinualBackprop(
+                nets=nets,
+                coeffs=[[0, 0]],
+                repl_rates=[[replacement_rate, 0]],
+                generators=generators,
+                step_size=step_size,
+                opt=opt,
+                decay_rate=decay_rate,
+                maturity_threshold=mt,
+                util_type=util_type,
+                init=init,
+                accumulate=accumulate,
+            )
+        else:
+            learner = EnsembleBackprop(
+                nets=nets,
+                generators=generators,
+                step_size=step_size,
+                opt=opt,
+                beta_1=beta_1,
+                beta_2=beta_2,
+                weight_decay=weight_decay,
+                to_perturb=(perturb_scale > 0),
+                perturb_scale=perturb_scale,
+            )
+        return ensemble_expr(params=params, learner=learner, num_runs=ensemble, stream_data=stream_data)
+
     if agent_type == 'linear':
         net = MyLinear(
             input_size=num_inputs,
@@ -66,6 +165,7 @@ def expr(params: {}):
             input_size=num_inputs,
             num_features=num_features,
             hidden_activation=hidden_activation,
+            sparse_input=sparse_input,
         )
 
     if agent_type == 'bp' or agent_type == 'linear' or agent_type == 'l2':
@@ -79,6 +179,7 @@ def expr(params: {}):
             weight_decay=weight_decay,
             to_perturb=(perturb_scale > 0),
             perturb_scale=perturb_scale,
+            compile_step=compile_step,
         )
     elif agent_type == 'cbp':
         learner = ContinualBackprop(
@@ -92,19 +193,40 @@ def expr(params: {}):
             util_type=util_type,
             init=init,
             accumulate=accumulate,
+            compile_step=compile_step,
         )
 
-    with open(env_file, 'rb+') as f:
-        inputs, outputs, _ = pickle.load(f)
+    if stream_data:
+        data = make_stream(params, seed=params['env_seed'])
+    else:
+        with open(env_file, 'rb+') as f:
+            inputs, outputs, _ = pickle.load(f)
 
     errs = torch.zeros((num_data_points), dtype=torch.float)
     if to_log: weight_mag = torch.zeros((num_data_points, 2), dtype=torch.float)
     if to_log_grad: grad_mag = torch.zeros((num_data_points, 2), dtype=torch.float)
     if to_log_activation: activation = torch.zeros((num_data_points, ), dtype=torch.float)
     
+    # the per-step logs need the network after every step, otherwise chunks of steps are learned with learn_many
+    if chunk_size > 1 and not (to_log or to_log_grad or to_log_activation):
+        for start in tqdm(range(0, num_data_points, chunk_size)):
+            end = min(start + chunk_size, num_data_points)
+            if stream_data:
+                x, y = data.get(start, end)
+            else:
+                x, y = inputs[start: end], outputs[start: end]
+            errs[start: end] = learner.learn_many(xs=x, targets=y)
+            for i in range(start, end):
+                if (i + 1) % 100 == 0:
+                    wandb.log({"error": errs[i]})
+        return {'errs': errs.numpy()}
+
     iter = 0
     for i in tqdm(range(num_data_points)):
-        x, y = inputs[i: i+1], outputs[i: i+1]
+        if stream_data:
+            x, y = data.get(i, i+1)
+        else:
+            x, y = inputs[i: i+1], outputs[i: i+1]
         err = learner.learn(x=x, target=y)
         if to_log:
             weight_mag[i][0] = learner.net.layers[0].weight.data.abs().mean()
@@ -156,9 +278,15 @@ def main(arguments):
     )
     data = expr(params)
 
-    os.makedirs(os.path.dirname(params['data_file']), exist_ok = True)
-    with open(params['data_file'], 'wb+') as f:
-        pickle.dump(data, f)
+    # with ensemble, the data of each run goes to the file of the run, see multi_param_expr.py
+    if isinstance(data, list):
+        data_files = [params['data_dir'] + str(params['run_idx'] + n) for n in range(len(data))]
+    else:
+        data, data_files = [data], [params['data_file']]
+    for run_data, data_file in zip(data, data_files):
+        os.makedirs(os.path.dirname(data_file), exist_ok = True)
+        with open(data_file, 'wb+') as f:
+            pickle.dump(run_data, f)
 
     wandb.finish()
 
@@ -38,6 +38,7 @@ def main(arguments):
             new_cfg_file = 'env_temp_cfg/'+str(idx)+'.json'
             new_params = copy.deepcopy(params)
             new_params['env_file'] = new_params['env_data_dir'] + str(idx)
+            new_params['env_seed'] = idx
             if 'target_net_dir' in new_params.keys():
                 if new_params['target_net_dir'] == '':
                     pass
@@ -70,9 +71,17 @@ def main(arguments):
         bash_command = "mkdir -p " + new_params['data_dir']
         subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
 
-        for idx in tqdm(range(params['num_runs'])):
+        # with ensemble N, the cfg of run idx trains the runs idx to idx + N - 1 together, see expr.py
+        ensemble = 0
+        if 'ensemble' in new_params.keys():
+            ensemble = new_params['ensemble']
+        for idx in tqdm(range(0, params['num_runs'], max(ensemble, 1))):
             new_params['data_file'] = new_params['data_dir'] + str(idx)
             new_params['env_file'] = new_params['env_data_dir'] + str(idx)
+            new_params['run_idx'] = idx
+            new_params['env_seed'] = idx
+            if ensemble > 0:
+                new_params['ensemble'] = min(ensemble, params['num_runs'] - idx)
 
             """
                 write data in config files
@@ -2,9 +2,11 @@ import sys
 import json
 import torch
 import pickle
+import numpy as np
 import argparse
 from tqdm import tqdm
 from lop.nets.fix_ltu_net import FixLTUNet
+from lop.utils.packed_bits import PackedBinaryInputs
 
 
 def generate_problem_data(
@@ -16,10 +18,19 @@ def generate_problem_data(
         num_flipping_bits=None,
         beta=0.75,
         flip_one=False,
+        seed=None,
+        data_format='tensor',
 ):
     """
     Generates data for one run on the slowly changing regression problem
+    With data_format='compact', the inputs are stored as PackedBinaryInputs instead of a float tensor
     """
+    if seed is not None:
+        torch.manual_seed(seed)
+    if data_format == 'compact':
+        return generate_compact_problem_data(
+            flip_after=flip_after, data_file=data_file, num_data_points=num_data_points, num_inputs=num_inputs,
+            num_target_features=num_target_features, num_flipping_bits=num_flipping_bits, beta=beta, flip_one=flip_one)
     target_network = FixLTUNet(
         num_inputs=num_inputs,
         num_features=num_target_features,
@@ -28,14 +39,8 @@ def generate_problem_data(
 
     num_flips = int(num_data_points/flip_after) + 1
     num_data_points = num_flips * flip_after
-    flipping_bits = torch.randint(2, size=(num_flips, num_flipping_bits), dtype=torch.float32)
+    flipping_bits = generate_flipping_bits(num_flips=num_flips, num_flipping_bits=num_flipping_bits, flip_one=flip_one)
     if num_flipping_bits > 0:
-        if flip_one:
-            for i in range(1, num_flips):
-                flipping_bits[i] = flipping_bits[i-1]
-                bit_to_flip = torch.randint(num_flipping_bits, (1, ))
-                flipping_bits[i][bit_to_flip] = 1 - flipping_bits[i-1][bit_to_flip]
-
         flipping_bits = flipping_bits.repeat_interleave(flip_after, dim=0)
         random_bits = torch.randint(2, size=(num_data_points, num_inputs - num_flipping_bits), dtype=torch.float32)
 
@@ -56,6 +61,139 @@ def generate_problem_data(
         pickle.dump(data, f)
 
 
+def generate_flipping_bits(num_flips, num_flipping_bits, flip_one=False, generator=None):
+    """
+    Values of the flipping bits in each of the num_flips segments of flip_after examples
+    """
+    flipping_bits = torch.randint(2, size=(num_flips, num_flipping_bits), dtype=torch.float32, generator=generator)
+    if num_flipping_bits > 0:
+        if flip_one:
+            for i in range(1, num_flips):
+                flipping_bits[i] = flipping_bits[i-1]
+                bit_to_flip = torch.randint(num_flipping_bits, (1, ), generator=generator)
+                flipping_bits[i][bit_to_flip] = 1 - flipping_bits[i-1][bit_to_flip]
+    return flipping_bits
+
+
+def generate_compact_problem_data(
+        flip_after=10000,
+        data_file='data/env_data/0',
+        num_data_points=1000*100,
+        num_inputs=20,
+        num_target_features=20,
+        num_flipping_bits=None,
+        beta=0.75,
+        flip_one=False,
+):
+    """
+    Same data as generate_problem_data, with the inputs generated chunk by chunk and stored as PackedBinaryInputs
+    """
+    stream = SlowlyChangingRegressionStream(
+        flip_after=flip_after, num_data_points=num_data_points, num_inputs=num_inputs,
+        num_target_features=num_target_features, num_flipping_bits=num_flipping_bits, beta=beta, flip_one=flip_one,
+        seed=None,
+    )
+    packed_bits, Y = [], []
+    for start_idx in tqdm(range(0, stream.num_data_points, stream.chunk_size)):
+        x, y = stream.get(start_idx, start_idx + stream.chunk_size)
+        packed_bits.append(np.packbits(x[:, num_flipping_bits:].numpy().astype(np.uint8), axis=1))
+        Y.append(y)
+
+    X = PackedBinaryInputs(
+        flipping_bits=stream.flipping_bits.numpy().astype(np.uint8),
+        flip_after=flip_after,
+        packed_bits=np.concatenate(packed_bits),
+        num_random_bits=num_inputs - num_flipping_bits,
+    )
+    data = X, torch.cat(Y), stream.target_network
+    with open(data_file, 'wb+') as f:
+        pickle.dump(data, f)
+
+
+class SlowlyChangingRegressionStream(object):
+    """
+    Generates the data of generate_problem_data(seed=seed, ...) lazily, chunk_size examples at a time, without a data
+    file. The random numbers are drawn from a generator that continues from the global random state of
+    generate_problem_data after the target network and the flipping bits are created. Random bits are drawn one chunk
+    at a time, which gives the same values as one large draw as the cpu generator produces them sequentially, and the
+    targets are computed in chunks of 10000 like in generate_problem_data, so chunk_size should be a multiple of 10000.
+    The global random state is left as it was, so creating the stream doesn't change the rest of the experiment.
+    With seed=None, the stream starts from the current global random state instead.
+    """
+    def __init__(
+            self,
+            flip_after=10000,
+            num_data_points=1000*100,
+            num_inputs=20,
+            num_target_features=20,
+            num_flipping_bits=None,
+            beta=0.75,
+            flip_one=False,
+            seed=0,
+            chunk_size=10000,
+    ):
+        self.flip_after = flip_after
+        self.num_inputs = num_inputs
+        self.num_flipping_bits = num_flipping_bits
+        self.chunk_size = chunk_size
+
+        global_state = torch.get_rng_state()
+        if seed is not None:
+            torch.manual_seed(seed)
+        self.target_network = FixLTUNet(
+            num_inputs=num_inputs,
+            num_features=num_target_features,
+            beta=beta,
+        )
+        num_flips = int(num_data_points/flip_after) + 1
+        self.num_data_points = num_flips * flip_after
+        self.flipping_bits = generate_flipping_bits(num_flips=num_flips, num_flipping_bits=num_flipping_bits,
+                                                    flip_one=flip_one)
+        self.generator = torch.Generator()
+        self.generator.set_state(torch.get_rng_state())
+        torch.set_rng_state(global_state)
+
+        self.chunk_start = 0
+        self.X, self.Y = self.generate_chunk(start_idx=0)
+
+    def generate_chunk(self, start_idx):
+        """
+        Returns: inputs and targets of examples start_idx to start_idx + chunk_size
+        """
+        end_idx = min(start_idx + self.chunk_size, self.num_data_points)
+        if self.num_flipping_bits > 0:
+            segments = torch.arange(start_idx, end_idx) // self.flip_after
+            random_bits = torch.randint(2, size=(end_idx - start_idx, self.num_inputs - self.num_flipping_bits),
+                                        dtype=torch.float32, generator=self.generator)
+            X = torch.cat((self.flipping_bits[segments], random_bits), dim=1)
+        else:
+            X = torch.randint(2, size=(end_idx - start_idx, self.num_inputs), dtype=torch.float32,
+                              generator=self.generator)
+
+        Y = torch.zeros((end_idx - start_idx, 1), dtype=torch.float)
+        with torch.no_grad():
+            mini_batch_size = 10000
+            for i in range(0, end_idx - start_idx, mini_batch_size):
+                Y[i: i+mini_batch_size], _ = self.target_network.predict(x=X[i: i+mini_batch_size])
+        return X, Y
+
+    def get(self, start_idx, end_idx):
+        """
+        Returns: inputs and targets of examples start_idx to end_idx. Examples have to be read in order, only the
+        current chunk is kept in memory
+        """
+        if start_idx < self.chunk_start:
+            raise ValueError("The stream can only move forward, example " + str(start_idx) + " was already dropped")
+        while end_idx > self.chunk_start + self.X.shape[0] and self.chunk_start + self.X.shape[0] < self.num_data_points:
+            # keep the examples of the current chunk that are still needed
+            X, Y = self.generate_chunk(start_idx=self.chunk_start + self.X.shape[0])
+            keep = start_idx - self.chunk_start
+            self.X, self.Y = torch.cat((self.X[keep:], X)), torch.cat((self.Y[keep:], Y))
+            self.chunk_start = start_idx
+        return self.X[start_idx - self.chunk_start: end_idx - self.chunk_start], \
+            self.Y[start_idx - self.chunk_start: end_idx - self.chunk_start]
+
+
 def main(arguments):
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -86,6 +224,8 @@ def main(arguments):
         num_flipping_bits=params['num_flipping_bits'],
         beta=params['beta'],
         flip_one=params['flip_one'],
+        seed=params.get('env_seed'),
+        data_format=params.get('data_format', 'tensor'),
     )
 
 
@@ -1,5 +1,6 @@
 import torch
 from torch.optim.optimizer import Optimizer
+from lop.utils.miscellaneous import masked_index_copy_
 
 
 class AdamGnT(Optimizer):
@@ -19,6 +20,17 @@ class AdamGnT(Optimizer):
         amsgrad (boolean, optional): whether to use the AMSGrad variant of this
             algorithm from the paper `On the Convergence of Adam and Beyond`_
             (default: False)
+        compact_step (boolean, optional): keep the step counts of weight matrices
+            and filters per output row and per input column instead of per element.
+            The step of an element is the smaller of the two, which is the same as
+            the per element count as long as steps are only reset through
+            reset_steps (default: False)
+        moment_dtype (torch.dtype, optional): dtype used to store exp_avg and
+            exp_avg_sq, e.g. torch.bfloat16. The update is still computed in the
+            dtype of the parameters (default: None, same as the parameters)
+        foreach (boolean, optional): update all parameters of a group together
+            with multi-tensor torch._foreach_* ops. Groups with amsgrad or a
+            moment_dtype use the per parameter loop (default: False)
 
     .. _Adam\: A Method for Stochastic Optimization:
         https://arxiv.org/abs/1412.6980
@@ -27,7 +39,8 @@ class AdamGnT(Optimizer):
     """
 
     def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, compact_step=False, moment_dtype=None,
+                 foreach=False):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
         if not 0.0 <= eps:
@@ -37,13 +50,73 @@ class AdamGnT(Optimizer):
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
         defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay, amsgrad=amsgrad)
+                        weight_decay=weight_decay, amsgrad=amsgrad,
+                        compact_step=compact_step, moment_dtype=moment_dtype, foreach=foreach)
         super(AdamGnT, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         super(AdamGnT, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('compact_step', False)
+            group.setdefault('moment_dtype', None)
+            group.setdefault('foreach', False)
+
+    def reset_steps(self, p, rows=None, cols=None, mask=None):
+        """Sets the step count of some rows and/or columns of a parameter to zero.
+
+        Arguments:
+            p (Tensor): parameter whose step counts are reset
+            rows (LongTensor, optional): indices along the first dimension
+            cols (LongTensor, optional): indices along the second dimension
+            mask (BoolTensor, optional): only the indices where mask is True are reset
+        """
+        state = self.state[p]
+        if 'row_step' in state:
+            row_step, col_step = state['row_step'], state['col_step']
+        else:
+            row_step = col_step = state['step']
+        if mask is not None:
+            if rows is not None:
+                masked_index_copy_(row_step, 0, rows, mask, 0)
+            if cols is not None:
+                masked_index_copy_(col_step, 1, cols, mask, 0)
+            return
+        if rows is not None:
+            row_step[rows] = 0
+        if cols is not None:
+            col_step[:, cols] = 0
+
+    def get_step(self, p):
+        """Returns the step count of every element of a parameter, broadcastable to its shape."""
+        state = self.state[p]
+        if 'row_step' in state:
+            return torch.minimum(state['row_step'], state['col_step'])
+        return state['step']
+
+    def _init_state(self, group, p):
+        state = self.state[p]
+        if group['compact_step'] and p.dim() >= 2:
+            # Step counts per output row and per input column, in a shape that broadcasts against p
+            state['row_step'] = p.data.new_zeros((p.shape[0],) + (1,) * (p.dim() - 1))
+            state['col_step'] = p.data.new_zeros((1, p.shape[1]) + (1,) * (p.dim() - 2))
+        else:
+            # state['step'] = 0
+            state['step'] = torch.zeros_like(p.data)
+        moment_dtype = group['moment_dtype'] or p.dtype
+        # Exponential moving average of gradient values
+        state['exp_avg'] = torch.zeros_like(p.data, dtype=moment_dtype)
+        # Exponential moving average of squared gradient values
+        state['exp_avg_sq'] = torch.zeros_like(p.data, dtype=moment_dtype)
+        if group['amsgrad']:
+            # Maintains max of all exp. moving avg. of sq. grad. values
+            state['max_exp_avg_sq'] = torch.zeros_like(p.data, dtype=moment_dtype)
+
+    def _step_counts(self, p):
+        state = self.state[p]
+        if 'row_step' in state:
+            return [state['row_step'], state['col_step']]
+        return [state['step']]
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -57,56 +130,106 @@ class AdamGnT(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            params = []
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
+                if p.grad.data.is_sparse:
                     raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
-                amsgrad = group['amsgrad']
-
-                state = self.state[p]
-
                 # State initialization
-                if len(state) == 0:
-                    # state['step'] = 0
-                    state['step'] = torch.zeros_like(p.data)
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if amsgrad:
-                        # Maintains max of all exp. moving avg. of sq. grad. values
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                if amsgrad:
-                    max_exp_avg_sq = state['max_exp_avg_sq']
-                beta1, beta2 = group['betas']
-
-                state['step'] += 1
-
-                if group['weight_decay'] != 0:
-                    grad.add_(p.data, alpha=group['weight_decay'])
-
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
-                if amsgrad:
-                    # Maintains the maximum of all 2nd moment running avg. till now
-                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
-                    # Use the max. for normalizing running avg. of gradient
-                    denom = max_exp_avg_sq.sqrt().add_(group['eps'])
-                else:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction = 1 - beta2 ** state['step']
-                # step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-                bias_correction.sqrt().div_(bias_correction1)
-
-                denom.div_(exp_avg)
-
-                # p.data.addcdiv_(-step_size, exp_avg, denom)
-                p.data.addcdiv_(bias_correction, denom, value=-group['lr'])
+                if len(self.state[p]) == 0:
+                    self._init_state(group, p)
+                params.append(p)
+
+            if len(params) == 0:
+                continue
+            if group['foreach'] and not group['amsgrad'] and group['moment_dtype'] is None:
+                self._multi_tensor_step(group, params)
+            else:
+                for p in params:
+                    self._single_tensor_step(group, p)
         return loss
+
+    def _single_tensor_step(self, group, p):
+        grad = p.grad.data
+        amsgrad = group['amsgrad']
+        state = self.state[p]
+
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        if amsgrad:
+            max_exp_avg_sq = state['max_exp_avg_sq']
+        low_precision_moments = exp_avg.dtype != p.dtype
+        if low_precision_moments:
+            exp_avg, exp_avg_sq = exp_avg.to(p.dtype), exp_avg_sq.to(p.dtype)
+            if amsgrad:
+                max_exp_avg_sq = max_exp_avg_sq.to(p.dtype)
+        beta1, beta2 = group['betas']
+
+        for step_count in self._step_counts(p):
+            step_count += 1
+        step = self.get_step(p)
+
+        if group['weight_decay'] != 0:
+            grad.add_(p.data, alpha=group['weight_decay'])
+
+        # Decay the first and second moment running average coefficient
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        if amsgrad:
+            # Maintains the maximum of all 2nd moment running avg. till now
+            torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+            # Use the max. for normalizing running avg. of gradient
+            denom = max_exp_avg_sq.sqrt().add_(group['eps'])
+        else:
+            denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+        if low_precision_moments:
+            state['exp_avg_sq'].copy_(exp_avg_sq)
+            if amsgrad:
+                state['max_exp_avg_sq'].copy_(max_exp_avg_sq)
+
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction = 1 - beta2 ** step
+        # step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+        bias_correction.sqrt().div_(bias_correction1)
+
+        denom.div_(exp_avg)
+        if low_precision_moments:
+            state['exp_avg'].copy_(exp_avg)
+
+        # p.data.addcdiv_(-step_size, exp_avg, denom)
+        p.data.addcdiv_(bias_correction, denom, value=-group['lr'])
+
+    def _multi_tensor_step(self, group, params):
+        """Same update as _single_tensor_step for all parameters of a group at once, using torch._foreach_* ops.
+
+        The result of `bias_correction.sqrt().div_(bias_correction1)` is discarded in the single tensor step, so it is
+        not computed here.
+        """
+        beta1, beta2 = group['betas']
+        grads = [p.grad.data for p in params]
+        params_data = [p.data for p in params]
+        exp_avgs = [self.state[p]['exp_avg'] for p in params]
+        exp_avg_sqs = [self.state[p]['exp_avg_sq'] for p in params]
+
+        torch._foreach_add_([step_count for p in params for step_count in self._step_counts(p)], 1)
+        steps = [self.get_step(p).expand_as(p) for p in params]
+
+        if group['weight_decay'] != 0:
+            torch._foreach_add_(grads, params_data, alpha=group['weight_decay'])
+
+        # Decay the first and second moment running average coefficient
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denoms, group['eps'])
+
+        # bias_correction = 1 - beta2 ** step
+        bias_corrections = torch._foreach_pow(beta2, steps)
+        torch._foreach_neg_(bias_corrections)
+        torch._foreach_add_(bias_corrections, 1)
+
+        torch._foreach_div_(denoms, exp_avgs)
+        torch._foreach_addcdiv_(params_data, bias_corrections, denoms, value=-group['lr'])
@@ -0,0 +1,41 @@
+import torch
+
+
+class InitPool(object):
+    """
+    Pool of pre-generated rows of input weights for new features, drawn from U(-bound, bound).
+    The pool lives on the device of the layer and is refilled in bulk with its own generator, so replacing features
+    only copies a slice of the pool instead of allocating and transferring a new tensor.
+    """
+    def __init__(self, row_shape, bound, pool_size=1000, device='cpu', seed=None, generator=None):
+        self.row_shape = tuple(row_shape)
+        self.bound = bound
+        self.pool_size = pool_size
+        self.device = device
+        """
+        The generator is seeded from the given or the global random number generator, so runs with a fixed seed are
+        reproducible
+        """
+        if seed is None:
+            seed = int(torch.randint(0, 2 ** 62, (1,), generator=generator).item())
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+        self.rows = torch.empty((pool_size,) + self.row_shape, device=device)
+        self.position = pool_size
+
+    def refill(self):
+        self.rows.uniform_(-self.bound, self.bound, generator=self.generator)
+        self.position = 0
+
+    def take(self, num_rows):
+        """
+        Returns: num_rows new rows of weights. The rows are a view into the pool and are only valid until the next call
+        """
+        if num_rows > self.pool_size:
+            return torch.empty((num_rows,) + self.row_shape, device=self.device).uniform_(
+                -self.bound, self.bound, generator=self.generator)
+        if self.position + num_rows > self.pool_size:
+            self.refill()
+        rows = self.rows[self.position: self.position + num_rows]
+        self.position += num_rows
+        return rows
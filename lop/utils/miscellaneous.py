@@ -112,6 +112,56 @@ def nll_accuracy(out, yb):
     return (predictions == yb).float().mean()
 
 
+class MetricBuffer(object):
+    """
+    Preallocated buffer for per-step metrics that stay on the device until they are flushed.
+    Recording a metric is a device-side copy, so it does not wait for the step to finish; only flush copies to the host.
+    """
+    def __init__(self, num_steps, shape=(), device='cpu', dtype=torch.float):
+        self.buffer = torch.zeros((num_steps,) + tuple(shape), dtype=dtype, device=device)
+        self.position = 0
+
+    def record(self, value):
+        self.buffer[self.position] = value
+        self.position += 1
+
+    def flush(self):
+        """
+        :return: the metrics recorded since the last flush, on the cpu
+        """
+        values = self.buffer[:self.position].cpu()
+        self.position = 0
+        return values
+
+
+def bounded_topk(scores: torch.Tensor, eligible: torch.Tensor, k, k_max: int):
+    """
+    Fixed-shape version of topk(scores[eligible], k), for a k that is only known on the device
+    :param scores: 1-d tensor of scores
+    :param eligible: boolean mask of the entries that can be selected
+    :param k: number of entries to select, a python number or a 0-d tensor; at most k_max entries are selected
+    :param k_max: number of returned indices
+    :return: indices of the k_max largest eligible scores, mask of the indices that are actually selected
+    """
+    k_max = min(k_max, scores.shape[0])
+    values, indices = torch.topk(torch.where(eligible, scores, -math.inf), k_max)
+    selected = (torch.arange(k_max, device=scores.device) < k) & (values > -math.inf)
+    return indices, selected
+
+
+def masked_index_copy_(tensor: torch.Tensor, dim: int, index: torch.Tensor, mask: torch.Tensor, source):
+    """
+    tensor.index_copy_(dim, index, source), but only for the entries of index where mask is True, and without reading
+    the mask on the host. index must not contain duplicates.
+    :param source: tensor of the shape of tensor.index_select(dim, index), or a scalar
+    """
+    shape = [1] * tensor.dim()
+    shape[dim] = -1
+    current = tensor.index_select(dim, index)
+    tensor.index_copy_(dim, index, torch.where(mask.view(shape), source, current).to(tensor.dtype))
+    return tensor
+
+
 def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
     assert inputs.shape[0] == targets.shape[0]
     if shuffle:
@@ -140,22 +190,58 @@ def get_layer_bound(layer, init, gain):
         return bound
 
 
-def compute_matrix_rank_summaries(m: torch.Tensor, prop=0.99, use_scipy=False):
+def compute_singular_values(m: torch.Tensor, use_scipy=False, method='svd', driver=None):
+    """
+    Computes the singular values of a matrix, or of a batch of matrices
+    :param m: (float torch Tensor) a rectangular matrix, or a batch of matrices with shape (..., n, d)
+    :param use_scipy: (bool) compute the singular values with scipy in the cpu, only matters when using a gpu
+    :param method: (str) 'svd' or 'gram'. 'gram' takes the square roots of the eigenvalues of m^T m or m m^T, whichever
+                         is smaller. It is much faster, but loses precision for singular values smaller than about
+                         sqrt(eps) times the largest one
+    :param driver: (str) lapack driver for scipy (default gesvd), or cusolver driver for torch.linalg.svdvals on a gpu
+    :return: (float torch Tensor) singular values in descending order, with shape (..., min(n, d))
+    """
+    if method == 'gram':
+        if m.shape[-2] >= m.shape[-1]:
+            gram = m.transpose(-2, -1) @ m
+        else:
+            gram = m @ m.transpose(-2, -1)
+        eigenvalues = torch.linalg.eigvalsh(gram)
+        return torch.flip(eigenvalues.clamp(min=0).sqrt(), dims=(-1,))
+    if use_scipy:
+        np_m = m.cpu().numpy()
+        driver = "gesvd" if driver is None else driver
+        if np_m.ndim == 2:
+            sv = svd(np_m, compute_uv=False, lapack_driver=driver)
+        else:
+            sv = np.stack([svd(matrix, compute_uv=False, lapack_driver=driver)
+                           for matrix in np_m.reshape((-1,) + np_m.shape[-2:])]).reshape(np_m.shape[:-2] + (-1,))
+        return torch.tensor(sv, device=m.device)
+    if driver is not None and m.is_cuda:
+        return torch.linalg.svdvals(m, driver=driver)
+    return torch.linalg.svdvals(m)    # for large matrices, svdvals may fail to converge in gpu, but not cpu
+
+
+def compute_matrix_rank_summaries(m: torch.Tensor, prop=0.99, use_scipy=False, method='svd', driver=None):
     """
     Computes the rank, effective rank, and approximate rank of a matrix
     Refer to the corresponding functions for their definitions
-    :param m: (float np array) a rectangular matrix
+    :param m: (float np array) a rectangular matrix, or a batch of matrices with shape (..., n, d)
     :param prop: (float) proportion used for computing the approximate rank
     :param use_scipy: (bool) indicates whether to compute the singular values in the cpu, only matters when using
                                   a gpu
-    :return: (torch int32) rank, (torch float32) effective rank, (torch int32) approximate rank
+    :param method: (str) how to compute the singular values, see compute_singular_values
+    :param driver: (str) lapack or cusolver driver, see compute_singular_values
+    :return: (torch int32) rank, (torch float32) effective rank, (torch int32) approximate rank,
+             each with the batch shape of m
     """
-    if use_scipy:
-        np_m = m.cpu().numpy()
-        sv = torch.tensor(svd(np_m, compute_uv=False, lapack_driver="gesvd"), device=m.device)
+    sv = compute_singular_values(m, use_scipy=use_scipy, method=method, driver=driver)
+    if method == 'gram':
+        # eigenvalues of the gram matrix that are zero in exact arithmetic are not exactly zero
+        tolerance = sv[..., :1] * max(m.shape[-2:]) * torch.finfo(sv.dtype).eps
+        rank = (sv > tolerance).sum(dim=-1).to(torch.int32)
     else:
-        sv = torch.linalg.svdvals(m)    # for large matrices, svdvals may fail to converge in gpu, but not cpu
-    rank = torch.count_nonzero(sv).to(torch.int32)
+        rank = torch.count_nonzero(sv, dim=-1).to(torch.int32)
     effective_rank = compute_effective_rank(sv)
     approximate_rank = compute_approximate_rank(sv, prop=prop)
     approximate_rank_abs = compute_abs_approximate_rank(sv, prop=prop)
@@ -166,49 +252,47 @@ def compute_effective_rank(sv: torch.Tensor):
     """
     Computes the effective rank as defined in this paper: https://ieeexplore.ieee.org/document/7098875/
     When computing the shannon entropy, 0 * log 0 is defined as 0
-    :param sv: (float torch Tensor) an array of singular values
+    :param sv: (float torch Tensor) an array of singular values, or a batch of arrays with shape (..., k)
     :return: (float torch Tensor) the effective rank
     """
-    norm_sv = sv / torch.sum(torch.abs(sv))
-    entropy = torch.tensor(0.0, dtype=torch.float32, device=sv.device)
-    for p in norm_sv:
-        if p > 0.0:
-            entropy -= p * torch.log(p)
+    norm_sv = sv / torch.sum(torch.abs(sv), dim=-1, keepdim=True)
+    positive = norm_sv > 0.0
+    entropy = -torch.where(positive, norm_sv * torch.log(torch.where(positive, norm_sv, 1.0)), 0.0).sum(dim=-1)
 
     effective_rank = torch.tensor(np.e) ** entropy
     return effective_rank.to(torch.float32)
 
 
+def _approximate_rank(sv: torch.Tensor, prop=0.99):
+    """
+    Smallest number of the largest values of sv whose sum is at least prop of the total
+    """
+    total = torch.sum(sv, dim=-1, keepdim=True)
+    normed_sv = torch.flip(torch.sort(sv / torch.where(total > 0, total, 1.0), dim=-1)[0], dims=(-1,))
+    cumulative_sum = torch.cumsum(normed_sv, dim=-1)
+    prop = torch.full(cumulative_sum.shape[:-1] + (1,), prop, dtype=cumulative_sum.dtype, device=sv.device)
+    approximate_rank = torch.searchsorted(cumulative_sum.contiguous(), prop).squeeze(-1) + 1
+    # all-zero singular values have approximate rank 1, like the rank computed with python loops
+    approximate_rank = torch.where(total.squeeze(-1) > 0, approximate_rank.clamp(max=sv.shape[-1]), 1)
+    return approximate_rank.to(torch.int32)
+
+
 def compute_approximate_rank(sv: torch.Tensor, prop=0.99):
     """
     Computes the approximate rank as defined in this paper: https://arxiv.org/pdf/1909.12255.pdf
-    :param sv: (float np array) an array of singular values
+    :param sv: (float np array) an array of singular values, or a batch of arrays with shape (..., k)
     :param prop: (float) proportion of the variance captured by the approximate rank
     :return: (torch int 32) approximate rank
     """
-    sqrd_sv = sv ** 2
-    normed_sqrd_sv = torch.flip(torch.sort(sqrd_sv / torch.sum(sqrd_sv))[0], dims=(0,))   # descending order
-    cumulative_ns_sv_sum = 0.0
-    approximate_rank = 0
-    while cumulative_ns_sv_sum < prop:
-        cumulative_ns_sv_sum += normed_sqrd_sv[approximate_rank]
-        approximate_rank += 1
-    return torch.tensor(approximate_rank, dtype=torch.int32)
+    return _approximate_rank(sv ** 2, prop=prop)
 
 
 def compute_abs_approximate_rank(sv: torch.Tensor, prop=0.99):
     """
     Computes the approximate rank as defined in this paper, just that we won't be squaring the singular values
     https://arxiv.org/pdf/1909.12255.pdf
-    :param sv: (float np array) an array of singular values
+    :param sv: (float np array) an array of singular values, or a batch of arrays with shape (..., k)
     :param prop: (float) proportion of the variance captured by the approximate rank
     :return: (torch int 32) approximate rank
     """
-    sqrd_sv = sv
-    normed_sqrd_sv = torch.flip(torch.sort(sqrd_sv / torch.sum(sqrd_sv))[0], dims=(0,))   # descending order
-    cumulative_ns_sv_sum = 0.0
-    approximate_rank = 0
-    while cumulative_ns_sv_sum < prop:
-        cumulative_ns_sv_sum += normed_sqrd_sv[approximate_rank]
-        approximate_rank += 1
-    return torch.tensor(approximate_rank, dtype=torch.int32)
+    return _approximate_rank(sv, prop=prop)
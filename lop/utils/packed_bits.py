@@ -0,0 +1,29 @@
+import torch
+import numpy as np
+
+
+class PackedBinaryInputs(object):
+    """
+    Inputs of the slowly changing regression problem, stored with one bit per input.
+    The flipping bits only change every flip_after examples, so they are kept once per segment, and the random bits
+    are packed with np.packbits. Slicing, e.g. X[i: i+1], unpacks the requested examples into a float tensor, so the
+    object can be used in place of the float tensor of inputs.
+    """
+    def __init__(self, flipping_bits, flip_after, packed_bits, num_random_bits):
+        self.flipping_bits = flipping_bits
+        self.flip_after = flip_after
+        self.packed_bits = packed_bits
+        self.num_random_bits = num_random_bits
+        self.shape = (packed_bits.shape[0], flipping_bits.shape[1] + num_random_bits)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            rows = np.arange(*idx.indices(self.shape[0]))
+        else:
+            rows = np.asarray(idx)
+        random_bits = np.unpackbits(self.packed_bits[rows], axis=-1, count=self.num_random_bits)
+        flipping_bits = self.flipping_bits[rows // self.flip_after]
+        return torch.from_numpy(np.concatenate((flipping_bits, random_bits), axis=-1).astype(np.float32))
@@ -0,0 +1,117 @@
+import torch
+from lop.utils.miscellaneous import compute_matrix_rank_summaries
+
+
+class FrequentDirections(object):
+    """
+    Frequent Directions sketch (Liberty, 2013) of the activations of a layer, updated from the mini-batches seen during
+    training. The sketch B has at most sketch_size rows and satisfies 0 <= A^T A - B^T B <= ||A||_F^2 / sketch_size * I,
+    where A is the matrix of all the activations added since the last reset, so the singular values of B approximate the ones of A
+    without storing A or computing its SVD.
+    With decay < 1, A^T A is an exponential moving sum instead, each update multiplies the older rows by sqrt(decay).
+    The decay is kept in a scalar scale, the sketch is scale times the stored rows, and it is only folded into the rows
+    when the sketch is shrunk, so an update costs the same with and without decay.
+    The Frobenius norm of A and the number of times each unit was active are tracked exactly, over the same
+    activations and with the same decay as the sketch.
+    """
+    def __init__(self, num_features, sketch_size=64, decay=1.0, device='cpu'):
+        self.num_features = num_features
+        self.sketch_size = sketch_size
+        self.decay = decay
+        # rows sketch_size to 2 * sketch_size - 1 are filled before each shrink, so one SVD is amortized over
+        # sketch_size rows
+        self.sketch = torch.zeros((2 * sketch_size, num_features), device=device)
+        self.num_rows = 0
+        self.scale = 1.0
+        self.min_scale = 1e-10
+        self.squared_frobenius_norm = torch.zeros((), device=device)
+        self.active_counts = torch.zeros(num_features, device=device)
+        self.num_examples = 0
+
+    def update(self, activations: torch.Tensor):
+        """
+        Add a mini-batch of activations (mini-batch * num_features) to the sketch
+        """
+        with torch.no_grad():
+            activations = activations.detach().reshape(-1, self.num_features).to(self.sketch.dtype)
+            if self.decay < 1:
+                self.scale *= self.decay ** 0.5
+                if self.scale < self.min_scale:
+                    self.fold_scale()
+                self.squared_frobenius_norm *= self.decay
+                self.active_counts *= self.decay
+            self.squared_frobenius_norm += activations.pow(2).sum()
+            self.active_counts += (activations != 0).sum(dim=0)
+            self.num_examples += activations.shape[0]
+
+            start = 0
+            while start < activations.shape[0]:
+                if self.num_rows == self.sketch.shape[0]:
+                    self.shrink()
+                num_new_rows = min(activations.shape[0] - start, self.sketch.shape[0] - self.num_rows)
+                self.sketch[self.num_rows: self.num_rows + num_new_rows] = \
+                    activations[start: start + num_new_rows] / self.scale
+                self.num_rows += num_new_rows
+                start += num_new_rows
+
+    def fold_scale(self):
+        """
+        Multiply the stored rows by the scale
+        """
+        self.sketch[:self.num_rows] *= self.scale
+        self.scale = 1.0
+
+    def rows(self):
+        """
+        :return: the rows of the sketch
+        """
+        return self.scale * self.sketch[:self.num_rows]
+
+    def shrink(self):
+        """
+        Subtract the sketch_size-th largest squared singular value from all of them, which leaves at most
+        sketch_size - 1 nonzero rows
+        """
+        self.fold_scale()
+        _, sv, vh = torch.linalg.svd(self.sketch[:self.num_rows], full_matrices=False)
+        delta = sv[self.sketch_size - 1] ** 2 if sv.shape[0] >= self.sketch_size else sv.new_zeros(())
+        shrunk_sv = (sv[:self.sketch_size] ** 2 - delta).clamp(min=0).sqrt()
+        self.sketch.zero_()
+        self.sketch[:shrunk_sv.shape[0]] = shrunk_sv.unsqueeze(1) * vh[:self.sketch_size]
+        self.num_rows = self.sketch_size
+
+    def singular_values(self):
+        """
+        :return: approximate singular values of the matrix of activations, in descending order
+        """
+        return torch.linalg.svdvals(self.rows())
+
+    def rank_summaries(self, prop=0.99):
+        """
+        :return: rank, effective rank, approximate rank and abs approximate rank of the sketch, see
+                 lop.utils.miscellaneous.compute_matrix_rank_summaries
+        """
+        return compute_matrix_rank_summaries(self.rows(), prop=prop)
+
+    def stable_rank(self):
+        """
+        :return: ||A||_F^2 / ||A||_2^2, with the spectral norm of A estimated from the sketch
+        """
+        return self.squared_frobenius_norm / self.singular_values()[0] ** 2
+
+    def dead_units(self):
+        """
+        :return: number of units that were not active for any of the examples added since the last reset
+        """
+        return (self.active_counts == 0).sum()
+
+    def reset(self):
+        """
+        Forget all the activations added so far, the sketch, its Frobenius norm and the active counts start over
+        """
+        self.sketch.zero_()
+        self.num_rows = 0
+        self.scale = 1.0
+        self.squared_frobenius_norm.zero_()
+        self.active_counts.zero_()
+        self.num_examples = 0
@@ -0,0 +1,56 @@
+import torch
+from lop.utils.AdamGnT import AdamGnT
+
+
+def run_adam(num_steps=30, **kwargs):
+    """
+    Adam steps on a linear layer and a conv layer with random gradients, resetting the steps of some features every
+    few steps like generate-and-test does
+    """
+    generator = torch.Generator().manual_seed(0)
+    shapes = [(8, 5), (8,), (3, 8), (4, 3, 2, 2), (4,)]
+    params = [torch.randn(shape, generator=generator).requires_grad_() for shape in shapes]
+    opt = AdamGnT(params, lr=0.01, **kwargs)
+    for step in range(num_steps):
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=generator)
+        opt.step()
+        if step % 4 == 3:
+            features = torch.randperm(8, generator=generator)[:2]
+            opt.reset_steps(params[0], rows=features)
+            opt.reset_steps(params[1], rows=features)
+            opt.reset_steps(params[2], cols=features)
+            filters = torch.randperm(4, generator=generator)[:1]
+            opt.reset_steps(params[3], rows=filters)
+            opt.reset_steps(params[4], rows=filters)
+    return params, opt
+
+
+def assert_same_steps(params, opt, other_params, other_opt, **kwargs):
+    for p, other_p in zip(params, other_params):
+        torch.testing.assert_close(p, other_p, **kwargs)
+        torch.testing.assert_close(opt.get_step(p).expand_as(p), other_opt.get_step(other_p).expand_as(other_p))
+        for key in ['exp_avg', 'exp_avg_sq']:
+            torch.testing.assert_close(opt.state[p][key], other_opt.state[other_p][key], **kwargs)
+
+
+def test_compact_step_matches_per_element_steps():
+    params, opt = run_adam()
+    compact_params, compact_opt = run_adam(compact_step=True)
+    assert 'row_step' in compact_opt.state[compact_params[0]]
+    assert_same_steps(params, opt, compact_params, compact_opt, rtol=0, atol=0)
+
+
+def test_low_precision_moments_stay_close():
+    params, opt = run_adam()
+    bf16_params, bf16_opt = run_adam(moment_dtype=torch.bfloat16)
+    assert bf16_opt.state[bf16_params[0]]['exp_avg'].dtype == torch.bfloat16
+    for p, bf16_p in zip(params, bf16_params):
+        torch.testing.assert_close(p, bf16_p, rtol=0, atol=0.05)
+
+
+def test_foreach_matches_single_tensor_step():
+    params, opt = run_adam()
+    for compact_step in [False, True]:
+        foreach_params, foreach_opt = run_adam(foreach=True, compact_step=compact_step)
+        assert_same_steps(params, opt, foreach_params, foreach_opt)
@@ -0,0 +1,81 @@
+import torch
+import numpy as np
+import collections as c
+from lop.algos.rl.buffer import Buffer
+
+
+class ListBuffer(object):
+    """
+    The rollout buffer as it was before it was backed by arrays, with a deque per field
+    """
+    def __init__(self, o_dim, a_dim, bs):
+        self.o_dim, self.a_dim, self.bs = o_dim, a_dim, bs
+        self.o_buf, self.a_buf, self.r_buf, self.logpb_buf, self.distb_buf, self.done_buf = \
+            c.deque(), c.deque(), c.deque(), c.deque(), c.deque(), c.deque()
+        self.op = np.zeros((1, o_dim), dtype=np.float32)
+
+    def store(self, o, a, r, op, logpb, dist, done):
+        self.o_buf.append(o)
+        self.a_buf.append(a)
+        self.r_buf.append(r)
+        self.logpb_buf.append(logpb)
+        self.distb_buf.append(dist)
+        self.done_buf.append(float(done))
+        self.op[:] = op
+
+    def pop(self):
+        for buf in [self.o_buf, self.a_buf, self.r_buf, self.logpb_buf, self.distb_buf, self.done_buf]:
+            buf.popleft()
+
+    def clear(self):
+        for buf in [self.o_buf, self.a_buf, self.r_buf, self.logpb_buf, self.distb_buf, self.done_buf]:
+            buf.clear()
+
+    def get(self, dist_stack):
+        rang = range(self.bs)
+        os = torch.as_tensor(np.array([self.o_buf[i] for i in rang]), dtype=torch.float32).view(-1, self.o_dim)
+        acts = torch.as_tensor(np.array([self.a_buf[i] for i in rang]), dtype=torch.float32).view(-1, self.a_dim)
+        rs = torch.as_tensor(np.array([self.r_buf[i] for i in rang]), dtype=torch.float32).view(-1, 1)
+        op = torch.as_tensor(self.op).view(-1, self.o_dim)
+        logpbs = torch.as_tensor(np.array([self.logpb_buf[i] for i in rang]), dtype=torch.float32).view(-1, 1)
+        distbs = dist_stack([self.distb_buf[i] for i in rang], device='cpu')
+        dones = torch.as_tensor(np.array([self.done_buf[i] for i in rang]), dtype=torch.float32).view(-1, 1)
+        return os, acts, rs, op, logpbs, distbs, dones
+
+
+def dist_stack(dists, device='cpu'):
+    return torch.as_tensor(np.array(dists), dtype=torch.float32, device=device).view(-1, 4)
+
+
+def test_buffer_matches_list_buffer():
+    o_dim, a_dim, bs = 3, 2, 4
+    rng = np.random.default_rng(0)
+    buf, list_buf = Buffer(o_dim, a_dim, bs), ListBuffer(o_dim, a_dim, bs)
+
+    def store(num_transitions):
+        for _ in range(num_transitions):
+            transition = (rng.standard_normal(o_dim), rng.standard_normal(a_dim), rng.standard_normal(),
+                          rng.standard_normal(o_dim), rng.standard_normal((1, 1)), rng.standard_normal(2 * a_dim),
+                          rng.random() < 0.3)
+            buf.store(*transition)
+            list_buf.store(*transition)
+
+    def check():
+        for x, list_x in zip(buf.get(dist_stack), list_buf.get(dist_stack)):
+            assert x.shape == list_x.shape
+            assert torch.equal(x, list_x)
+
+    # a full rollout, episodic updates that store more than bs transitions and pop the oldest one, and a clear
+    store(bs)
+    check()
+    store(3)
+    for _ in range(5):
+        buf.pop()
+        list_buf.pop()
+        check()
+        store(2)
+    check()
+    buf.clear()
+    list_buf.clear()
+    store(bs)
+    check()
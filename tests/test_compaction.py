@@ -0,0 +1,56 @@
+import torch
+import torch.nn.functional as F
+from lop.nets.deep_ffnn import DeepFFNN
+
+
+def make_nets():
+    """
+    The same network with and without compaction, where a third of the units of the first hidden layer never fire
+    """
+    nets = []
+    for compact_dead_units in [False, True]:
+        torch.manual_seed(0)
+        net = DeepFFNN(input_size=6, num_features=12, num_outputs=2, num_hidden_layers=2,
+                       compact_dead_units=compact_dead_units, compaction_window=3, compaction_period=2)
+        with torch.no_grad():
+            net.in_layer.fc.weight[:4] = 0
+            net.in_layer.fc.bias[:4] = -1
+        nets.append(net)
+    return nets
+
+
+def step(net, opt, x, target):
+    output, features = net.predict(x)
+    loss = F.mse_loss(output, target)
+    opt.zero_grad()
+    loss.backward()
+    grads = [p.grad.clone() for p in net.parameters()]
+    opt.step()
+    return output.detach(), [f.detach() for f in features], grads
+
+
+def test_compaction_matches_dense_forward_and_backward():
+    dense_net, compact_net = make_nets()
+    dense_opt = torch.optim.SGD(dense_net.parameters(), lr=0.1)
+    compact_opt = torch.optim.SGD(compact_net.parameters(), lr=0.1)
+    generator = torch.Generator().manual_seed(1)
+    for i in range(20):
+        if i == 12:
+            # revive a dead unit, the compacted step has to notice it before it is gathered out
+            with torch.no_grad():
+                for net in [dense_net, compact_net]:
+                    net.in_layer.fc.bias[0] = 1
+        x = torch.randn(5, 6, generator=generator)
+        target = torch.randn(5, 2, generator=generator)
+        dense_output, dense_features, dense_grads = step(dense_net, dense_opt, x, target)
+        compact_output, compact_features, compact_grads = step(compact_net, compact_opt, x, target)
+        torch.testing.assert_close(compact_output, dense_output)
+        for compact_f, dense_f in zip(compact_features, dense_features):
+            torch.testing.assert_close(compact_f, dense_f)
+        for compact_g, dense_g in zip(compact_grads, dense_grads):
+            torch.testing.assert_close(compact_g, dense_g)
+        if i == 11:
+            assert compact_net.compaction.dead_units[0] is not None
+            assert 0 in compact_net.compaction.dead_units[0].tolist()
+    dead_units = compact_net.compaction.dead_units[0]
+    assert dead_units is None or 0 not in dead_units.tolist()
@@ -0,0 +1,54 @@
+import torch
+from lop.nets.ffnn import FFNN
+from lop.algos.bp import Backprop
+from lop.algos.cbp import ContinualBackprop
+from lop.utils.AdamGnT import AdamGnT
+
+
+def test_compiled_adam_gnt_step_does_not_recompile_after_step_resets():
+    generator = torch.Generator().manual_seed(0)
+    params = [torch.randn(8, 5, generator=generator).requires_grad_(), torch.randn(8, generator=generator).requires_grad_()]
+    for compact_step in [False, True]:
+        torch._dynamo.reset()
+        opt = AdamGnT(params, lr=0.01, compact_step=compact_step)
+        opt_step = torch.compile(opt.step, backend='eager')
+        # the first steps initialize the state, which the compiled step is specialized on
+        for _ in range(2):
+            for p in params:
+                p.grad = torch.randn(p.shape, generator=generator)
+            opt_step()
+        with torch._dynamo.config.patch(error_on_recompile=True):
+            for i in range(4):
+                features = torch.tensor([i, i + 2])
+                opt.reset_steps(params[0], rows=features)
+                opt.reset_steps(params[1], rows=features)
+                for p in params:
+                    p.grad = torch.randn(p.shape, generator=generator)
+                opt_step()
+        assert (opt.get_step(params[0]) < 6).any()
+
+
+def test_learn_many_matches_learn():
+    generator = torch.Generator().manual_seed(0)
+    xs = torch.randn(40, 10, generator=generator)
+    targets = torch.randn(40, 1, generator=generator)
+    for agent_type in ['bp', 'cbp']:
+        nets, all_losses = [], []
+        for use_learn_many in [False, True]:
+            torch.manual_seed(1)
+            net = FFNN(input_size=10, num_features=12)
+            if agent_type == 'cbp':
+                learner = ContinualBackprop(net=net, coeffs=[[0, 0]], repl_rates=[[0.05, 0]], step_size=0.01,
+                                            opt='adam', maturity_threshold=5)
+            else:
+                learner = Backprop(net=net, step_size=0.01, opt='adam')
+            if use_learn_many:
+                losses = learner.learn_many(xs, targets, mini_batch_size=4)
+            else:
+                losses = torch.stack([learner.learn(x=xs[i: i + 4], target=targets[i: i + 4])
+                                      for i in range(0, 40, 4)])
+            nets.append(net)
+            all_losses.append(losses)
+        torch.testing.assert_close(all_losses[0], all_losses[1], rtol=0, atol=0)
+        for p, other_p in zip(nets[0].parameters(), nets[1].parameters()):
+            torch.testing.assert_close(p, other_p, rtol=0, atol=0)
@@ -0,0 +1,62 @@
+import torch
+from lop.nets.ffnn import FFNN
+from lop.algos.bp import Backprop
+from lop.algos.cbp import ContinualBackprop
+from lop.algos.ensemble import build_runs, EnsembleBackprop, EnsembleContinualBackprop
+
+
+def make_net():
+    return FFNN(input_size=10, num_features=12, hidden_activation='tanh')
+
+
+def learner_kwargs(agent_type):
+    if agent_type == 'cbp':
+        return dict(coeffs=[[0, 0]], repl_rates=[[0.05, 0]], step_size=0.01, opt='adam', decay_rate=0.9,
+                    maturity_threshold=5)
+    return dict(step_size=0.01, opt='adam')
+
+
+def run_single(agent_type, seed, xs, targets):
+    """
+    A single run seeded with torch.manual_seed(seed), as in the experiments
+    """
+    torch.manual_seed(seed)
+    net = make_net()
+    if agent_type == 'cbp':
+        learner = ContinualBackprop(net=net, **learner_kwargs(agent_type))
+    else:
+        learner = Backprop(net=net, **learner_kwargs(agent_type))
+    losses = torch.stack([learner.learn(x=x, target=target) for x, target in zip(xs, targets)])
+    return net, losses
+
+
+def run_ensemble(agent_type, seeds, xs, targets):
+    nets, generators = build_runs(make_net=make_net, seeds=seeds)
+    if agent_type == 'cbp':
+        learner = EnsembleContinualBackprop(nets=nets, generators=generators, **learner_kwargs(agent_type))
+    else:
+        learner = EnsembleBackprop(nets=nets, generators=generators, **learner_kwargs(agent_type))
+    losses = torch.stack([learner.learn(x=x, target=target) for x, target in zip(xs, targets)])
+    return learner, losses
+
+
+def test_ensemble_runs_match_single_runs():
+    # in double precision, the different rounding of the batched matrix multiplications can't change a replacement
+    default_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float64)
+    try:
+        seeds = [3, 7]
+        generator = torch.Generator().manual_seed(0)
+        xs = torch.randint(2, size=(100, len(seeds), 1, 10), generator=generator).double()
+        targets = torch.randn(100, len(seeds), 1, 1, generator=generator, dtype=torch.float64)
+        for agent_type in ['bp', 'cbp']:
+            ensemble, ensemble_losses = run_ensemble(agent_type, seeds, xs, targets)
+            for n, seed in enumerate(seeds):
+                net, losses = run_single(agent_type, seed, xs[:, n], targets[:, n])
+                torch.testing.assert_close(ensemble_losses[:, n], losses)
+                for p, ensemble_p in zip(net.parameters(), ensemble.net.nets[n].parameters()):
+                    torch.testing.assert_close(p, ensemble_p)
+            if agent_type == 'cbp':
+                assert any((gnt.ages[0] < 100).any() for gnt in ensemble.gnts)
+    finally:
+        torch.set_default_dtype(default_dtype)
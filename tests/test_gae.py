@@ -0,0 +1,30 @@
+import torch
+from lop.algos.rl.ppo import gae_advantages
+
+
+def loop_advantages(rs, dones, vals, g, lm):
+    """
+    The reverse loop that computed the advantages before they were vectorized
+    """
+    advs = torch.zeros(len(rs) + 1)
+    for t in reversed(range(len(rs))):
+        delta = rs[t] + (1 - dones[t]) * g * vals[t + 1] - vals[t]
+        advs[t] = delta + (1 - dones[t]) * g * lm * advs[t + 1]
+    return advs[:-1]
+
+
+def test_vectorized_gae_matches_loop():
+    generator = torch.Generator().manual_seed(0)
+    g, lm = 0.99, 0.95
+    for num_steps in [1, 10, 64, 150]:
+        for done_prob in [0.0, 0.05, 1.0]:
+            rs = torch.randn(num_steps, 3, generator=generator)
+            dones = (torch.rand(num_steps, 3, generator=generator) < done_prob).float()
+            vals = torch.randn(num_steps + 1, 3, generator=generator)
+            advs = gae_advantages(rs, dones, vals, g=g, lm=lm)
+            assert advs.shape == rs.shape
+            for env_idx in range(3):
+                expected = loop_advantages(rs[:, env_idx], dones[:, env_idx], vals[:, env_idx], g, lm)
+                torch.testing.assert_close(advs[:, env_idx], expected, rtol=1e-5, atol=1e-5)
+            # a single environment, with one dimension less
+            torch.testing.assert_close(gae_advantages(rs[:, 0], dones[:, 0], vals[:, 0], g=g, lm=lm), advs[:, 0])
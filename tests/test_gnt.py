@@ -0,0 +1,76 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from lop.algos.gnt import GnT
+from lop.algos.fused_gnt import FusedGnT
+from lop.utils.AdamGnT import AdamGnT
+
+
+def make_net(activation=nn.ReLU):
+    torch.manual_seed(0)
+    return nn.Sequential(nn.Linear(6, 16), activation(), nn.Linear(16, 16), activation(), nn.Linear(16, 1))
+
+
+def run_gnt(net, gnt_class, opt='sgd', num_steps=200, **kwargs):
+    """
+    Train net with a generate-and-test step after every gradient step, the data comes from its own generator and the
+    generate-and-test object draws from the global one, which is seeded the same for every run
+    """
+    if opt == 'adam':
+        optimizer = AdamGnT(net.parameters(), lr=0.01)
+    else:
+        optimizer = torch.optim.SGD(net.parameters(), lr=0.01)
+    gnt = gnt_class(net=net, hidden_activations='relu', opt=optimizer, coeffs=[[0, 0], [0, 0]],
+                    repl_rates=[[0.02, 0.01], [0.05, 0.02]], decay_rate=0.9, maturity_threshold=5, **kwargs)
+    data_generator = torch.Generator().manual_seed(1)
+    torch.manual_seed(2)
+    for _ in range(num_steps):
+        x = torch.randn(8, 6, generator=data_generator)
+        target = torch.randn(8, 1, generator=data_generator)
+        features = []
+        out = x
+        for i in range(gnt.num_hidden_layers):
+            out = net[i * 2 + 1](net[i * 2](out))
+            features.append(out)
+        loss = F.mse_loss(net[-1](out), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        gnt.gen_and_test(features=[f.detach() for f in features])
+    return net, gnt, optimizer
+
+
+def assert_same_nets(net, other_net):
+    for p, other_p in zip(net.parameters(), other_net.parameters()):
+        torch.testing.assert_close(p, other_p)
+
+
+def test_fused_gnt_matches_gnt():
+    for opt in ['sgd', 'adam']:
+        net, gnt, optimizer = run_gnt(make_net(), GnT, opt=opt)
+        fused_net, fused_gnt, fused_optimizer = run_gnt(make_net(), FusedGnT, opt=opt)
+        assert_same_nets(net, fused_net)
+        for i in range(gnt.num_hidden_layers):
+            torch.testing.assert_close(gnt.ages[i], fused_gnt.ages[i])
+            torch.testing.assert_close(gnt.util[i], fused_gnt.util[i])
+            torch.testing.assert_close(gnt.mean_feature_act[i], fused_gnt.mean_feature_act[i])
+        if opt == 'adam':
+            for p, fused_p in zip(net.parameters(), fused_net.parameters()):
+                for key in ['exp_avg', 'exp_avg_sq']:
+                    torch.testing.assert_close(optimizer.state[p][key], fused_optimizer.state[fused_p][key])
+
+
+def test_fused_gnt_replaces_features():
+    _, gnt, _ = run_gnt(make_net(), FusedGnT)
+    assert any((gnt.ages[i] < 200).any() for i in range(gnt.num_hidden_layers))
+
+
+def test_lazy_decay_matches_gnt():
+    # the decay scale is folded back into the utilities after about 220 steps with decay_rate 0.9
+    net, gnt, _ = run_gnt(make_net(activation=nn.Tanh), GnT, num_steps=300)
+    for gnt_class in [GnT, FusedGnT]:
+        lazy_net, lazy_gnt, _ = run_gnt(make_net(activation=nn.Tanh), gnt_class, num_steps=300, lazy_decay=True)
+        assert_same_nets(net, lazy_net)
+        for i in range(gnt.num_hidden_layers):
+            torch.testing.assert_close(gnt.ages[i], lazy_gnt.ages[i])
+            torch.testing.assert_close(gnt.corrected_utility(i), lazy_gnt.corrected_utility(i), rtol=1e-4, atol=1e-6)
@@ -0,0 +1,34 @@
+import torch
+import pickle
+import numpy as np
+from lop.utils.packed_bits import PackedBinaryInputs
+from lop.slowly_changing_regression.slowly_changing_regression import generate_problem_data
+
+
+def test_packed_bits_round_trip():
+    generator = np.random.default_rng(0)
+    flip_after, num_flipping_bits, num_random_bits = 7, 3, 13
+    flipping_bits = generator.integers(2, size=(5, num_flipping_bits), dtype=np.uint8)
+    random_bits = generator.integers(2, size=(5 * flip_after, num_random_bits), dtype=np.uint8)
+    inputs = np.concatenate((flipping_bits.repeat(flip_after, axis=0), random_bits), axis=1).astype(np.float32)
+
+    X = PackedBinaryInputs(flipping_bits=flipping_bits, flip_after=flip_after,
+                           packed_bits=np.packbits(random_bits, axis=1), num_random_bits=num_random_bits)
+    assert X.shape == inputs.shape
+    assert torch.equal(X[:], torch.from_numpy(inputs))
+    assert torch.equal(X[5: 6], torch.from_numpy(inputs[5: 6]))
+    assert torch.equal(X[np.array([0, 20, 34])], torch.from_numpy(inputs[[0, 20, 34]]))
+
+
+def test_compact_data_file_matches_tensor_data_file(tmp_path):
+    kwargs = dict(flip_after=10000, num_data_points=20000, num_inputs=21, num_target_features=10, num_flipping_bits=5,
+                  seed=4)
+    generate_problem_data(data_file=str(tmp_path / 'tensor'), **kwargs)
+    generate_problem_data(data_file=str(tmp_path / 'compact'), data_format='compact', **kwargs)
+    with open(tmp_path / 'tensor', 'rb') as f:
+        X, Y, _ = pickle.load(f)
+    with open(tmp_path / 'compact', 'rb') as f:
+        compact_X, compact_Y, _ = pickle.load(f)
+    assert compact_X.shape == tuple(X.shape)
+    assert torch.equal(compact_X[:], X)
+    assert torch.equal(compact_Y, Y)
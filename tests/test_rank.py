@@ -0,0 +1,45 @@
+import torch
+import numpy as np
+from lop.utils.miscellaneous import compute_matrix_rank_summaries
+
+
+def loop_approximate_rank(sv, prop=0.99):
+    """
+    Approximate rank computed with a python loop over the sorted values, as before the summaries were batched
+    """
+    normed_sv = torch.flip(torch.sort(sv / torch.sum(sv))[0], dims=(0,))
+    cumulative_sum = 0.0
+    approximate_rank = 0
+    while cumulative_sum < prop:
+        cumulative_sum += normed_sv[approximate_rank]
+        approximate_rank += 1
+    return approximate_rank
+
+
+def loop_effective_rank(sv):
+    norm_sv = sv / torch.sum(torch.abs(sv))
+    entropy = torch.tensor(0.0, dtype=torch.float32)
+    for p in norm_sv:
+        if p > 0.0:
+            entropy -= p * torch.log(p)
+    return torch.tensor(np.e) ** entropy
+
+
+def test_batched_rank_summaries_match_per_matrix():
+    generator = torch.Generator().manual_seed(0)
+    matrices = torch.randn(5, 40, 12, generator=generator)
+    # a rank-deficient matrix, a matrix with one large direction and an all-zero matrix
+    matrices[1] = torch.randn(40, 3, generator=generator) @ torch.randn(3, 12, generator=generator)
+    matrices[2] = torch.randn(40, 1, generator=generator) @ torch.randn(1, 12, generator=generator) * 100 + matrices[2]
+    matrices[3] = 0
+    rank, effective_rank, approximate_rank, approximate_rank_abs = compute_matrix_rank_summaries(matrices)
+    assert rank.shape == (5,)
+    for i, m in enumerate(matrices):
+        sv = torch.linalg.svdvals(m)
+        assert rank[i] == torch.count_nonzero(sv)
+        assert approximate_rank[i] == loop_approximate_rank(sv ** 2)
+        assert approximate_rank_abs[i] == loop_approximate_rank(sv)
+        torch.testing.assert_close(effective_rank[i], loop_effective_rank(sv).to(torch.float32))
+        single_summaries = compute_matrix_rank_summaries(m)
+        for batched, single in zip((rank, effective_rank, approximate_rank, approximate_rank_abs), single_summaries):
+            torch.testing.assert_close(batched[i], single)
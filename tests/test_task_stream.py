@@ -0,0 +1,31 @@
+import torch
+import numpy as np
+from lop.permuted_mnist.task_stream import PermutedTaskStream
+
+
+def test_task_stream_matches_permuted_copies():
+    examples_per_task, input_size = 50, 12
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(examples_per_task, input_size, generator=generator)
+    y = torch.randint(10, size=(examples_per_task,), generator=generator)
+
+    # the original experiment copies the data set at every task switch
+    np.random.seed(1)
+    permuted_x, permuted_y = [], []
+    task_x, task_y = x, y
+    for _ in range(4):
+        pixel_permutation = np.random.permutation(input_size)
+        data_permutation = np.random.permutation(examples_per_task)
+        task_x = task_x[:, pixel_permutation][data_permutation]
+        task_y = task_y[data_permutation]
+        permuted_x.append(task_x)
+        permuted_y.append(task_y)
+
+    np.random.seed(1)
+    stream = PermutedTaskStream(x, y, examples_per_task=examples_per_task, input_size=input_size)
+    for task_x, task_y in zip(permuted_x, permuted_y):
+        stream.new_task()
+        for start_idx in range(0, examples_per_task, 16):
+            batch_x, batch_y = stream.get(start_idx, start_idx + 16)
+            assert torch.equal(batch_x, task_x[start_idx: start_idx + 16])
+            assert torch.equal(batch_y, task_y[start_idx: start_idx + 16])